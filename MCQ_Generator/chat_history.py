@@ -0,0 +1,66 @@
+from datetime import timedelta
+from typing import Iterable, List, Tuple
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+
+def build_turn_messages(message_model, chat, turns: Iterable[Tuple[str, str]], last_order_number: int = 0) -> List:
+    """
+    Builds the unsaved message rows for each (user_message, llm_message) turn. The user message of a turn always
+    comes directly before the llm message, numbered on from last_order_number.
+    """
+
+    chat_messages = []
+
+    for user_message, llm_message in turns:
+        chat_messages.append(message_model(chat=chat, message_text=user_message,
+                                           order_number=last_order_number + 1, llm_response=False))
+        chat_messages.append(message_model(chat=chat, message_text=llm_message,
+                                           order_number=last_order_number + 2, llm_response=True))
+        last_order_number += 2
+
+    return chat_messages
+
+
+def append_chat_turns(message_model, chat, turns: Iterable[Tuple[str, str]]) -> List:
+    """Appends the turns to the end of the chat with a single INSERT however many turns there are."""
+
+    last_order_number = message_model.objects.filter(chat=chat).aggregate(Max("order_number"))["order_number__max"]
+
+    chat_messages = message_model.objects.bulk_create(
+        build_turn_messages(message_model, chat, turns, last_order_number or 0))
+    chat.save(update_fields=["updated_at"])
+
+    return chat_messages
+
+
+async def aappend_chat_turns(message_model, chat, turns: Iterable[Tuple[str, str]]) -> List:
+
+    last_order_number = await message_model.objects.filter(chat=chat).aaggregate(Max("order_number"))
+
+    chat_messages = await message_model.objects.abulk_create(
+        build_turn_messages(message_model, chat, turns, last_order_number["order_number__max"] or 0))
+    await chat.asave(update_fields=["updated_at"])
+
+    return chat_messages
+
+
+def get_stale_drafts(chat_model):
+    """
+    Drafts whose last turn is older than the session cookie. Their session has expired so they can never be saved
+    or cleared by the user.
+    """
+
+    cutoff = timezone.now() - timedelta(seconds=settings.SESSION_COOKIE_AGE)
+
+    return chat_model.objects.filter(is_draft=True, updated_at__lt=cutoff)
+
+
+def delete_stale_drafts(chat_model) -> int:
+    return get_stale_drafts(chat_model).delete()[0]
+
+
+async def adelete_stale_drafts(chat_model) -> int:
+    return (await get_stale_drafts(chat_model).adelete())[0]
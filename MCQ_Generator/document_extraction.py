@@ -0,0 +1,138 @@
+import codecs
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from tempfile import NamedTemporaryFile
+from typing import Iterator, List, Tuple
+
+import billiard
+from django.conf import settings
+from pypdf import PdfReader
+
+logger = logging.getLogger("django_mcq")
+
+
+def get_pdf_source(file):
+    """
+    Works out what to hand to PdfReader without copying the upload. Uploads Django has already streamed to disk
+    (TemporaryUploadedFile) and FieldFiles on local storage are read from their path, in-memory uploads are read
+    straight from their buffer and plain paths are passed through.
+    """
+
+    if isinstance(file, (str, os.PathLike)):
+        return file
+
+    if hasattr(file, "temporary_file_path"):
+        return file.temporary_file_path()
+
+    local_path = get_local_path(file)
+    if local_path:
+        return local_path
+
+    file.seek(0)
+    return file
+
+
+def get_local_path(file):
+    # FieldFiles expose their path on FileSystemStorage, other storages raise NotImplementedError
+    try:
+        return file.path
+    except (AttributeError, NotImplementedError, ValueError):
+        return None
+
+
+@contextmanager
+def get_pdf_path(source):
+    """
+    Workers open their own reader so they are given a path. A buffer is written to a temporary file once, rather
+    than pickling the whole PDF for every page range.
+    """
+
+    if isinstance(source, (str, os.PathLike)):
+        yield str(source)
+        return
+
+    with NamedTemporaryFile(suffix=".pdf") as pdf_file:
+        source.seek(0)
+        shutil.copyfileobj(source, pdf_file)
+        pdf_file.flush()
+        yield pdf_file.name
+
+
+def iter_pdf_pages(file, start_page: int = 0) -> Iterator[Tuple[int, str]]:
+    """
+    Yields (page_number, page_text) in page order. Page numbers start at 0 to match the metadata
+    PyPDFLoader used to store in chroma, pages before start_page are skipped without extracting their text.
+    Large PDFs are split into page ranges which are extracted in parallel by the PDF process pool.
+    """
+
+    source = get_pdf_source(file)
+    reader = PdfReader(source)
+    page_count = len(reader.pages)
+
+    if not can_extract_in_parallel(page_count - start_page):
+        for page_number in range(start_page, page_count):
+            yield page_number, reader.pages[page_number].extract_text()
+        return
+
+    page_ranges = [(start, min(start + settings.PDF_EXTRACTION_PAGES_PER_TASK, page_count))
+                   for start in range(start_page, page_count, settings.PDF_EXTRACTION_PAGES_PER_TASK)]
+
+    # The pool only lives for this document so no idle processes are left behind in web or celery workers
+    with get_pdf_path(source) as pdf_path, get_pdf_process_pool(len(page_ranges)) as pool:
+        range_texts = pool.map(partial(extract_page_range, pdf_path), page_ranges)
+
+        # map returns the ranges in submission order so pages come out in order
+        for (start, _), texts in zip(page_ranges, range_texts):
+            for offset, page_text in enumerate(texts):
+                yield start + offset, page_text
+
+
+def extract_page_range(pdf_path: str, page_range: Tuple[int, int]) -> List[str]:
+
+    start_page, end_page = page_range
+    reader = PdfReader(pdf_path)
+
+    return [reader.pages[page_number].extract_text() for page_number in range(start_page, end_page)]
+
+
+def can_extract_in_parallel(page_count: int) -> bool:
+    # Small PDFs aren't worth the cost of shipping them to other processes
+    return settings.PDF_EXTRACTION_WORKERS > 1 and page_count >= settings.PDF_EXTRACTION_MIN_PAGES
+
+
+def get_pdf_process_pool(task_count: int):
+    """
+    Returns a pool with map(func, iterable) that is closed on leaving its with block. Celery prefork workers are
+    daemonic and multiprocessing refuses to start children from them, billiard doesn't have that restriction so
+    its pool is used there instead.
+    """
+
+    max_workers = min(settings.PDF_EXTRACTION_WORKERS, task_count)
+
+    # spawn rather than fork so workers don't inherit the locks held by the parent's client threads
+    if multiprocessing.current_process().daemon:
+        return billiard.get_context("spawn").Pool(processes=max_workers)
+
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def read_text_file(file, encoding: str = "utf-8") -> str:
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "r", encoding=encoding) as text_file:
+            return text_file.read()
+
+    file.seek(0)
+
+    # The incremental decoder carries characters split across chunk boundaries over to the next chunk, so the upload
+    # is never held as bytes and text at the same time
+    decoder = codecs.getincrementaldecoder(encoding)()
+    text_chunks = [decoder.decode(chunk) for chunk in file.chunks()]
+    text_chunks.append(decoder.decode(b"", final=True))
+
+    return "".join(text_chunks)
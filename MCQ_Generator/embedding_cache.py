@@ -0,0 +1,72 @@
+import hashlib
+import logging
+import unicodedata
+from array import array
+from typing import Callable, List
+
+from django.core.cache import caches
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger("django_mcq")
+
+EMBEDDING_CACHE_ALIAS = "embeddings"
+
+
+def normalise_embedding_text(text: str) -> str:
+    """Folds case, unicode forms and whitespace so near identical queries share a cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", text).split()).casefold()
+
+
+def get_embedding_cache_key(text: str, model: str) -> str:
+    digest = hashlib.sha256(f"{model}\n{normalise_embedding_text(text)}".encode("utf-8")).hexdigest()
+    return f"embedding:{digest}"
+
+
+def encode_embedding(vector) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def decode_embedding(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+def get_cached_embeddings(texts: List[str], model: str,
+                          embed_texts: Callable[[List[str]], list]) -> List[List[float]]:
+    """
+    Returns an embedding for every text, only calling embed_texts for the texts that are not already cached.
+    Vectors are stored as float32 blobs in the embeddings cache which evicts the least recently used entries.
+    """
+    cache = caches[EMBEDDING_CACHE_ALIAS]
+    keys = [get_embedding_cache_key(text, model) for text in texts]
+    cached = cache.get_many(keys)
+
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cached and key not in missing:
+            missing[key] = text
+
+    if missing:
+        logger.debug(f"Embedding cache miss for {len(missing)} of {len(texts)} texts")
+        vectors = embed_texts(list(missing.values()))
+        new_entries = {key: encode_embedding(vector) for key, vector in zip(missing, vectors)}
+        cache.set_many(new_entries)
+        cached.update(new_entries)
+
+    return [decode_embedding(cached[key]) for key in keys]
+
+
+class CachedEmbeddings(Embeddings):
+    """Langchain embeddings wrapper which serves embed_query from the embeddings cache."""
+
+    def __init__(self, embeddings: Embeddings, model: str):
+        self.embeddings = embeddings
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # Document chunks are rarely embedded twice so they are not worth the cache space
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return get_cached_embeddings([text], self.model, self.embeddings.embed_documents)[0]
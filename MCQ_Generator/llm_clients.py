@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from collections import defaultdict
+from typing import Callable
+
+import httpx
+from django.conf import settings
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_pinecone import PineconeVectorStore
+
+from MCQ_Generator.embedding_cache import CachedEmbeddings
+
+logger = logging.getLogger("django_mcq")
+
+DEFAULT_CHAT_MODEL = "gpt-4o-mini"
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-large"
+
+
+class ClientRegistry:
+    """
+    Thread safe, per-process store of API clients so their HTTP connection pools are reused between requests.
+
+    Clients registered as loop_bound hold httpx async connections, which only work on the event loop that opened
+    them, so they are kept per running event loop. Under ASGI that is one per process, under WSGI each async view
+    gets its own loop and the clients go away with it.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self._clients = {}
+        self._loop_clients = weakref.WeakKeyDictionary()
+        self._stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+
+    def _get_scope(self, loop_bound: bool):
+        if os.getpid() != self._pid:
+            # Sockets must not be shared with a forked child, e.g. a celery prefork worker
+            self._pid = os.getpid()
+            self._clients = {}
+            self._loop_clients = weakref.WeakKeyDictionary()
+
+        if not loop_bound:
+            return self._clients
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self._clients
+
+        scope = self._loop_clients.get(loop)
+        if scope is None:
+            scope = self._loop_clients[loop] = {}
+        return scope
+
+    def get(self, key: str, factory: Callable, loop_bound: bool = False):
+        with self._lock:
+            scope = self._get_scope(loop_bound)
+            client = scope.get(key)
+
+            if client is not None:
+                self._stats[key]["hits"] += 1
+                return client
+
+            # Creation is rare so it happens under the lock, that way each client is only ever built once
+            client = scope[key] = factory()
+            self._stats[key]["misses"] += 1
+            logger.info(f"Created {key} client, registry stats {self._stats[key]}")
+
+        return client
+
+    def stats(self):
+        """Hits and misses for each client key since the process started."""
+        with self._lock:
+            return {key: dict(counts) for key, counts in self._stats.items()}
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+            self._loop_clients = weakref.WeakKeyDictionary()
+            self._stats.clear()
+
+
+llm_clients = ClientRegistry()
+
+
+def get_http_limits(max_connections: int, max_keepalive_connections: int) -> httpx.Limits:
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections,
+                        keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY)
+
+
+def get_http_client() -> httpx.Client:
+    return llm_clients.get("http_client", lambda: httpx.Client(
+        limits=get_http_limits(settings.LLM_HTTP_MAX_CONNECTIONS, settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS),
+        timeout=settings.LLM_HTTP_TIMEOUT))
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    # Every async view in an ASGI worker shares this pool, so it is sized for all of their LLM calls at once
+    return llm_clients.get("async_http_client", lambda: httpx.AsyncClient(
+        limits=get_http_limits(settings.LLM_ASYNC_HTTP_MAX_CONNECTIONS,
+                               settings.LLM_ASYNC_HTTP_MAX_KEEPALIVE_CONNECTIONS),
+        timeout=settings.LLM_HTTP_TIMEOUT), loop_bound=True)
+
+
+def get_chat_model(model: str = DEFAULT_CHAT_MODEL) -> ChatOpenAI:
+    return llm_clients.get(f"chat_model:{model}", lambda: ChatOpenAI(
+        model=model,
+        api_key=settings.OPEN_API_KEY,
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client(),
+    ), loop_bound=True)
+
+
+def get_embeddings(model: str = DEFAULT_EMBEDDING_MODEL) -> CachedEmbeddings:
+    # Only the sync client is given as the async embedding methods run the sync ones in an executor
+    return llm_clients.get(f"embeddings:{model}", lambda: CachedEmbeddings(
+        OpenAIEmbeddings(model=model, api_key=settings.OPEN_API_KEY, http_client=get_http_client()),
+        model=model
+    ))
+
+
+def get_pinecone_vector_store(index_name: str, embedding_model: str = DEFAULT_EMBEDDING_MODEL):
+    # Creating the store looks the index host up over HTTP so it is only done once per process
+    return llm_clients.get(f"pinecone:{index_name}", lambda: PineconeVectorStore(
+        index_name=index_name,
+        embedding=get_embeddings(embedding_model),
+        pinecone_api_key=settings.PINECONE_API_KEY
+    ))
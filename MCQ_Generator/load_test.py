@@ -0,0 +1,87 @@
+"""
+Fires concurrent chatbot requests at a running deployment and reports latency and throughput, used to compare the
+WSGI deployment against the ASGI one, e.g.
+
+    gunicorn MCQ_Generator.wsgi --workers 4
+    uvicorn MCQ_Generator.asgi:application --workers 4
+
+    python -m MCQ_Generator.load_test --base-url http://localhost:8000 --username user --password pass \
+        --requests 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def login(client: httpx.AsyncClient, username: str, password: str):
+    response = await client.get("/accounts/login/")
+    response.raise_for_status()
+    response = await client.post("/accounts/login/", data={
+        "username": username,
+        "password": password,
+        "csrfmiddlewaretoken": client.cookies["csrftoken"],
+    }, headers={"Referer": str(client.base_url)})
+    response.raise_for_status()
+
+    if "sessionid" not in client.cookies:
+        raise SystemExit("Login failed, check the username and password")
+
+
+async def timed_post(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, path: str, user_msg: str):
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            response = await client.post(path, json={"user_msg": user_msg},
+                                         headers={"X-CSRFToken": client.cookies["csrftoken"],
+                                                  "Referer": str(client.base_url)})
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        return time.perf_counter() - start, ok
+
+
+def percentile(latencies, percent):
+    index = min(len(latencies) - 1, round(percent / 100 * (len(latencies) - 1)))
+    return latencies[index]
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        await login(client, args.username, args.password)
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        start = time.perf_counter()
+        results = await asyncio.gather(*[
+            timed_post(client, semaphore, args.path, f"{args.message} ({i})") for i in range(args.requests)
+        ])
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    failures = sum(1 for _, ok in results if not ok)
+
+    print(f"Requests:    {args.requests} ({failures} failed) at concurrency {args.concurrency}")
+    print(f"Total time:  {elapsed:.2f}s")
+    print(f"Throughput:  {args.requests / elapsed:.2f} req/s")
+    print(f"Latency:     mean {statistics.mean(latencies):.2f}s, p50 {percentile(latencies, 50):.2f}s, "
+          f"p95 {percentile(latencies, 95):.2f}s, max {latencies[-1]:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--path", default="/chatbot/answer_user")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--message", default="What is the capital of France?")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
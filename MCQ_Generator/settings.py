@@ -176,6 +176,75 @@ CELERY_RESULT_BACKEND = 'django-db'
 CELERY_TIMEZONE = 'UTC'
 CELERY_RESULT_EXTENDED = True
 
+# Quiz generation
+# PDFs with more characters than QUIZ_CHUNKED_THRESHOLD are split into chunks and questions are generated per chunk
+QUIZ_CHUNKED_THRESHOLD = env.int('QUIZ_CHUNKED_THRESHOLD', default=12000)
+QUIZ_CHUNK_SIZE = env.int('QUIZ_CHUNK_SIZE', default=6000)
+QUIZ_MAX_CHUNKS = env.int('QUIZ_MAX_CHUNKS', default=10)
+QUIZ_CHUNK_MAX_CONCURRENCY = env.int('QUIZ_CHUNK_MAX_CONCURRENCY', default=10)
+# Generated quizzes are cached by file hash, entries expire after QUIZ_CACHE_TTL seconds
+QUIZ_CACHE_TTL = env.int('QUIZ_CACHE_TTL', default=60 * 60 * 24 * 7)
+QUIZ_CACHE_MAX_ENTRIES = env.int('QUIZ_CACHE_MAX_ENTRIES', default=1000)
+# Quiz jobs still unfinished after QUIZ_JOB_TIMEOUT seconds are reported as failed, e.g. when their worker died.
+# Job rows and their uploads are deleted QUIZ_JOB_RETENTION seconds after they were created
+QUIZ_JOB_TIMEOUT = env.int('QUIZ_JOB_TIMEOUT', default=60 * 10)
+QUIZ_JOB_RETENTION = env.int('QUIZ_JOB_RETENTION', default=60 * 60 * 24)
+
+# PDFs with at least PDF_EXTRACTION_MIN_PAGES pages have their text extracted in parallel across worker processes.
+# Each web or celery worker starts its own pool per document so this is kept small
+PDF_EXTRACTION_WORKERS = env.int('PDF_EXTRACTION_WORKERS', default=2)
+PDF_EXTRACTION_MIN_PAGES = env.int('PDF_EXTRACTION_MIN_PAGES', default=32)
+PDF_EXTRACTION_PAGES_PER_TASK = env.int('PDF_EXTRACTION_PAGES_PER_TASK', default=8)
+
+CHROMA_DB_PATH = os.path.join(BASE_DIR, "chroma_db_storage")
+# Maximum number of per-user chroma collection handles kept open in each process
+LIBRARY_COLLECTION_POOL_SIZE = env.int('LIBRARY_COLLECTION_POOL_SIZE', default=128)
+# Library uploads are embedded in batches of chunks capped by token count, with several batches in flight at once
+LIBRARY_EMBEDDING_BATCH_TOKENS = env.int('LIBRARY_EMBEDDING_BATCH_TOKENS', default=20000)
+LIBRARY_EMBEDDING_BATCH_SIZE = env.int('LIBRARY_EMBEDDING_BATCH_SIZE', default=512)
+LIBRARY_EMBEDDING_MAX_CONCURRENCY = env.int('LIBRARY_EMBEDDING_MAX_CONCURRENCY', default=4)
+# Failed uploads are retried from their last checkpoint, waiting LIBRARY_INGEST_RETRY_DELAY seconds doubled each time.
+# Redeliveries after a worker died count against the same limit
+LIBRARY_INGEST_MAX_RETRIES = env.int('LIBRARY_INGEST_MAX_RETRIES', default=3)
+LIBRARY_INGEST_RETRY_DELAY = env.int('LIBRARY_INGEST_RETRY_DELAY', default=30)
+# Pages are extracted, embedded and checkpointed this many at a time so a resumed upload skips finished pages
+LIBRARY_INGEST_PAGES_PER_BATCH = env.int('LIBRARY_INGEST_PAGES_PER_BATCH', default=20)
+# Chunks of documents uploaded before chunk metadata held the document id are deleted by id in batches of this size
+LIBRARY_DELETE_BATCH_SIZE = env.int('LIBRARY_DELETE_BATCH_SIZE', default=1000)
+# Library chat retrieves this many chunks and packs the best of them into a context of at most this many tokens
+LIBRARY_CHAT_N_RESULTS = env.int('LIBRARY_CHAT_N_RESULTS', default=10)
+LIBRARY_CHAT_CONTEXT_TOKENS = env.int('LIBRARY_CHAT_CONTEXT_TOKENS', default=2000)
+
+# Chatbot answers are reused for questions whose embeddings have at least this cosine similarity, bump the corpus
+# version whenever the lyl-pdf index is rebuilt so answers from the old documents are dropped
+CHATBOT_SEMANTIC_CACHE_SIZE = env.int('CHATBOT_SEMANTIC_CACHE_SIZE', default=1000)
+CHATBOT_SEMANTIC_CACHE_THRESHOLD = env.float('CHATBOT_SEMANTIC_CACHE_THRESHOLD', default=0.95)
+LYL_CORPUS_VERSION = env('LYL_CORPUS_VERSION', default='1')
+
+# Connection pool shared by the OpenAI clients in each process, idle keep-alive connections close after the expiry
+LLM_HTTP_MAX_CONNECTIONS = env.int('LLM_HTTP_MAX_CONNECTIONS', default=20)
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = env.int('LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS', default=10)
+LLM_HTTP_KEEPALIVE_EXPIRY = env.int('LLM_HTTP_KEEPALIVE_EXPIRY', default=30)
+LLM_HTTP_TIMEOUT = env.int('LLM_HTTP_TIMEOUT', default=120)
+# The async pool is shared by every concurrent chat in an ASGI worker, a request past the limit waits for a connection
+LLM_ASYNC_HTTP_MAX_CONNECTIONS = env.int('LLM_ASYNC_HTTP_MAX_CONNECTIONS', default=500)
+LLM_ASYNC_HTTP_MAX_KEEPALIVE_CONNECTIONS = env.int('LLM_ASYNC_HTTP_MAX_KEEPALIVE_CONNECTIONS', default=100)
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Query embeddings stored as float32 blobs, least recently used entries are culled past MAX_ENTRIES
+    "embeddings": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "embeddings",
+        "TIMEOUT": None,
+        "OPTIONS": {
+            "MAX_ENTRIES": env.int('EMBEDDING_CACHE_MAX_ENTRIES', default=2000),
+        },
+    },
+}
+
 
 AWS_REGION = env('AWS_REGION')
 S3_BUCKET_NAME = env('S3_BUCKET_NAME')
@@ -183,6 +252,27 @@ AWS_ACCESS_KEY = env('AWS_ACCESS_KEY')
 AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY')
 
 VIDEOAPI_BASE_URL = env('VIDEOAPI_BASE_URL')
+# Videos the video API works on at once, the rest wait in the queue. A processing video that sends no webhook for
+# VIDEO_JOB_STALE_AFTER seconds is assumed lost and gives up its slot
+VIDEO_JOB_SLOTS = env.int('VIDEO_JOB_SLOTS', default=5)
+VIDEO_JOB_STALE_AFTER = env.int('VIDEO_JOB_STALE_AFTER', default=2 * 60 * 60)
+# Video API circuit breaker: opens after VIDEO_API_FAILURE_THRESHOLD failed calls in a row, probes again after
+# VIDEO_API_RESET_TIMEOUT seconds and gives a probing worker VIDEO_API_PROBE_LEASE seconds before another may try
+VIDEO_API_FAILURE_THRESHOLD = env.int('VIDEO_API_FAILURE_THRESHOLD', default=3)
+VIDEO_API_RESET_TIMEOUT = env.int('VIDEO_API_RESET_TIMEOUT', default=60)
+VIDEO_API_PROBE_LEASE = env.int('VIDEO_API_PROBE_LEASE', default=60)
+# The video detail page polls for status changes pushed by the video API's webhooks. Under WSGI it waits
+# VIDEO_STATUS_POLL_INTERVAL seconds between requests, under ASGI the server holds each request for up to
+# VIDEO_STATUS_LONG_POLL_TIMEOUT seconds, checking the database every VIDEO_STATUS_POLL_INTERVAL seconds
+VIDEO_STATUS_LONG_POLL_TIMEOUT = env.int('VIDEO_STATUS_LONG_POLL_TIMEOUT', default=25)
+VIDEO_STATUS_POLL_INTERVAL = env.float('VIDEO_STATUS_POLL_INTERVAL', default=3.0)
+# "proxy" streams videos from S3 through the app, "redirect" sends the browser to a presigned S3 url instead
+VIDEO_DOWNLOAD_MODE = env('VIDEO_DOWNLOAD_MODE', default='proxy')
+VIDEO_DOWNLOAD_CHUNK_SIZE = env.int('VIDEO_DOWNLOAD_CHUNK_SIZE', default=1024 * 1024)
+VIDEO_DOWNLOAD_URL_EXPIRY = env.int('VIDEO_DOWNLOAD_URL_EXPIRY', default=300)
+# Playback urls are signed for VIDEO_URL_EXPIRY seconds and reused until VIDEO_URL_REFRESH_MARGIN seconds are left
+VIDEO_URL_EXPIRY = env.int('VIDEO_URL_EXPIRY', default=3600)
+VIDEO_URL_REFRESH_MARGIN = env.int('VIDEO_URL_REFRESH_MARGIN', default=300)
 
 DJANGO_ENV = env('DJANGO_ENV')
 DJANGO_API_KEY = env("DJANGO_API_KEY")
@@ -0,0 +1,74 @@
+import logging
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Union
+
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+logger = logging.getLogger("django_mcq")
+
+
+def is_asgi_request(request) -> bool:
+    """
+    True when served by the ASGI handler. Under WSGI Django reads an async iterator to the end before sending it,
+    and an async view holds its worker for as long as it waits, so views pick their behaviour on this.
+    """
+
+    return isinstance(request, ASGIRequest)
+
+
+def stream_llm_message(message_chunks: Iterable, on_complete: Callable[[str], None], error_message: str):
+    """
+    Yields the text of each message chunk as it arrives and hands the full message to on_complete once the model
+    has finished. If the model fails part way through error_message is sent instead and on_complete isn't called.
+    """
+
+    parts = []
+
+    try:
+        for chunk in message_chunks:
+            if chunk.content:
+                parts.append(chunk.content)
+                yield chunk.content
+    except Exception as e:
+        logger.error(e)
+        yield error_message
+        return
+
+    on_complete("".join(parts))
+
+
+async def astream_llm_message(message_chunks: AsyncIterable, on_complete: Callable[[str], Awaitable[None]],
+                              error_message: str):
+
+    parts = []
+
+    try:
+        async for chunk in message_chunks:
+            if chunk.content:
+                parts.append(chunk.content)
+                yield chunk.content
+    except Exception as e:
+        logger.error(e)
+        yield error_message
+        return
+
+    await on_complete("".join(parts))
+
+
+def streaming_llm_response(message_chunks: Union[Iterable, AsyncIterable], on_complete: Callable, error_message: str):
+    """
+    Async chunks, e.g. from chain.astream, need an async on_complete and are for the ASGI deployment, under WSGI
+    pass sync chunks so they are still sent as they arrive.
+    """
+
+    if hasattr(message_chunks, "__aiter__"):
+        streaming_content = astream_llm_message(message_chunks, on_complete, error_message)
+    else:
+        streaming_content = stream_llm_message(message_chunks, on_complete, error_message)
+
+    response = StreamingHttpResponse(streaming_content, content_type="text/plain; charset=utf-8")
+    # Stop proxies such as nginx holding tokens back until the buffer fills
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+
+    return response
@@ -5,16 +5,16 @@ from chatbot.models import Chat, Message
 from django.db.models import Count
 
 class ChatAdmin(admin.ModelAdmin):
-    list_display = ('title', 'user')
-    list_filter = ('user',)
+    list_display = ('title', 'user', 'is_draft')
+    list_filter = ('user', 'is_draft')
     search_fields = ('title', 'user__username')
 
     change_list_template = "admin/chat_changelist.html"
 
     def changelist_view(self, request, extra_context=None):
-        total_chats = Chat.objects.count()
+        total_chats = Chat.objects.filter(is_draft=False).count()
         chats_per_user = (
-                Chat.objects.values('user__username')
+                Chat.objects.filter(is_draft=False).values('user__username')
             .annotate(count=Count('id'))
             .order_by('-count')
         )
@@ -1,20 +1,28 @@
 import logging
 
-from langchain_pinecone import PineconeVectorStore
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_core.messages import AIMessage, AIMessageChunk
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 
+from MCQ_Generator.llm_clients import get_chat_model, get_embeddings, get_pinecone_vector_store
+from chatbot.semantic_cache import semantic_answer_cache
+
 logger = logging.getLogger("django_mcq")
 
-def chatbot_response(user_msg: str):
+def get_chatbot_retriever():
+    """The pinecone retriever that finds the content to answer with."""
+
+    return get_pinecone_vector_store("lyl-pdf").as_retriever(
+        search_type="similarity_score_threshold",
+        search_kwargs={"k": 3, "score_threshold": 0.5},
+    )
 
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large", api_key=settings.OPEN_API_KEY)
-    vector_store = PineconeVectorStore(index_name="lyl-pdf", embedding=embeddings,
-                                       pinecone_api_key=settings.PINECONE_API_KEY)
 
-    model = ChatOpenAI(model="gpt-4o-mini", api_key=settings.OPEN_API_KEY)
+def get_chatbot_chain():
+
+    model = get_chat_model()
 
     prompt_template = """
         Use the following pieces of information to answer the users question. If you don't know the answer just say you don't know.
@@ -31,18 +39,131 @@ def chatbot_response(user_msg: str):
         input_variables=["content", "question"],
     )
 
-    retriever = vector_store.as_retriever(
-        search_type="similarity_score_threshold",
-        search_kwargs={"k": 3, "score_threshold": 0.5},
-    )
+    # And a query intended to prompt a language model to populate the data structure.
+    chain = prompt | model
 
-    doc_content = retriever.invoke(user_msg)
+    return chain
+
+
+def get_chatbot_chain_inputs(doc_content, user_msg: str):
 
     page_content_str = ".".join([doc.page_content for doc in doc_content])
 
-    # And a query intended to prompt a language model to populate the data structure.
-    chain = prompt | model
+    return {"content": page_content_str, "question": user_msg}
+
+
+def build_chatbot_chain(user_msg: str):
+    """Retrieves the context for user_msg and returns the chain with the inputs to run it on."""
+
+    doc_content = get_chatbot_retriever().invoke(user_msg)
+
+    return get_chatbot_chain(), get_chatbot_chain_inputs(doc_content, user_msg)
+
+
+def get_question_embedding(user_msg: str):
+    # Goes through the embeddings cache so the retriever's lookup of the same question doesn't call OpenAI again
+    return get_embeddings().embed_query(user_msg)
+
+
+def chatbot_response(user_msg: str):
+    corpus_version = settings.LYL_CORPUS_VERSION
+    question_embedding = get_question_embedding(user_msg)
+
+    cached_answer = semantic_answer_cache.get(question_embedding, corpus_version)
+    if cached_answer is not None:
+        return AIMessage(content=cached_answer)
+
+    chain, chain_inputs = build_chatbot_chain(user_msg)
+
+    output = chain.invoke(chain_inputs)
+
+    semantic_answer_cache.set(question_embedding, output.content, corpus_version)
+
+    return output
+
+
+def stream_chatbot_response(user_msg: str):
+    """
+    Retrieval runs straight away so its errors are raised here, the returned iterator yields the model's message
+    chunks as they are generated.
+    """
+    corpus_version = settings.LYL_CORPUS_VERSION
+    question_embedding = get_question_embedding(user_msg)
+
+    cached_answer = semantic_answer_cache.get(question_embedding, corpus_version)
+    if cached_answer is not None:
+        return iter([AIMessageChunk(content=cached_answer)])
+
+    chain, chain_inputs = build_chatbot_chain(user_msg)
+
+    return cache_streamed_answer(chain.stream(chain_inputs), question_embedding, corpus_version)
+
+
+def cache_streamed_answer(message_chunks, question_embedding, corpus_version):
+    """Passes the chunks straight through and caches the answer once the model has finished."""
+
+    parts = []
+
+    for chunk in message_chunks:
+        parts.append(chunk.content)
+        yield chunk
+
+    semantic_answer_cache.set(question_embedding, "".join(parts), corpus_version)
+
+
+async def acache_streamed_answer(message_chunks, question_embedding, corpus_version):
+
+    parts = []
+
+    async for chunk in message_chunks:
+        parts.append(chunk.content)
+        yield chunk
+
+    semantic_answer_cache.set(question_embedding, "".join(parts), corpus_version)
+
+
+async def asingle_chunk(content: str):
+    yield AIMessageChunk(content=content)
+
+
+async def astream_chatbot_response(user_msg: str):
+    """Async version of stream_chatbot_response, the returned async iterator streams from chain.astream."""
+
+    corpus_version = settings.LYL_CORPUS_VERSION
+    question_embedding = await sync_to_async(get_question_embedding, thread_sensitive=False)(user_msg)
+
+    cached_answer = semantic_answer_cache.get(question_embedding, corpus_version)
+    if cached_answer is not None:
+        return asingle_chunk(cached_answer)
+
+    retriever = await sync_to_async(get_chatbot_retriever, thread_sensitive=False)()
+
+    doc_content = await retriever.ainvoke(user_msg)
+
+    chain = get_chatbot_chain()
+
+    return acache_streamed_answer(chain.astream(get_chatbot_chain_inputs(doc_content, user_msg)),
+                                  question_embedding, corpus_version)
+
+
+async def achatbot_response(user_msg: str):
+    """Async version of chatbot_response so a waiting request doesn't hold a worker thread."""
+
+    corpus_version = settings.LYL_CORPUS_VERSION
+    question_embedding = await sync_to_async(get_question_embedding, thread_sensitive=False)(user_msg)
+
+    cached_answer = semantic_answer_cache.get(question_embedding, corpus_version)
+    if cached_answer is not None:
+        return AIMessage(content=cached_answer)
+
+    # The first call creates the pinecone index client, which looks the index up over a blocking HTTP call
+    retriever = await sync_to_async(get_chatbot_retriever, thread_sensitive=False)()
+
+    doc_content = await retriever.ainvoke(user_msg)
+
+    # The chain is built on this event loop so the model gets this loop's async connection pool
+    output = await get_chatbot_chain().ainvoke(get_chatbot_chain_inputs(doc_content, user_msg))
 
-    output = chain.invoke({"content": page_content_str, "question": user_msg})
+    semantic_answer_cache.set(question_embedding, output.content, corpus_version)
 
-    return output
\ No newline at end of file
+    return output
@@ -3,13 +3,20 @@ from django.db import models
 from django.contrib.auth.models import User
 
 class Chat(models.Model):
-    title = models.CharField(max_length=128)
+    # Drafts have no title until the user saves them, postgres lets the unique constraint hold any number of nulls
+    title = models.CharField(max_length=128, null=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    is_draft = models.BooleanField(default=False)
+    # Bumped on every new turn so abandoned drafts can be told apart from ones still being written
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['user', 'title'], name='unique_chat_title_per_user')
         ]
+        indexes = [
+            models.Index(fields=['is_draft', 'updated_at'], name='chat_draft_idx')
+        ]
 
 
 class Message(models.Model):
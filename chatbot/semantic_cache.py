@@ -0,0 +1,102 @@
+import logging
+import threading
+from typing import Optional
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger("django_mcq")
+
+
+class SemanticAnswerCache:
+    """
+    In-process cache of chatbot answers looked up by question similarity rather than exact text. Question
+    embeddings are held as unit vectors in one float32 matrix so a lookup is a single matrix-vector product.
+    When the cache is full the least recently used answer is replaced. Answers were generated from one version of
+    the corpus, so the whole cache is dropped when the version changes.
+    """
+
+    def __init__(self, max_size: int, threshold: float):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self, corpus_version=None):
+        self.corpus_version = corpus_version
+        self._vectors = None
+        self._answers = []
+        self._last_used = np.zeros(self.max_size, dtype=np.int64)
+        self._tick = 0
+
+    def _use_corpus_version(self, corpus_version):
+        if corpus_version != self.corpus_version:
+            if self._answers:
+                logger.info(f"Corpus version is now {corpus_version}, dropping {len(self._answers)} cached answers")
+            self._clear(corpus_version)
+
+    @staticmethod
+    def _normalise(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, embedding, corpus_version) -> Optional[str]:
+        if self.max_size <= 0:
+            return None
+
+        vector = self._normalise(embedding)
+
+        with self._lock:
+            self._use_corpus_version(corpus_version)
+
+            if self._answers and self._vectors.shape[1] == vector.shape[0]:
+                similarities = self._vectors[:len(self._answers)] @ vector
+                best = int(np.argmax(similarities))
+
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    self._tick += 1
+                    self._last_used[best] = self._tick
+                    return self._answers[best]
+
+            self.misses += 1
+            return None
+
+    def set(self, embedding, answer: str, corpus_version):
+        if self.max_size <= 0:
+            return
+
+        vector = self._normalise(embedding)
+
+        with self._lock:
+            self._use_corpus_version(corpus_version)
+
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                # First answer, or the embedding model changed, so start again at the new dimension
+                self._clear(corpus_version)
+                self._vectors = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+
+            if len(self._answers) < self.max_size:
+                slot = len(self._answers)
+                self._answers.append(answer)
+            else:
+                slot = int(np.argmin(self._last_used))
+                self._answers[slot] = answer
+
+            self._vectors[slot] = vector
+            self._tick += 1
+            self._last_used[slot] = self._tick
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def __len__(self):
+        return len(self._answers)
+
+
+semantic_answer_cache = SemanticAnswerCache(max_size=settings.CHATBOT_SEMANTIC_CACHE_SIZE,
+                                            threshold=settings.CHATBOT_SEMANTIC_CACHE_THRESHOLD)
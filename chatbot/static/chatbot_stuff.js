@@ -51,7 +51,7 @@ submitBtn.addEventListener(
 
         let bodyObject;
 
-        if (url === "/library/answer_user"){
+        if (url.startsWith("/library/")){
             const documentSelect = document.getElementById("id_document")
             let selectedValues = Array.from(documentSelect.selectedOptions).map(
                 option => option.value);
@@ -67,14 +67,31 @@ submitBtn.addEventListener(
             method: 'POST',
             body: JSON.stringify(bodyObject)
     })
-        .then(response => {
-        // Parse the JSON from the response
-        return response.json();
-        })
-        .then(data => {
-            const message = data['message']
-            boxDiv.appendChild(createItem(message, true));
+        .then(async response => {
+            // Errors before the model starts answering still come back as JSON
+            if (response.headers.get("Content-Type").startsWith("application/json")) {
+                const data = await response.json();
+                boxDiv.appendChild(createItem(data['message'], true));
+                boxDiv.appendChild(createLineBreak());
+                return;
+            }
+
+            const llmItem = createItem("", true);
+            const llmText = llmItem.querySelector(".msg p");
+            boxDiv.appendChild(llmItem);
             boxDiv.appendChild(createLineBreak());
+
+            // Show each token as soon as it arrives
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+
+            while (true) {
+                const {done, value} = await reader.read();
+                if (done) {
+                    break;
+                }
+                llmText.textContent += decoder.decode(value, {stream: true});
+            }
         })
         .catch(err => {
             console.log(err)
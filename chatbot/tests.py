@@ -1,12 +1,30 @@
+import asyncio
 import json
-from unittest.mock import patch
-
-from django.test import TestCase, Client
+import threading
+import time
+from datetime import timedelta
+from unittest import TestCase as unittestTestCase
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.utils import timezone
+
+from langchain_core.messages import AIMessage, AIMessageChunk
 
+from chatbot.helpers import achatbot_response, astream_chatbot_response, chatbot_response, stream_chatbot_response
 from chatbot.models import Chat, Message
+from chatbot.semantic_cache import SemanticAnswerCache
 from chatbot.forms import ChatTitleForm
+from MCQ_Generator.chat_history import append_chat_turns, build_turn_messages
+from MCQ_Generator.llm_clients import ClientRegistry, get_async_http_client, get_chat_model, get_http_client
+from MCQ_Generator.embedding_cache import (EMBEDDING_CACHE_ALIAS, CachedEmbeddings, get_cached_embeddings,
+                                           get_embedding_cache_key)
 
 
 
@@ -93,6 +111,23 @@ class ChatTestCase(TestCase):
         # Client not logged in so will do a redirect
         self.assertEqual(response.status_code, 302)
 
+    def start_draft_chat(self, client, turns):
+        draft_chat = Chat.objects.create(user=ChatTestCase.test_user, is_draft=True)
+        for turn in range(1, turns + 1):
+            Message.objects.create(chat=draft_chat, message_text=f"user_msg_{turn}", order_number=turn * 2 - 1,
+                                   llm_response=False)
+            Message.objects.create(chat=draft_chat, message_text=f"llm_msg_{turn}", order_number=turn * 2,
+                                   llm_response=True)
+        session = client.session
+        session['draft_chat_id'] = draft_chat.pk
+        session.save()
+        return draft_chat
+
+    def assert_chat_messages(self, chat, expected_messages):
+        chat_messages = Message.objects.filter(chat=chat).order_by('order_number')
+        self.assertEqual([(m.order_number, m.message_text, m.llm_response) for m in chat_messages],
+                         expected_messages)
+
     def test_new_chat_get_request_success(self):
 
         url = reverse("new_chat")
@@ -109,8 +144,18 @@ class ChatTestCase(TestCase):
         self.assertIn("form", response.context)
         self.assertIsInstance(response.context["form"], ChatTitleForm)
 
-        self.assertEqual(self.authenticated_client.session['lyl_messages'], [])
-        self.assertEqual(self.authenticated_client.session['number_chats'], 1)
+        self.assertNotIn('draft_chat_id', self.authenticated_client.session)
+
+    def test_new_chat_discards_unsaved_draft(self):
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=2)
+
+        response = self.authenticated_client.get(reverse("new_chat"))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertFalse(Chat.objects.filter(pk=draft_chat.pk).exists())
+        self.assertFalse(Message.objects.filter(chat_id=draft_chat.pk).exists())
+        self.assertNotIn('draft_chat_id', self.authenticated_client.session)
+        self.assertTrue(Chat.objects.filter(pk=ChatTestCase.test_chat.pk).exists())
 
     def test_new_chat_get_request_unauthorised(self):
         url = reverse("new_chat")
@@ -118,7 +163,7 @@ class ChatTestCase(TestCase):
         response = self.unauthenticated_client.get(url)
         self.assertEqual(response.status_code, 302)
 
-    @patch("chatbot.views.chatbot_response")
+    @patch("chatbot.views.achatbot_response")
     def test_answer_input_success_first_msg(self, mock_chatbot_response):
         url = reverse("answer_user_input")
         user_message = "Hello World"
@@ -129,59 +174,97 @@ class ChatTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(str(response.content, 'utf-8')), {"message": llm_message})
 
-        message_dict = {f"user_msg": user_message, f"llm_msg": llm_message, "chat_number": 1}
-
-        self.assertEqual(self.authenticated_client.session['number_chats'], 2)
-        self.assertEqual(self.authenticated_client.session['lyl_messages'], [message_dict])
+        draft_chat = Chat.objects.get(pk=self.authenticated_client.session['draft_chat_id'])
+        self.assertTrue(draft_chat.is_draft)
+        self.assertIsNone(draft_chat.title)
+        self.assertEqual(draft_chat.user, ChatTestCase.test_user)
+        self.assert_chat_messages(draft_chat, [(1, user_message, False), (2, llm_message, True)])
         mock_chatbot_response.assert_called_once_with(user_message)
 
-    @patch("chatbot.views.chatbot_response")
+    @patch("chatbot.views.achatbot_response")
     def test_answer_input_success_multiple_msg(self, mock_chatbot_response):
         url = reverse("answer_user_input")
         user_message = "Hello World multiple"
         llm_message = "Hello Human multiple"
         llm_response = MockLLMContent(llm_message)
         mock_chatbot_response.return_value = llm_response
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_chats'] = 4
-        session['lyl_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"user_msg": user_message}, content_type="application/json")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(str(response.content, 'utf-8')), {"message": llm_message})
 
-        message_dict = {f"user_msg": user_message, f"llm_msg": llm_message, "chat_number": 4}
-
-        message_session.append(message_dict)
-
-        self.assertEqual(self.authenticated_client.session['number_chats'], 5)
-        self.assertEqual(self.authenticated_client.session['lyl_messages'], message_session)
+        self.assertEqual(self.authenticated_client.session['draft_chat_id'], draft_chat.pk)
+        self.assert_chat_messages(draft_chat, [
+            (1, "user_msg_1", False), (2, "llm_msg_1", True),
+            (3, "user_msg_2", False), (4, "llm_msg_2", True),
+            (5, "user_msg_3", False), (6, "llm_msg_3", True),
+            (7, user_message, False), (8, llm_message, True),
+        ])
 
         mock_chatbot_response.assert_called_once_with(user_message)
 
-    @patch("chatbot.views.chatbot_response")
+    @patch("chatbot.views.achatbot_response")
     def test_answer_input_chatbot_response_raises_exception(self, mock_chatbot_response):
         url = reverse("answer_user_input")
         user_message = "Hello World multiple"
         mock_chatbot_response.side_effect = Exception
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_chats'] = 4
-        session['lyl_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"user_msg": user_message}, content_type="application/json")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(str(response.content, 'utf-8')),
                          {"message": "Problem with chatbot response please contact the System Administrator"})
 
+        self.assertEqual(Message.objects.filter(chat=draft_chat).count(), 6)
         mock_chatbot_response.assert_called_once_with(user_message)
 
-    @patch("chatbot.views.chatbot_response")
+    @patch("chatbot.views.achatbot_response")
+    def test_answer_input_ignores_another_users_draft(self, mock_chatbot_response):
+        url = reverse("answer_user_input")
+        mock_chatbot_response.return_value = MockLLMContent("Hello Human")
+        other_draft = Chat.objects.create(user=ChatTestCase.random_user, is_draft=True)
+        session = self.authenticated_client.session
+        session['draft_chat_id'] = other_draft.pk
+        session.save()
+
+        response = self.authenticated_client.post(url, data={"user_msg": "Hello"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertFalse(Message.objects.filter(chat=other_draft).exists())
+        draft_chat = Chat.objects.get(pk=self.authenticated_client.session['draft_chat_id'])
+        self.assertEqual(draft_chat.user, ChatTestCase.test_user)
+
+    @patch("chatbot.views.achatbot_response")
+    def test_new_draft_deletes_drafts_left_by_expired_sessions(self, mock_chatbot_response):
+        mock_chatbot_response.return_value = MockLLMContent("Hello Human")
+        expired = timezone.now() - timedelta(seconds=settings.SESSION_COOKIE_AGE + 60)
+        stale_draft = Chat.objects.create(user=ChatTestCase.random_user, is_draft=True)
+        Message.objects.create(chat=stale_draft, message_text="user_msg_1", order_number=1)
+        active_draft = Chat.objects.create(user=ChatTestCase.random_user, is_draft=True)
+        old_saved_chat = Chat.objects.create(user=ChatTestCase.random_user, title="Old chat")
+        Chat.objects.filter(pk__in=[stale_draft.pk, old_saved_chat.pk]).update(updated_at=expired)
+
+        response = self.authenticated_client.post(reverse("answer_user_input"), data={"user_msg": "Hello"},
+                                                  content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertFalse(Chat.objects.filter(pk=stale_draft.pk).exists())
+        self.assertFalse(Message.objects.filter(chat_id=stale_draft.pk).exists())
+        self.assertTrue(Chat.objects.filter(pk=active_draft.pk).exists())
+        self.assertTrue(Chat.objects.filter(pk=old_saved_chat.pk).exists())
+
+    @patch("chatbot.views.achatbot_response")
+    def test_new_turn_keeps_draft_from_going_stale(self, mock_chatbot_response):
+        mock_chatbot_response.return_value = MockLLMContent("Hello Human")
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=1)
+        Chat.objects.filter(pk=draft_chat.pk).update(updated_at=timezone.now() - timedelta(days=1))
+
+        self.authenticated_client.post(reverse("answer_user_input"), data={"user_msg": "Hello"},
+                                       content_type="application/json")
+
+        draft_chat.refresh_from_db()
+        self.assertGreater(draft_chat.updated_at, timezone.now() - timedelta(minutes=1))
+
+    @patch("chatbot.views.achatbot_response")
     def test_answer_input_unauthorised(self, mock_chatbot_response):
         url = reverse("answer_user_input")
         user_message = "Hello World"
@@ -192,22 +275,98 @@ class ChatTestCase(TestCase):
         self.assertEqual(response.status_code, 302)
         mock_chatbot_response.assert_not_called()
 
+    @patch("chatbot.views.stream_chatbot_response")
+    def test_answer_input_stream_success(self, mock_stream_response):
+        url = reverse("answer_user_input_stream")
+        user_message = "Hello World"
+        mock_stream_response.return_value = iter([MockLLMContent("Hello"), MockLLMContent(""),
+                                                  MockLLMContent(" Human")])
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=1)
+
+        response = self.authenticated_client.post(url, data={"user_msg": user_message}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+
+        # Full message is only added to the history once the stream has finished
+        self.assertEqual(Message.objects.filter(chat=draft_chat).count(), 2)
+        self.assertEqual(list(response.streaming_content), [b"Hello", b" Human"])
+        self.assert_chat_messages(draft_chat, [
+            (1, "user_msg_1", False), (2, "llm_msg_1", True),
+            (3, user_message, False), (4, "Hello Human", True),
+        ])
+        mock_stream_response.assert_called_once_with(user_message)
+
+    @patch("chatbot.views.stream_chatbot_response")
+    def test_answer_input_stream_first_msg_starts_draft(self, mock_stream_response):
+        url = reverse("answer_user_input_stream")
+        mock_stream_response.return_value = iter([MockLLMContent("Hello Human")])
+
+        response = self.authenticated_client.post(url, data={"user_msg": "Hello"}, content_type="application/json")
+        self.assertEqual(list(response.streaming_content), [b"Hello Human"])
+
+        draft_chat = Chat.objects.get(pk=self.authenticated_client.session['draft_chat_id'])
+        self.assertTrue(draft_chat.is_draft)
+        self.assert_chat_messages(draft_chat, [(1, "Hello", False), (2, "Hello Human", True)])
+
+    @patch("chatbot.views.stream_chatbot_response")
+    def test_answer_input_stream_retrieval_raises_exception(self, mock_stream_response):
+        url = reverse("answer_user_input_stream")
+        mock_stream_response.side_effect = Exception
+
+        response = self.authenticated_client.post(url, data={"user_msg": "Hello"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(str(response.content, 'utf-8')),
+                         {"message": "Problem with chatbot response please contact the System Administrator"})
+
+    @patch("chatbot.views.stream_chatbot_response")
+    def test_answer_input_stream_model_fails_mid_stream(self, mock_stream_response):
+        url = reverse("answer_user_input_stream")
+
+        def message_chunks():
+            yield MockLLMContent("Hello")
+            raise Exception("connection reset")
+
+        mock_stream_response.return_value = message_chunks()
+
+        response = self.authenticated_client.post(url, data={"user_msg": "Hello"}, content_type="application/json")
+        self.assertEqual(b"".join(response.streaming_content),
+                         b"HelloProblem with chatbot response please contact the System Administrator")
+        self.assertNotIn('draft_chat_id', self.authenticated_client.session)
+        self.assertFalse(Chat.objects.filter(is_draft=True).exists())
+
+    @patch("chatbot.views.stream_chatbot_response")
+    def test_answer_input_stream_unauthorised(self, mock_stream_response):
+        url = reverse("answer_user_input_stream")
+        response = self.client.post(url, data={"user_msg": "Hello"}, content_type="application/json")
+        self.assertEqual(response.status_code, 302)
+        mock_stream_response.assert_not_called()
+
+    def test_draft_chats_are_not_listed_or_viewable(self):
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=1)
+
+        response = self.authenticated_client.get(reverse("chat_index"))
+        self.assertEqual(list(response.context['chats']), [ChatTestCase.test_chat])
+
+        response = self.authenticated_client.get(reverse("chat_detail", args=[draft_chat.pk]))
+        self.assertEqual(response.status_code, 404)
+
     def test_save_chat_success(self):
         url = reverse("save_chat")
         new_chat_title = 'Save Chat Test'
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_chats'] = 4
-        session['lyl_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"name_title": new_chat_title})
         self.assertEqual(response.status_code, 302)
         new_chat_queryset = Chat.objects.filter(title=new_chat_title, user=ChatTestCase.test_user)
         self.assertTrue(new_chat_queryset.exists())
         self.assertEqual(new_chat_queryset.count(), 1)
         new_chat_obj = new_chat_queryset.first()
+
+        # Saving names the draft in place rather than copying its messages
+        self.assertEqual(new_chat_obj.pk, draft_chat.pk)
+        self.assertFalse(new_chat_obj.is_draft)
+        self.assertNotIn('draft_chat_id', self.authenticated_client.session)
+
         messages_queryset = Message.objects.filter(chat=new_chat_obj).order_by('order_number')
         self.assertEqual(messages_queryset.count(), 6)
 
@@ -234,33 +393,32 @@ class ChatTestCase(TestCase):
 
             count += 1
 
+    def test_save_chat_without_messages(self):
+        url = reverse("save_chat")
+        response = self.authenticated_client.post(url, data={"name_title": "Empty chat"})
+        self.assertEqual(response.status_code, 302)
+
+        new_chat = Chat.objects.get(title="Empty chat", user=ChatTestCase.test_user)
+        self.assertFalse(new_chat.is_draft)
+        self.assertFalse(Message.objects.filter(chat=new_chat).exists())
+
     def test_save_form_not_valid(self):
         url = reverse("save_chat")
         new_chat_title = 'Save Chat Test dhbbbbbbsnjssssssssssssssss22888888888888888888dbbdbdbdbdbdbbdbdbhddhwkebwefbwedkbfhewfbefbwekfbfhjfbkrwfdkdjkdjdjjdjdjddjd'
 
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_chats'] = 4
-        session['lyl_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"name_title": new_chat_title})
         self.assertEqual(response.status_code, 400)
         self.assertEqual(json.loads(str(response.content, 'utf-8'))['error'], "Please fix chat name")
+        draft_chat.refresh_from_db()
+        self.assertTrue(draft_chat.is_draft)
 
 
     def test_save_form_error_save_chat(self):
         url = reverse("save_chat")
         new_chat_title = 'test chat'
 
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_chats'] = 4
-        session['lyl_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"name_title": new_chat_title})
         self.assertEqual(response.status_code, 500)
         self.assertEqual(json.loads(str(response.content, 'utf-8'))['error'], "Error when saving chat")
@@ -268,17 +426,15 @@ class ChatTestCase(TestCase):
         self.assertTrue(number_chat_queryset.exists())
         self.assertEqual(number_chat_queryset.count(), 1)
 
+        # The draft is kept so the user can pick another name
+        draft_chat.refresh_from_db()
+        self.assertTrue(draft_chat.is_draft)
+        self.assertEqual(self.authenticated_client.session['draft_chat_id'], draft_chat.pk)
+
     def test_save_unauthenticated_user(self):
         url = reverse("save_chat")
         new_chat_title = 'test chat'
 
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.unauthenticated_client.session
-        session['number_chats'] = 4
-        session['lyl_messages'] = message_session
-        session.save()
         response = self.unauthenticated_client.post(url, data={"name_title": new_chat_title})
         self.assertEqual(response.status_code, 302)
 
@@ -333,3 +489,398 @@ class ChatTestCase(TestCase):
         first_response = self.unauthenticated_client.get(url)
         self.assertEqual(first_response.status_code, 404)
 
+
+class ChatHistoryTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.test_user = User.objects.create_user(username='testuser', password='password')
+        cls.turns = [(f"user_msg_{i}", f"llm_msg_{i}") for i in range(1, 101)]
+
+    def setUp(self):
+        self.authenticated_client = Client()
+        self.authenticated_client.login(username='testuser', password='password')
+
+    def test_build_turn_messages(self):
+        chat = Chat(user=self.test_user, is_draft=True)
+        chat_messages = build_turn_messages(Message, chat, self.turns[:2], last_order_number=4)
+
+        self.assertEqual([(m.order_number, m.message_text, m.llm_response) for m in chat_messages], [
+            (5, "user_msg_1", False), (6, "llm_msg_1", True), (7, "user_msg_2", False), (8, "llm_msg_2", True)
+        ])
+        self.assertTrue(all(m.chat is chat for m in chat_messages))
+
+    def test_append_100_turns_in_one_insert(self):
+        chat = Chat.objects.create(user=self.test_user, is_draft=True)
+        append_chat_turns(Message, chat, self.turns[:1])
+
+        # One query for the last order number, one INSERT and one UPDATE of the chat's updated_at,
+        # saving each row would take 200
+        with self.assertNumQueries(3):
+            append_chat_turns(Message, chat, self.turns)
+
+        chat_messages = Message.objects.filter(chat=chat).order_by('order_number')
+        self.assertEqual(chat_messages.count(), 202)
+        self.assertEqual(chat_messages.last().order_number, 202)
+        self.assertEqual(chat_messages.last().message_text, "llm_msg_100")
+
+    def save_draft_chat(self, title, number_of_turns):
+        chat = Chat.objects.create(user=self.test_user, is_draft=True)
+        append_chat_turns(Message, chat, self.turns[:number_of_turns])
+        session = self.authenticated_client.session
+        session['draft_chat_id'] = chat.pk
+        session.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.authenticated_client.post(reverse("save_chat"), data={"name_title": title})
+        self.assertEqual(response.status_code, 302)
+
+        return len(queries)
+
+    def test_saving_100_turn_chat_costs_the_same_as_one_turn(self):
+        one_turn_queries = self.save_draft_chat("One turn", 1)
+        hundred_turn_queries = self.save_draft_chat("Hundred turns", 100)
+
+        self.assertEqual(hundred_turn_queries, one_turn_queries)
+        saved_chat = Chat.objects.get(title="Hundred turns")
+        self.assertEqual(Message.objects.filter(chat=saved_chat).count(), 200)
+
+
+class AsyncAnswerConcurrencyTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.test_user = User.objects.create_user(username='testuser', password='password')
+
+    async def test_concurrent_answers_wait_on_the_llm_together(self):
+        await self.async_client.aforce_login(self.test_user)
+        url = reverse("answer_user_input")
+        llm_latency = 0.5
+        number_of_requests = 20
+
+        async def slow_chatbot_response(user_msg):
+            await asyncio.sleep(llm_latency)
+            return MockLLMContent(f"Answer to {user_msg}")
+
+        with patch("chatbot.views.achatbot_response", side_effect=slow_chatbot_response):
+            start = time.perf_counter()
+            responses = await asyncio.gather(*[
+                self.async_client.post(url, data={"user_msg": f"Question {i}"}, content_type="application/json")
+                for i in range(number_of_requests)
+            ])
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual([response.status_code for response in responses], [200] * number_of_requests)
+        self.assertEqual(json.loads(responses[3].content), {"message": "Answer to Question 3"})
+        # Served one after another this would take number_of_requests * llm_latency seconds
+        self.assertLess(elapsed, llm_latency * 4)
+
+
+class AsyncStreamTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.test_user = User.objects.create_user(username='testuser', password='password')
+
+    async def test_answer_stream_sends_each_chunk_as_it_arrives(self):
+        await self.async_client.aforce_login(self.test_user)
+        produced = []
+
+        async def message_chunks():
+            for content in ["Hello", " Human"]:
+                produced.append(content)
+                yield MockLLMContent(content)
+
+        with patch("chatbot.views.astream_chatbot_response", return_value=message_chunks()) as mock_stream:
+            response = await self.async_client.post(reverse("answer_user_input_stream"), data={"user_msg": "Hello"},
+                                                     content_type="application/json")
+
+            received = []
+            async for chunk in response.streaming_content:
+                received.append(chunk)
+                # The next chunk hasn't been asked for yet, so nothing is collected up before it is sent
+                self.assertEqual(len(produced), len(received))
+
+        self.assertTrue(response.is_async)
+        self.assertEqual(received, [b"Hello", b" Human"])
+        mock_stream.assert_called_once_with("Hello")
+
+        draft_chat = await Chat.objects.aget(user=self.test_user, is_draft=True)
+        messages = [message async for message in Message.objects.filter(chat=draft_chat).order_by("order_number")]
+        self.assertEqual([message.message_text for message in messages], ["Hello", "Hello Human"])
+
+
+class EmbeddingCacheTestCase(unittestTestCase):
+
+    def setUp(self):
+        caches[EMBEDDING_CACHE_ALIAS].clear()
+        self.addCleanup(caches[EMBEDDING_CACHE_ALIAS].clear)
+        self.embed_texts = MagicMock(side_effect=lambda texts: [[float(len(text)), 0.25, -1.5] for text in texts])
+
+    def test_repeat_query_skips_embedding_call(self):
+        first = get_cached_embeddings(["What is photosynthesis?"], "model", self.embed_texts)
+        second = get_cached_embeddings(["What is photosynthesis?"], "model", self.embed_texts)
+
+        self.assertEqual(first, [[23.0, 0.25, -1.5]])
+        self.assertEqual(first, second)
+        self.embed_texts.assert_called_once_with(["What is photosynthesis?"])
+
+    def test_near_identical_queries_share_key(self):
+        self.assertEqual(get_embedding_cache_key("  What is\nPhotosynthesis? ", "model"),
+                         get_embedding_cache_key("what is photosynthesis?", "model"))
+
+    def test_model_name_is_part_of_key(self):
+        self.assertNotEqual(get_embedding_cache_key("What is photosynthesis?", "model-a"),
+                            get_embedding_cache_key("What is photosynthesis?", "model-b"))
+
+    def test_only_missing_texts_are_embedded(self):
+        get_cached_embeddings(["first"], "model", self.embed_texts)
+
+        output = get_cached_embeddings(["first", "second", "second"], "model", self.embed_texts)
+
+        self.assertEqual(output, [[5.0, 0.25, -1.5], [6.0, 0.25, -1.5], [6.0, 0.25, -1.5]])
+        self.assertEqual(self.embed_texts.call_count, 2)
+        self.embed_texts.assert_called_with(["second"])
+
+    def test_vectors_stored_as_float32_blobs(self):
+        get_cached_embeddings(["first"], "model", self.embed_texts)
+
+        blob = caches[EMBEDDING_CACHE_ALIAS].get(get_embedding_cache_key("first", "model"))
+        self.assertIsInstance(blob, bytes)
+        self.assertEqual(len(blob), 3 * 4)
+
+    def test_cached_embeddings_embed_query(self):
+        base_embeddings = MagicMock()
+        base_embeddings.embed_documents.side_effect = lambda texts: [[1.0, 2.0] for _ in texts]
+        embeddings = CachedEmbeddings(base_embeddings, model="model")
+
+        self.assertEqual(embeddings.embed_query("hello"), [1.0, 2.0])
+        self.assertEqual(embeddings.embed_query("Hello "), [1.0, 2.0])
+        base_embeddings.embed_documents.assert_called_once_with(["hello"])
+
+
+class ClientRegistryTestCase(unittestTestCase):
+
+    def setUp(self):
+        self.registry = ClientRegistry()
+
+    def test_client_is_reused_and_counted(self):
+        factory = MagicMock(side_effect=lambda: object())
+
+        first = self.registry.get("client", factory)
+        second = self.registry.get("client", factory)
+
+        self.assertIs(first, second)
+        factory.assert_called_once()
+        self.assertEqual(self.registry.stats(), {"client": {"hits": 1, "misses": 1}})
+
+    def test_concurrent_first_use_builds_one_client(self):
+        calls = []
+
+        def factory():
+            calls.append(1)
+            time.sleep(0.05)
+            return object()
+
+        barrier = threading.Barrier(8)
+        clients = []
+
+        def get_client():
+            barrier.wait()
+            clients.append(self.registry.get("client", factory))
+
+        threads = [threading.Thread(target=get_client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len({id(client) for client in clients}), 1)
+        self.assertEqual(self.registry.stats()["client"], {"hits": 7, "misses": 1})
+
+    def test_loop_bound_clients_are_kept_per_event_loop(self):
+
+        async def get_twice():
+            return (self.registry.get("client", object, loop_bound=True),
+                    self.registry.get("client", object, loop_bound=True))
+
+        first_loop = asyncio.run(get_twice())
+        second_loop = asyncio.run(get_twice())
+        outside_loop = self.registry.get("client", object, loop_bound=True)
+
+        self.assertIs(first_loop[0], first_loop[1])
+        self.assertIsNot(first_loop[0], second_loop[0])
+        self.assertIsNot(outside_loop, first_loop[0])
+        self.assertIsNot(outside_loop, second_loop[0])
+
+    def test_unbound_clients_are_shared_with_event_loops(self):
+        outside_loop = self.registry.get("client", object)
+
+        async def get_client():
+            return self.registry.get("client", object)
+
+        self.assertIs(asyncio.run(get_client()), outside_loop)
+
+    def test_forked_process_builds_its_own_clients(self):
+        parent_client = self.registry.get("client", object)
+
+        with patch("MCQ_Generator.llm_clients.os.getpid", return_value=-1):
+            child_client = self.registry.get("client", object)
+
+        self.assertIsNot(parent_client, child_client)
+
+    def test_chat_model_uses_pooled_http_client(self):
+        with patch("MCQ_Generator.llm_clients.llm_clients", self.registry):
+            model = get_chat_model()
+
+            self.assertIs(get_chat_model(), model)
+            self.assertIs(model.http_client, get_http_client())
+            self.assertEqual(model.model_name, "gpt-4o-mini")
+
+        self.assertEqual(self.registry.stats()["chat_model:gpt-4o-mini"], {"hits": 1, "misses": 1})
+
+    def test_async_http_client_is_not_capped_by_sync_pool(self):
+        latency = 0.3
+        number_of_requests = settings.LLM_HTTP_MAX_CONNECTIONS * 3
+
+        async def handle(reader, writer):
+            await reader.readuntil(b"\r\n\r\n")
+            await asyncio.sleep(latency)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok")
+            await writer.drain()
+            writer.close()
+
+        async def send_requests():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+            client = get_async_http_client()
+
+            start = time.perf_counter()
+            responses = await asyncio.gather(*[client.get(url) for _ in range(number_of_requests)])
+            elapsed = time.perf_counter() - start
+
+            await client.aclose()
+            server.close()
+            await server.wait_closed()
+            return responses, elapsed
+
+        with patch("MCQ_Generator.llm_clients.llm_clients", self.registry):
+            responses, elapsed = asyncio.run(send_requests())
+
+        self.assertEqual([response.status_code for response in responses], [200] * number_of_requests)
+        # Capped at the sync pool's size these would go out in three waves
+        self.assertLess(elapsed, latency * 2)
+
+
+class SemanticAnswerCacheTestCase(unittestTestCase):
+
+    def setUp(self):
+        self.cache = SemanticAnswerCache(max_size=2, threshold=0.95)
+
+    def test_near_duplicate_question_hits(self):
+        self.cache.set([1.0, 0.0, 0.0], "cached answer", "1")
+
+        self.assertEqual(self.cache.get([0.99, 0.05, 0.0], "1"), "cached answer")
+        self.assertEqual(self.cache.get([2.0, 0.0, 0.0], "1"), "cached answer")
+        self.assertIsNone(self.cache.get([0.0, 1.0, 0.0], "1"))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_least_recently_used_answer_is_evicted(self):
+        self.cache.set([1.0, 0.0, 0.0], "first", "1")
+        self.cache.set([0.0, 1.0, 0.0], "second", "1")
+        self.cache.get([1.0, 0.0, 0.0], "1")
+
+        self.cache.set([0.0, 0.0, 1.0], "third", "1")
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get([1.0, 0.0, 0.0], "1"), "first")
+        self.assertIsNone(self.cache.get([0.0, 1.0, 0.0], "1"))
+        self.assertEqual(self.cache.get([0.0, 0.0, 1.0], "1"), "third")
+
+    def test_new_corpus_version_drops_answers(self):
+        self.cache.set([1.0, 0.0, 0.0], "old answer", "1")
+
+        self.assertIsNone(self.cache.get([1.0, 0.0, 0.0], "2"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_zero_size_disables_cache(self):
+        cache = SemanticAnswerCache(max_size=0, threshold=0.95)
+        cache.set([1.0, 0.0], "answer", "1")
+
+        self.assertIsNone(cache.get([1.0, 0.0], "1"))
+
+
+class ChatbotResponseSemanticCacheTestCase(unittestTestCase):
+
+    def setUp(self):
+        question_embeddings = {"What is LYL?": [1.0, 0.0], "what is lyl": [0.99, 0.02], "Who wrote it?": [0.0, 1.0]}
+
+        self.chain = MagicMock()
+        self.chain.invoke.side_effect = lambda inputs: AIMessage(content=f"answer to {inputs['question']}")
+        self.retriever = MagicMock()
+        self.retriever.invoke.return_value = []
+
+        patches = [
+            patch("chatbot.helpers.semantic_answer_cache", SemanticAnswerCache(max_size=10, threshold=0.95)),
+            patch("chatbot.helpers.get_question_embedding", side_effect=question_embeddings.get),
+            patch("chatbot.helpers.get_chatbot_chain", return_value=self.chain),
+            patch("chatbot.helpers.get_chatbot_retriever", return_value=self.retriever),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_near_duplicate_question_skips_retrieval_and_llm(self):
+        first = chatbot_response("What is LYL?")
+        second = chatbot_response("what is lyl")
+        other = chatbot_response("Who wrote it?")
+
+        self.assertEqual(first.content, "answer to What is LYL?")
+        self.assertEqual(second.content, "answer to What is LYL?")
+        self.assertEqual(other.content, "answer to Who wrote it?")
+        self.assertEqual(self.chain.invoke.call_count, 2)
+        self.assertEqual(self.retriever.invoke.call_count, 2)
+
+    def test_streamed_answer_is_cached_once_finished(self):
+        self.chain.stream.return_value = iter([AIMessageChunk(content="streamed"), AIMessageChunk(content=" answer")])
+
+        message_chunks = stream_chatbot_response("What is LYL?")
+        self.assertEqual("".join(chunk.content for chunk in message_chunks), "streamed answer")
+
+        cached_chunks = list(stream_chatbot_response("what is lyl"))
+        self.assertEqual([chunk.content for chunk in cached_chunks], ["streamed answer"])
+        self.assertEqual(chatbot_response("What is LYL?").content, "streamed answer")
+        self.chain.stream.assert_called_once()
+        self.chain.invoke.assert_not_called()
+
+    def test_async_response_uses_cache(self):
+        chatbot_response("What is LYL?")
+
+        output = asyncio.run(achatbot_response("what is lyl"))
+
+        self.assertEqual(output.content, "answer to What is LYL?")
+        self.chain.ainvoke.assert_not_called()
+
+    def test_async_streamed_answer_is_cached_once_finished(self):
+        async def astream(inputs):
+            for content in ["streamed", " answer"]:
+                yield AIMessageChunk(content=content)
+
+        self.retriever.ainvoke = AsyncMock(return_value=[])
+        self.chain.astream.side_effect = astream
+
+        async def collect(user_msg):
+            return [chunk.content async for chunk in await astream_chatbot_response(user_msg)]
+
+        self.assertEqual(asyncio.run(collect("What is LYL?")), ["streamed", " answer"])
+        self.assertEqual(asyncio.run(collect("what is lyl")), ["streamed answer"])
+        self.chain.astream.assert_called_once()
+
+    def test_new_corpus_version_misses(self):
+        chatbot_response("What is LYL?")
+
+        with override_settings(LYL_CORPUS_VERSION="2"):
+            chatbot_response("What is LYL?")
+
+        self.assertEqual(self.chain.invoke.call_count, 2)
@@ -8,6 +8,7 @@ urlpatterns = [
     path('<int:pk>', views.get_chat_data, name='chat_detail'),
     path("new_chat", views.chatbot_new_chat, name="new_chat"),
     path("answer_user", views.answer_user_input, name="answer_user_input"),
+    path("answer_user_stream", views.answer_user_input_stream, name="answer_user_input_stream"),
     path("save_chat", views.save_chat, name="save_chat"),
     path('delete/<int:pk>', views.ChatDeleteView.as_view(), name='delete_chat')
 ]
\ No newline at end of file
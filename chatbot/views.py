@@ -1,10 +1,12 @@
 import logging
 import json
 
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.shortcuts import redirect, render, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import transaction
 from django.http import JsonResponse, Http404
 from django.views.generic.list import ListView
 from django.views.generic.edit import DeleteView
@@ -12,13 +14,19 @@ from django.http import HttpResponseForbidden
 from django.urls import reverse_lazy
 
 
-from chatbot.helpers import chatbot_response
+from MCQ_Generator.chat_history import adelete_stale_drafts, append_chat_turns, aappend_chat_turns, delete_stale_drafts
+from MCQ_Generator.streaming import is_asgi_request, streaming_llm_response
+from chatbot.helpers import achatbot_response, astream_chatbot_response, stream_chatbot_response
 from chatbot.models import Chat, Message
 from chatbot.forms import ChatTitleForm
 
 
 logger = logging.getLogger("django_mcq")
 
+CHATBOT_ERROR_MESSAGE = "Problem with chatbot response please contact the System Administrator"
+
+DRAFT_CHAT_SESSION_KEY = "draft_chat_id"
+
 
 class ChatListView(LoginRequiredMixin, ListView):
     model = Chat
@@ -28,54 +36,121 @@ class ChatListView(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         # Filter quizzes by the current logged-in user
-        return Chat.objects.filter(user=self.request.user)
+        return Chat.objects.filter(user=self.request.user, is_draft=False)
 
 
 @login_required
 def chatbot_new_chat(request):
-    request.session['lyl_messages'] = []
-    request.session['number_chats'] = 1
+    # An unsaved conversation is thrown away when the user starts a new one
+    draft_chat_id = request.session.pop(DRAFT_CHAT_SESSION_KEY, None)
+    Chat.objects.filter(pk=draft_chat_id, user=request.user, is_draft=True).delete()
     return render(request=request, template_name='chatbot/chatbot.html', context={'form': ChatTitleForm()})
 
 
+@transaction.non_atomic_requests
 @login_required(login_url='login')
-def answer_user_input(request):
+async def answer_user_input(request):
 
     post_data = json.loads(request.body.decode("utf-8"))
 
+    user_message = post_data['user_msg']
+
     try:
-        chat_number = request.session["number_chats"]
-    except KeyError:
-        chat_number = 1
-    else:
-        chat_number = int(chat_number)
+        chatbot_res = await achatbot_response(user_message)
+    except Exception as e:
+        logger.error(e)
+        return JsonResponse({"message": CHATBOT_ERROR_MESSAGE})
+
+    chatbot_res_content = chatbot_res.content
+
+    draft_chat = await aget_draft_chat(request.session, await request.auser())
+    await arecord_chat_message(draft_chat, user_message, chatbot_res_content)
+
+    return JsonResponse({"message": chatbot_res_content})
 
 
+@transaction.non_atomic_requests
+@login_required(login_url='login')
+async def answer_user_input_stream(request):
+
+    post_data = json.loads(request.body.decode("utf-8"))
+
     user_message = post_data['user_msg']
 
+    if not is_asgi_request(request):
+        return await sync_to_async(stream_answer_sync)(request, user_message)
+
     try:
-        chatbot_res = chatbot_response(user_message)
+        message_chunks = await astream_chatbot_response(user_message)
     except Exception as e:
         logger.error(e)
-        return JsonResponse({"message": "Problem with chatbot response please contact the System Administrator"})
+        return JsonResponse({"message": CHATBOT_ERROR_MESSAGE})
 
-    chatbot_res_content = chatbot_res.content
+    user = await request.auser()
 
-    message_dict = {f"user_msg": user_message, f"llm_msg": chatbot_res_content, "chat_number": chat_number}
+    async def on_complete(chatbot_res_content):
+        draft_chat = await aget_draft_chat(request.session, user)
+        await arecord_chat_message(draft_chat, user_message, chatbot_res_content)
+        # The session middleware has already run by the time the stream finishes so save it here
+        await request.session.asave()
 
-    chat_messages = request.session.get("lyl_messages", [])
-    chat_messages.append(message_dict)
-    request.session["lyl_messages"] = chat_messages  # Save back to the session
+    return streaming_llm_response(message_chunks, on_complete, CHATBOT_ERROR_MESSAGE)
 
-    new_chat_number = chat_number + 1
-    request.session["number_chats"] = new_chat_number
 
-    logger.debug("This is session at end of logic")
+def stream_answer_sync(request, user_message):
+    """The WSGI version of answer_user_input_stream, WSGI servers only send sync iterators as they go."""
 
-    logger.debug(request.session["lyl_messages"])
-    logger.debug(request.session["number_chats"])
+    try:
+        message_chunks = stream_chatbot_response(user_message)
+    except Exception as e:
+        logger.error(e)
+        return JsonResponse({"message": CHATBOT_ERROR_MESSAGE})
+
+    def on_complete(chatbot_res_content):
+        draft_chat = get_draft_chat(request.session, request.user)
+        record_chat_message(draft_chat, user_message, chatbot_res_content)
+        request.session.save()
+
+    return streaming_llm_response(message_chunks, on_complete, CHATBOT_ERROR_MESSAGE)
+
+
+def get_draft_chat(session, user):
+    """
+    Returns the draft chat for this session, creating it on the first message. Only the draft's id is kept in the
+    session, the transcript itself is appended to the Message table one turn at a time.
+    """
+
+    draft_chat = Chat.objects.filter(pk=session.get(DRAFT_CHAT_SESSION_KEY), user=user, is_draft=True).first()
+
+    if draft_chat is None:
+        # Starting a draft is rare enough to also clear out the ones left behind by expired sessions
+        delete_stale_drafts(Chat)
+        draft_chat = Chat.objects.create(user=user, is_draft=True)
+        session[DRAFT_CHAT_SESSION_KEY] = draft_chat.pk
+
+    return draft_chat
+
+
+async def aget_draft_chat(session, user):
+
+    draft_chat = await Chat.objects.filter(pk=await session.aget(DRAFT_CHAT_SESSION_KEY), user=user,
+                                           is_draft=True).afirst()
+
+    if draft_chat is None:
+        await adelete_stale_drafts(Chat)
+        draft_chat = await Chat.objects.acreate(user=user, is_draft=True)
+        await session.aset(DRAFT_CHAT_SESSION_KEY, draft_chat.pk)
+
+    return draft_chat
+
+
+def record_chat_message(chat, user_message, llm_message):
+    append_chat_turns(Message, chat, [(user_message, llm_message)])
+
+
+async def arecord_chat_message(chat, user_message, llm_message):
+    await aappend_chat_turns(Message, chat, [(user_message, llm_message)])
 
-    return JsonResponse({"message": chatbot_res_content})
 
 @login_required(login_url='login')
 def save_chat(request):
@@ -83,8 +158,6 @@ def save_chat(request):
         return HttpResponseForbidden('DONT HIT THIS')
 
     logger.debug(request.POST['name_title'])
-    logger.debug(request.session["lyl_messages"])
-    logger.debug(request.session["number_chats"])
 
     submitted_form = ChatTitleForm(request.POST)
 
@@ -93,45 +166,22 @@ def save_chat(request):
         messages.error(request, 'Please fix chat name')
         return JsonResponse({"error": "Please fix chat name"}, status=400)
 
-    new_chat = Chat()
-    new_chat.user = request.user
-    new_chat.title = submitted_form.cleaned_data['name_title']
+    title = submitted_form.cleaned_data['name_title']
+    draft_chat_id = request.session.get(DRAFT_CHAT_SESSION_KEY)
 
     try:
-        new_chat.save()
+        with transaction.atomic():
+            # The messages are already stored against the draft so saving just names it
+            saved = Chat.objects.filter(pk=draft_chat_id, user=request.user, is_draft=True).update(
+                title=title, is_draft=False)
+            if not saved:
+                Chat.objects.create(user=request.user, title=title)
     except Exception as e:
         logger.error(e)
         messages.error(request, f"An error occurred: {str(e)}")
         return JsonResponse({"error": "Error when saving chat"}, status=500)
 
-    for message in request.session["lyl_messages"]:
-
-        user_chat_number = message["chat_number"] * 2 - 1
-        llm_chat_number = message["chat_number"] * 2
-
-        new_user_message = Message()
-        new_llm_message = Message()
-
-        new_user_message.chat = new_chat
-        new_llm_message.chat = new_chat
-
-        new_user_message.message_text = message['user_msg']
-        new_user_message.order_number = user_chat_number
-        new_user_message.llm_response = False
-
-        new_llm_message.message_text = message['llm_msg']
-        new_llm_message.order_number = llm_chat_number
-        new_llm_message.llm_response = True
-
-        try:
-            # Unable to test as unsure how I will hit this in a unit test
-            new_user_message.save()
-            new_llm_message.save()
-
-        except Exception as e:
-            logger.error(e)
-            messages.error(request, f"An error occurred: {str(e)}")
-            return JsonResponse({"error": "Error when saving Messaged"}, status=500)
+    request.session.pop(DRAFT_CHAT_SESSION_KEY, None)
 
     messages.success(request, "Data saved successfully!")
     return redirect("chat_index")
@@ -142,7 +192,7 @@ def get_chat_data(request, pk):
     logger.debug("testing output")
     logger.debug(pk)
     # Get the quiz by pk or return 404 if not found
-    chat = get_object_or_404(Chat, pk=pk, user=request.user)
+    chat = get_object_or_404(Chat, pk=pk, user=request.user, is_draft=False)
 
     # # Check if the logged-in user is associated with the quiz
     # if quiz.user != request.user:
@@ -175,7 +225,7 @@ class ChatDeleteView(LoginRequiredMixin, DeleteView):
         """
         Limit the queryset to quizzes owned by the logged-in user.
         """
-        return Chat.objects.filter(user=self.request.user)
+        return Chat.objects.filter(user=self.request.user, is_draft=False)
     def handle_no_permission(self):
         """
         Handle unauthorized access attempts.
@@ -6,16 +6,16 @@ from django.db.models import Count
 
 
 class LibChatAdmin(admin.ModelAdmin):
-    list_display = ('title', 'user')
-    list_filter = ('user',)
+    list_display = ('title', 'user', 'is_draft')
+    list_filter = ('user', 'is_draft')
     search_fields = ('title', 'user__username')
 
     change_list_template = "admin/libchat_changelist.html"
 
     def changelist_view(self, request, extra_context=None):
-        total_libchats = LibChat.objects.count()
+        total_libchats = LibChat.objects.filter(is_draft=False).count()
         libchats_per_user = (
-                LibChat.objects.values('user__username')
+                LibChat.objects.filter(is_draft=False).values('user__username')
             .annotate(count=Count('id'))
             .order_by('-count')
         )
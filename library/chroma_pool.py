@@ -0,0 +1,95 @@
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import chromadb
+import chromadb.utils.embedding_functions as embedding_functions
+from chromadb.errors import InvalidCollectionException
+from django.conf import settings
+
+logger = logging.getLogger("django_mcq")
+
+LIBRARY_EMBEDDING_MODEL = "text-embedding-3-large"
+
+
+@lru_cache(maxsize=1)
+def get_chroma_client():
+    """Returns the process wide chroma client so the on disk store is only opened once."""
+    return chromadb.PersistentClient(path=str(settings.CHROMA_DB_PATH))
+
+
+@lru_cache(maxsize=1)
+def get_embedding_function():
+    return embedding_functions.OpenAIEmbeddingFunction(
+        api_key=settings.OPEN_API_KEY,
+        model_name=LIBRARY_EMBEDDING_MODEL
+    )
+
+
+class CollectionPool:
+    """Bounded LRU of per-user chroma collection handles, safe to share between threads."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._collections = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, unique_user: str):
+        with self._lock:
+            collection = self._collections.get(unique_user)
+            if collection is not None:
+                self._collections.move_to_end(unique_user)
+                return collection
+
+        # Opening the collection can be slow so do it outside the lock, if two threads race the first one wins
+        collection = get_chroma_client().get_or_create_collection(
+            name=unique_user, embedding_function=get_embedding_function())
+
+        with self._lock:
+            collection = self._collections.setdefault(unique_user, collection)
+            self._collections.move_to_end(unique_user)
+            while len(self._collections) > self.max_size:
+                evicted_user, _ = self._collections.popitem(last=False)
+                logger.debug(f"Evicted chroma collection {evicted_user} from pool")
+
+        return collection
+
+    def forget(self, unique_user: str):
+        with self._lock:
+            self._collections.pop(unique_user, None)
+
+    def delete(self, unique_user: str):
+        self.forget(unique_user)
+        get_chroma_client().delete_collection(name=unique_user)
+
+    def clear(self):
+        with self._lock:
+            self._collections.clear()
+
+    def __len__(self):
+        return len(self._collections)
+
+    def __contains__(self, unique_user):
+        return unique_user in self._collections
+
+
+collection_pool = CollectionPool(max_size=settings.LIBRARY_COLLECTION_POOL_SIZE)
+
+
+def get_user_collection(unique_user: str):
+    return collection_pool.get(unique_user)
+
+
+def run_on_user_collection(unique_user: str, operation):
+    """
+    Runs operation(collection) against the pooled collection for unique_user. The collection may have been deleted
+    and recreated by another process since it was pooled, in that case the stale handle is dropped and the
+    operation is retried once with a fresh one.
+    """
+    try:
+        return operation(get_user_collection(unique_user))
+    except InvalidCollectionException:
+        logger.info(f"Pooled chroma collection {unique_user} is stale, reopening")
+        collection_pool.forget(unique_user)
+        return operation(get_user_collection(unique_user))
@@ -1,13 +1,14 @@
-import os
 import logging
+from asgiref.sync import sync_to_async
 from django.conf import settings
 
-import chromadb
-import chromadb.utils.embedding_functions as embedding_functions
-from langchain_openai import ChatOpenAI
-
 from langchain_core.prompts import PromptTemplate
 
+from MCQ_Generator.embedding_cache import get_cached_embeddings
+from MCQ_Generator.llm_clients import get_chat_model
+from library.chroma_pool import LIBRARY_EMBEDDING_MODEL, get_embedding_function, run_on_user_collection
+from library.utils import pack_retrieved_context
+
 
 logger = logging.getLogger("django_mcq")
 
@@ -36,18 +37,15 @@ Instructions:
 """
 
 
-def answer_user_message_library(user_message, unique_user, filter_docs):
-    chroma_path = os.path.join(settings.BASE_DIR, "chroma_db_storage")
-    chroma_client = chromadb.PersistentClient(path=chroma_path)
-    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=settings.OPEN_API_KEY,
-        model_name="text-embedding-3-large"
-    )
-    collection = chroma_client.get_or_create_collection(name=unique_user, embedding_function=openai_ef)
+def retrieve_library_context(user_message, unique_user, filter_docs):
+
+    query_embeddings = get_cached_embeddings([user_message], LIBRARY_EMBEDDING_MODEL,
+                                             lambda texts: get_embedding_function()(input=texts))
 
     query_params = {
-        "query_texts": [user_message],
-        "n_results": 3
+        "query_embeddings": query_embeddings,
+        "n_results": settings.LIBRARY_CHAT_N_RESULTS,
+        "include": ["documents", "metadatas", "distances"],
     }
 
 
@@ -57,15 +55,14 @@ def answer_user_message_library(user_message, unique_user, filter_docs):
             "source": {"$in": filter_docs}
         }
 
-    results = collection.query(**query_params)
+    results = run_on_user_collection(unique_user, lambda collection: collection.query(**query_params))
+
+    return pack_retrieved_context(results, max_tokens=settings.LIBRARY_CHAT_CONTEXT_TOKENS)
 
-    page_content_str = ""
 
-    for document in results["documents"]:
-        for doc in document:
-            page_content_str += doc
+def get_library_chain():
 
-    model = ChatOpenAI(model="gpt-4o-mini", api_key=settings.OPEN_API_KEY)
+    model = get_chat_model()
 
     prompt = PromptTemplate(
         template=library_chat_prompt,
@@ -75,11 +72,51 @@ def answer_user_message_library(user_message, unique_user, filter_docs):
     # And a query intended to prompt a language model to populate the data structure.
     chain = prompt | model
 
-    output = chain.invoke({"retrieved_context": page_content_str, "user_query": user_message})
+    return chain
+
+
+def build_library_chain(user_message, unique_user, filter_docs):
+    """Retrieves the context for user_message and returns the chain with the inputs to run it on."""
+
+    page_content_str = retrieve_library_context(user_message, unique_user, filter_docs)
+
+    return get_library_chain(), {"retrieved_context": page_content_str, "user_query": user_message}
+
+
+def answer_user_message_library(user_message, unique_user, filter_docs):
+    chain, chain_inputs = build_library_chain(user_message, unique_user, filter_docs)
+
+    output = chain.invoke(chain_inputs)
 
     return output
 
 
+def stream_user_message_library(user_message, unique_user, filter_docs):
+    """
+    Retrieval runs straight away so its errors are raised here, the returned iterator yields the model's message
+    chunks as they are generated.
+    """
+    chain, chain_inputs = build_library_chain(user_message, unique_user, filter_docs)
+
+    return chain.stream(chain_inputs)
+
+
+async def astream_user_message_library(user_message, unique_user, filter_docs):
+    """Async version of stream_user_message_library, the returned async iterator streams from chain.astream."""
 
+    page_content_str = await sync_to_async(retrieve_library_context, thread_sensitive=False)(
+        user_message, unique_user, filter_docs)
 
+    return get_library_chain().astream({"retrieved_context": page_content_str, "user_query": user_message})
 
+
+async def aanswer_user_message_library(user_message, unique_user, filter_docs):
+    """Async version of answer_user_message_library so a waiting request doesn't hold a worker thread."""
+
+    # chroma only has a blocking client so retrieval runs on a worker thread
+    page_content_str = await sync_to_async(retrieve_library_context, thread_sensitive=False)(
+        user_message, unique_user, filter_docs)
+
+    output = await get_library_chain().ainvoke({"retrieved_context": page_content_str, "user_query": user_message})
+
+    return output
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-17 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0003_alter_libdocumentembeddings_end_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='libdocumentembeddings',
+            name='last_chunk_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='libdocumentembeddings',
+            name='last_page',
+            field=models.IntegerField(null=True),
+        ),
+    ]
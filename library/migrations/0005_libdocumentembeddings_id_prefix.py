@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-17 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0004_libdocumentembeddings_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='libdocumentembeddings',
+            name='id_prefix',
+            field=models.CharField(default='id', max_length=32),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-17 12:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0005_libdocumentembeddings_id_prefix'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='libchat',
+            name='is_draft',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='libchat',
+            name='title',
+            field=models.CharField(blank=True, max_length=128, null=True),
+        ),
+    ]
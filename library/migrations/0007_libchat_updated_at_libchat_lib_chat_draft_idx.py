@@ -0,0 +1,24 @@
+# Generated by Django 5.1.2 on 2026-10-17 13:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0006_libchat_is_draft_alter_libchat_title'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='libchat',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='libchat',
+            index=models.Index(fields=['is_draft', 'updated_at'], name='lib_chat_draft_idx'),
+        ),
+    ]
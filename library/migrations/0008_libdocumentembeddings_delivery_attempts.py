@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-17 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0007_libchat_updated_at_libchat_lib_chat_draft_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='libdocumentembeddings',
+            name='delivery_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
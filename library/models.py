@@ -14,13 +14,20 @@ def user_directory_path(instance, filename):
     return 'user_{0}/{1}'.format(instance.user.id, filename)
 
 class LibChat(models.Model):
-    title = models.CharField(max_length=128)
+    # Drafts have no title until the user saves them, postgres lets the unique constraint hold any number of nulls
+    title = models.CharField(max_length=128, null=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    is_draft = models.BooleanField(default=False)
+    # Bumped on every new turn so abandoned drafts can be told apart from ones still being written
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['user', 'title'], name='unique_lib_chat_title_per_user')
         ]
+        indexes = [
+            models.Index(fields=['is_draft', 'updated_at'], name='lib_chat_draft_idx')
+        ]
 
 
 class LibMessage(models.Model):
@@ -43,5 +50,12 @@ class LibDocumentEmbeddings(models.Model):
     document = models.ForeignKey(LibDocuments, on_delete=models.CASCADE)
     start_id = models.IntegerField()
     end_id = models.IntegerField(null=True)
+    # Chunk ids are f"{id_prefix}{n}", documents uploaded before per-document prefixes share the plain "id" prefix
+    id_prefix = models.CharField(max_length=32, default="id")
+    # Ingestion checkpoint, the last page whose chunks are all in chroma and the last chunk id of that page
+    last_page = models.IntegerField(null=True)
+    last_chunk_id = models.IntegerField(null=True)
+    # Counts every delivery of the ingestion task, including redeliveries after its worker died
+    delivery_attempts = models.PositiveSmallIntegerField(default=0)
 
 
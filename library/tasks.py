@@ -1,25 +1,29 @@
 from celery import shared_task
 
-import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from typing import Optional
 from django.conf import settings
-from django.db import transaction
-
-import chromadb
-import chromadb.utils.embedding_functions as embedding_functions
+from django.db.models import F
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from langchain_community.document_loaders import PyPDFLoader
-
-from library.utils import get_final_id, get_lists_for_chroma_upsert, get_list_of_ids_for_chroma_deletion
+from MCQ_Generator.document_extraction import iter_pdf_pages
+from library.chroma_pool import collection_pool, get_embedding_function, run_on_user_collection
+from library.utils import (LIBRARY_CHUNK_OVERLAP, LIBRARY_CHUNK_SIZE, batch_chunks_by_tokens, get_final_id,
+                           get_lists_for_chroma_upsert, get_list_of_ids_for_chroma_deletion)
 
 logger = logging.getLogger("django_mcq")
 
 
-@shared_task
-def upload_document_to_library(file_path, unique_user, new_id, document_pk):
+class DocumentHasNoTextError(Exception):
+    """The PDF has no extractable text, retrying can't change that."""
+
+
+# Acked only once it finishes so a task lost with its worker is redelivered and resumes from the checkpoint
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def upload_document_to_library(self, file_path, unique_user, new_id, document_pk):
 
     from library import models
 
@@ -29,117 +33,181 @@ def upload_document_to_library(file_path, unique_user, new_id, document_pk):
         document_embeddings = models.LibDocumentEmbeddings.objects.get(document=document)
 
     except (models.LibDocuments.DoesNotExist, models.LibDocumentEmbeddings.DoesNotExist):
+        # Deleted while this upload was queued or running, whatever it stored before then has to go as well
+        delete_document_vectors(unique_user=unique_user, document_id=document_pk)
         raise Exception("Document not found.")
 
-    try:
-        need_delete = False
-        with transaction.atomic():
+    # A redelivery of a task whose worker died after it finished but before it was acked
+    if document.status == "completed":
+        return "Success"
 
-            document.status = "processing"
-            document.save()
+    # Redeliveries don't count as celery retries, so a document that kills its worker would otherwise be retried
+    # forever. The counter is committed before any work so it survives the crash
+    models.LibDocumentEmbeddings.objects.filter(pk=document_embeddings.pk).update(
+        delivery_attempts=F("delivery_attempts") + 1)
+    document_embeddings.refresh_from_db(fields=["delivery_attempts"])
+
+    if document_embeddings.delivery_attempts > settings.LIBRARY_INGEST_MAX_RETRIES + 1:
+        logger.error(f"Giving up on document {document_pk} after {document_embeddings.delivery_attempts - 1} "
+                     f"deliveries")
+        fail_document_upload(document, document_embeddings, unique_user=unique_user, new_id=new_id)
+        raise Exception("Document could not be ingested.")
+
+    # Resume after the last checkpointed page, chunk ids are deterministic so the remaining pages get the same ids
+    # they would have had on the first attempt
+    if document_embeddings.last_page is not None:
+        start_page = document_embeddings.last_page + 1
+        next_id = document_embeddings.last_chunk_id + 1
+        logger.info(f"Resuming document {document_pk} from page {start_page}")
+    else:
+        start_page = 0
+        next_id = new_id
 
-            chroma_path = os.path.join(settings.BASE_DIR, "chroma_db_storage")
-            chroma_client = chromadb.PersistentClient(path=chroma_path)
+    try:
+        document.status = "processing"
+        document.save()
 
-            openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-                api_key=settings.OPEN_API_KEY,
-                model_name="text-embedding-3-large"
-            )
+        # text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=20)
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=LIBRARY_CHUNK_SIZE,  # Maximum number of characters in each chunk
+            chunk_overlap=LIBRARY_CHUNK_OVERLAP,  # Number of characters to overlap between chunks
+            length_function=len,  # Use standard Python len() function to measure chunk size
+            separators=["\n\n", "\n", " ", ""]  # Progressively try these separators
+        )
 
+        found_text = document_embeddings.last_chunk_id is not None
+        pages = iter_pdf_pages(file_path, start_page=start_page)
+        embedding_function = get_embedding_function()
+        executor = ThreadPoolExecutor(max_workers=settings.LIBRARY_EMBEDDING_MAX_CONCURRENCY)
 
-            collection = chroma_client.get_or_create_collection(name=unique_user, embedding_function=openai_ef)
+        try:
+            # Only one batch of pages is held at a time and it is checkpointed before the next is extracted
+            while page_batch := list(islice(pages, settings.LIBRARY_INGEST_PAGES_PER_BATCH)):
+                chunks = []
+                # (page_number, id of the last chunk on that page) in page order, used to checkpoint after each batch
+                page_ends = []
 
-            loader = PyPDFLoader(file_path)
-            # docs = loader.lazy_load()
-            # text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=20)
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=500,  # Maximum number of characters in each chunk
-                chunk_overlap=20,  # Number of characters to overlap between chunks
-                length_function=len,  # Use standard Python len() function to measure chunk size
-                separators=["\n\n", "\n", " ", ""]  # Progressively try these separators
-            )
+                for page_number, page_content in page_batch:
 
-            last_id = None
-            logger.debug('DOCSSSS')
+                    if not page_content:
+                        continue
 
-            for doc in loader.lazy_load():
+                    page_chunks = text_splitter.split_text(page_content)
 
-                page_content = doc.page_content
+                    id_list, metadata_list = get_lists_for_chroma_upsert(
+                        all_splits=page_chunks, new_id=next_id,
+                        metadata={"source": file_path, "page": page_number, "document_id": document_pk},
+                        id_prefix=document_embeddings.id_prefix)
 
-                if not page_content:
-                    continue
+                    chunks.extend(zip(id_list, page_chunks, metadata_list))
+                    next_id += len(page_chunks)
+                    page_ends.append((page_number, next_id - 1))
 
-                page_chunks = text_splitter.split_text(page_content)
+                found_text = found_text or bool(chunks)
+                store_page_chunks(executor, embedding_function, unique_user, document_embeddings, chunks, page_ends)
+        finally:
+            # Don't keep paying for embeddings of batches that will never be upserted
+            executor.shutdown(wait=True, cancel_futures=True)
 
-                logger.debug(page_chunks)
+        if not found_text:
+            raise DocumentHasNoTextError("No text found in document.")
 
-                if last_id:
-                    new_id = last_id + 1
+        logger.info(run_on_user_collection(unique_user, lambda collection: collection.count()))
 
-                id_list, metadata_list = get_lists_for_chroma_upsert(all_splits=page_chunks, new_id=new_id,
-                                                                     metadata=doc.metadata)
+        document.status = "completed"
+        document_embeddings.end_id = document_embeddings.last_chunk_id
 
-                logger.info(id_list)
-                logger.info(metadata_list)
-                logger.info(page_chunks)
-                #
-                collection.upsert(
-                    ids=id_list,
-                    metadatas=metadata_list,
-                    documents=page_chunks,
-                )
-                last_id = get_final_id(num=id_list[-1])
-                need_delete = True
-            #
-            logger.info(collection.count())
+        document.save()
+        document_embeddings.save()
 
-            logger.info(id_list[-1])
-            final_id = get_final_id(num=id_list[-1])
+    except Exception as e:
+        logger.error(e)
 
-            document.status = "completed"
-            document_embeddings.end_id = final_id
+        if not models.LibDocuments.objects.filter(pk=document_pk).exists():
+            # The document was deleted part way through, saving it now would bring it back
+            delete_document_vectors(unique_user=unique_user, document_id=document_pk)
+            raise Exception("Document not found.")
 
-            document.save()
-            document_embeddings.save()
+        attempts = document_embeddings.delivery_attempts
+        if not isinstance(e, DocumentHasNoTextError) and attempts <= settings.LIBRARY_INGEST_MAX_RETRIES:
+            # Vectors and the checkpoint are kept so the retry carries on where this attempt stopped
+            raise self.retry(exc=e, max_retries=settings.LIBRARY_INGEST_MAX_RETRIES,
+                             countdown=settings.LIBRARY_INGEST_RETRY_DELAY * 2 ** (attempts - 1))
 
-    except Exception as e:
-        logger.error(e)
-        document.status = "error"
-        document.save()
-        document_embeddings.delete()
-        if need_delete:
-            number_of_documents = models.LibDocuments.objects.filter(user=document.user).count()
-            cleanup_failed_document_upload(number_of_documents=number_of_documents,
-                                           new_id=new_id, collection=collection, unique_user=unique_user,
-                                           chroma_client=chroma_client, last_id=last_id)
+        fail_document_upload(document, document_embeddings, unique_user=unique_user, new_id=new_id)
         raise Exception(e)
 
     else:
         return "Success"
 
 
+def store_page_chunks(executor, embedding_function, unique_user, document_embeddings, chunks: list,
+                      page_ends: list):
+    """Embeds and upserts a batch of pages' chunks, moving the checkpoint on after each upsert."""
+
+    batches = list(batch_chunks_by_tokens(chunks, max_tokens=settings.LIBRARY_EMBEDDING_BATCH_TOKENS,
+                                          max_items=settings.LIBRARY_EMBEDDING_BATCH_SIZE))
+
+    logger.info(f"Embedding {len(chunks)} chunks in {len(batches)} batches")
+
+    # map yields the batches in order so every page before the end of a batch is fully stored
+    embedded_batches = executor.map(lambda batch: embedding_function(input=[chunk[1] for chunk in batch]), batches)
+
+    for batch, embeddings in zip(batches, embedded_batches):
+        run_on_user_collection(unique_user, lambda collection: collection.upsert(
+            ids=[chunk[0] for chunk in batch],
+            embeddings=embeddings,
+            metadatas=[chunk[2] for chunk in batch],
+            documents=[chunk[1] for chunk in batch],
+        ))
+
+        checkpoint_ingested_pages(document_embeddings, page_ends, get_final_id(num=batch[-1][0]))
+
+
+def fail_document_upload(document, document_embeddings, unique_user: str, new_id: int):
+    """Marks the document as failed and removes whatever of it was already stored."""
+
+    from library import models
+
+    document.status = "error"
+    document.save()
+    last_id = document_embeddings.last_chunk_id
+    document_embeddings.delete()
+    if last_id is not None:
+        number_of_documents = models.LibDocuments.objects.filter(user=document.user).count()
+        cleanup_failed_document_upload(number_of_documents=number_of_documents,
+                                       new_id=new_id, unique_user=unique_user, last_id=last_id,
+                                       document_id=document.pk, id_prefix=document_embeddings.id_prefix)
+
+
+def checkpoint_ingested_pages(document_embeddings, page_ends: list, upserted_id: int):
+    """
+    Moves the checkpoint on to the last page whose chunks all have ids up to upserted_id. A batch can end part way
+    through a page, that page is redone on resume and its chunks are upserted again under the same ids.
+    """
+
+    while page_ends and page_ends[0][1] <= upserted_id:
+        document_embeddings.last_page, document_embeddings.last_chunk_id = page_ends.pop(0)
+
+    saved = type(document_embeddings).objects.filter(pk=document_embeddings.pk).update(
+        last_page=document_embeddings.last_page, last_chunk_id=document_embeddings.last_chunk_id)
+
+    if not saved:
+        raise Exception("Document not found.")
+
+
 @shared_task
-def delete_document_from_library(number_of_documents: int, list_of_ids: Optional[list], unique_user: str):
+def delete_document_from_library(number_of_documents: int, unique_user: str, document_id: int,
+                                 start_id: Optional[int] = None, end_id: Optional[int] = None, id_prefix: str = 'id'):
 
     try:
 
-        chroma_path = os.path.join(settings.BASE_DIR, "chroma_db_storage")
-        chroma_client = chromadb.PersistentClient(path=chroma_path)
-
         if number_of_documents == 1:
-            chroma_client.delete_collection(name=unique_user)
+            collection_pool.delete(unique_user)
             return
 
-        openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-            api_key=settings.OPEN_API_KEY,
-            model_name="text-embedding-3-large"
-        )
-
-        collection = chroma_client.get_or_create_collection(name=unique_user, embedding_function=openai_ef)
-
-        collection.delete(
-            ids=list_of_ids
-        )
+        delete_document_vectors(unique_user=unique_user, document_id=document_id, start_id=start_id, end_id=end_id,
+                                id_prefix=id_prefix)
 
     except Exception as e:
         logger.error(e)
@@ -148,23 +216,41 @@ def delete_document_from_library(number_of_documents: int, list_of_ids: Optional
     return "Success Delete"
 
 
-def cleanup_failed_document_upload(number_of_documents: int, new_id: int, collection, unique_user: str, chroma_client,
-                                   last_id: int):
+def delete_document_vectors(unique_user: str, document_id: int, start_id: Optional[int] = None,
+                            end_id: Optional[int] = None, id_prefix: str = 'id'):
+    """
+    Deletes a document's chunks with a metadata filter. Chunks stored before document_id was added to the metadata
+    can only be found by id, if the document's first id is still there its id range is deleted in fixed size batches.
+    """
 
-    if number_of_documents == 1:
-        chroma_client.delete_collection(name=unique_user)
-        return
+    def delete(collection):
+        collection.delete(where={"document_id": document_id})
 
-    try:
-        # end_id = collection.count()
+        if start_id is None or end_id is None:
+            return
 
-        end_id = last_id
+        if not collection.get(ids=[f"{id_prefix}{start_id}"], include=[])["ids"]:
+            return
 
-        list_of_ids = get_list_of_ids_for_chroma_deletion(start_id=new_id, end_id=end_id)
+        for batch_start in range(start_id, end_id + 1, settings.LIBRARY_DELETE_BATCH_SIZE):
+            batch_end = min(batch_start + settings.LIBRARY_DELETE_BATCH_SIZE - 1, end_id)
+            collection.delete(
+                ids=get_list_of_ids_for_chroma_deletion(start_id=batch_start, end_id=batch_end, id_prefix=id_prefix)
+            )
 
-        collection.delete(
-            ids=list_of_ids
-        )
+    run_on_user_collection(unique_user, delete)
+
+
+def cleanup_failed_document_upload(number_of_documents: int, new_id: int, unique_user: str, last_id: int,
+                                   document_id: int, id_prefix: str = 'id'):
+
+    if number_of_documents == 1:
+        collection_pool.delete(unique_user)
+        return
+
+    try:
+        delete_document_vectors(unique_user=unique_user, document_id=document_id, start_id=new_id, end_id=last_id,
+                                id_prefix=id_prefix)
 
     except Exception as e:
         logger.error(e)
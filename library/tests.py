@@ -2,21 +2,56 @@ from io import BytesIO
 import json
 import os
 import shutil
+from datetime import timedelta
+from tempfile import NamedTemporaryFile
 from unittest import TestCase as unittestTestCase
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
 from django.conf import settings
-from django.test import TestCase, Client
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.test import TestCase, Client, override_settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.utils import timezone
 
 from library.models import LibChat, LibMessage, LibDocuments, LibDocumentEmbeddings
 from library.forms import LibDocForm, LibChatTitleForm, SaveLibChatTitleForm
-from library.utils import get_final_id, get_list_of_ids_for_chroma_deletion, get_lists_for_chroma_upsert
+import chromadb
+from chromadb.errors import InvalidCollectionException
+
+from langchain_core.language_models import FakeListChatModel
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from MCQ_Generator.chat_history import append_chat_turns
+from MCQ_Generator.document_extraction import iter_pdf_pages
+from MCQ_Generator.embedding_cache import EMBEDDING_CACHE_ALIAS
+from library.chroma_pool import CollectionPool, get_chroma_client, run_on_user_collection
+from library.helpers import answer_user_message_library, stream_user_message_library
+from library.views import get_draft_lib_chat
+from library.tasks import delete_document_vectors, upload_document_to_library
+from library.utils import (LIBRARY_CHUNK_OVERLAP, LIBRARY_CHUNK_SIZE, batch_chunks_by_tokens, get_document_id_prefix,
+                           pack_retrieved_context, get_final_id, get_list_of_ids_for_chroma_deletion,
+                           get_lists_for_chroma_upsert)
 from chatbot.tests import MockLLMContent
+from quiz.tests import build_test_pdf
 # from chatbot.forms import ChatTitleForm
 
+class MockChromaClient:
+
+    def __init__(self):
+        self.opened = []
+        self.deleted = []
+
+    def get_or_create_collection(self, name, embedding_function):
+        self.opened.append(name)
+        return MagicMock(name=f"collection_{name}")
+
+    def delete_collection(self, name):
+        self.deleted.append(name)
+
+
 class MockLangchainDocument:
 
     def __init__(self, page_content, metadata):
@@ -164,6 +199,23 @@ class LibraryTestCase(TestCase):
         # Client not logged in so will do a redirect
         self.assertEqual(response.status_code, 302)
 
+    def start_draft_lib_chat(self, client, turns):
+        draft_chat = LibChat.objects.create(user=LibraryTestCase.test_user, is_draft=True)
+        for turn in range(1, turns + 1):
+            LibMessage.objects.create(chat=draft_chat, message_text=f"user_msg_{turn}", order_number=turn * 2 - 1,
+                                      llm_response=False)
+            LibMessage.objects.create(chat=draft_chat, message_text=f"llm_msg_{turn}", order_number=turn * 2,
+                                      llm_response=True)
+        session = client.session
+        session['draft_lib_chat_id'] = draft_chat.pk
+        session.save()
+        return draft_chat
+
+    def assert_lib_chat_messages(self, chat, expected_messages):
+        chat_messages = LibMessage.objects.filter(chat=chat).order_by('order_number')
+        self.assertEqual([(m.order_number, m.message_text, m.llm_response) for m in chat_messages],
+                         expected_messages)
+
     def test_new_libchat_get_request_success(self):
 
         url = reverse("new_lib_chat")
@@ -180,8 +232,39 @@ class LibraryTestCase(TestCase):
         self.assertIn("form", response.context)
         self.assertIsInstance(response.context["form"], LibChatTitleForm)
 
-        self.assertEqual(self.authenticated_client.session['library_messages'], [])
-        self.assertEqual(self.authenticated_client.session['number_lib_chats'], 1)
+        self.assertNotIn('draft_lib_chat_id', self.authenticated_client.session)
+
+    def test_new_libchat_discards_unsaved_draft(self):
+        draft_chat = self.start_draft_lib_chat(self.authenticated_client, turns=2)
+
+        response = self.authenticated_client.get(reverse("new_lib_chat"))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertFalse(LibChat.objects.filter(pk=draft_chat.pk).exists())
+        self.assertFalse(LibMessage.objects.filter(chat_id=draft_chat.pk).exists())
+        self.assertNotIn('draft_lib_chat_id', self.authenticated_client.session)
+
+    def test_new_draft_deletes_lib_drafts_left_by_expired_sessions(self):
+        expired = timezone.now() - timedelta(seconds=settings.SESSION_COOKIE_AGE + 60)
+        stale_draft = LibChat.objects.create(user=LibraryTestCase.random_user, is_draft=True)
+        active_draft = LibChat.objects.create(user=LibraryTestCase.random_user, is_draft=True)
+        LibChat.objects.filter(pk__in=[stale_draft.pk, LibraryTestCase.test_chat.pk]).update(updated_at=expired)
+
+        draft_chat = get_draft_lib_chat(SessionStore(), LibraryTestCase.test_user)
+
+        self.assertTrue(draft_chat.is_draft)
+        self.assertFalse(LibChat.objects.filter(pk=stale_draft.pk).exists())
+        self.assertTrue(LibChat.objects.filter(pk=active_draft.pk).exists())
+        self.assertTrue(LibChat.objects.filter(pk=LibraryTestCase.test_chat.pk).exists())
+
+    def test_draft_lib_chats_are_not_listed_or_viewable(self):
+        draft_chat = self.start_draft_lib_chat(self.authenticated_client, turns=1)
+
+        response = self.authenticated_client.get(reverse("library_index"))
+        self.assertEqual(list(response.context['chats']), [LibraryTestCase.test_chat])
+
+        response = self.authenticated_client.get(reverse("lib_chat_detail", args=[draft_chat.pk]))
+        self.assertEqual(response.status_code, 404)
 
     def test_new_libchat_no_documents_for_user(self):
 
@@ -200,7 +283,7 @@ class LibraryTestCase(TestCase):
         response = self.unauthenticated_client.get(url)
         self.assertEqual(response.status_code, 302)
 
-    @patch("library.views.answer_user_message_library")
+    @patch("library.views.aanswer_user_message_library")
     def test_answer_input_lib_success_first_msg(self, mock_chatbot_response):
         url = reverse("answer_user_input_lib")
         user_message = "Hello World"
@@ -214,13 +297,70 @@ class LibraryTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(str(response.content, 'utf-8')), {"message": llm_message})
 
-        message_dict = {f"user_msg": user_message, f"llm_msg": llm_message, "chat_number": 1}
-
-        self.assertEqual(self.authenticated_client.session['number_lib_chats'], 2)
-        self.assertEqual(self.authenticated_client.session['library_messages'], [message_dict])
+        draft_chat = LibChat.objects.get(pk=self.authenticated_client.session['draft_lib_chat_id'])
+        self.assertTrue(draft_chat.is_draft)
+        self.assertIsNone(draft_chat.title)
+        self.assertEqual(draft_chat.user, LibraryTestCase.test_user)
+        self.assert_lib_chat_messages(draft_chat, [(1, user_message, False), (2, llm_message, True)])
         mock_chatbot_response.assert_called_once_with(user_message, unique_user, [])
 
-    @patch("library.views.answer_user_message_library")
+    @patch("library.views.stream_user_message_library")
+    def test_answer_input_lib_stream_success(self, mock_stream_response):
+        url = reverse("answer_user_input_lib_stream")
+        user_message = "Hello World"
+        unique_user = f'user_{LibraryTestCase.test_user.id}'
+        mock_stream_response.return_value = iter([MockLLMContent("Hello"), MockLLMContent(" Human")])
+        file_path = os.path.join(settings.MEDIA_ROOT, LibraryTestCase.document_1.upload_file.name)
+
+        response = self.authenticated_client.post(
+            url, data={"user_msg": user_message, "user_docs": [LibraryTestCase.document_1.pk]},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"Hello Human")
+
+        draft_chat = LibChat.objects.get(pk=self.authenticated_client.session['draft_lib_chat_id'])
+        self.assert_lib_chat_messages(draft_chat, [(1, user_message, False), (2, "Hello Human", True)])
+        mock_stream_response.assert_called_once_with(user_message, unique_user, [file_path])
+
+    async def test_answer_input_lib_stream_sends_each_chunk_as_it_arrives(self):
+        await self.async_client.aforce_login(LibraryTestCase.test_user)
+        unique_user = f'user_{LibraryTestCase.test_user.id}'
+        file_path = os.path.join(settings.MEDIA_ROOT, LibraryTestCase.document_1.upload_file.name)
+        produced = []
+
+        async def message_chunks():
+            for content in ["Hello", " Human"]:
+                produced.append(content)
+                yield MockLLMContent(content)
+
+        with patch("library.views.astream_user_message_library", return_value=message_chunks()) as mock_stream:
+            response = await self.async_client.post(
+                reverse("answer_user_input_lib_stream"),
+                data={"user_msg": "Hello", "user_docs": [LibraryTestCase.document_1.pk]},
+                content_type="application/json")
+
+            received = []
+            async for chunk in response.streaming_content:
+                received.append(chunk)
+                self.assertEqual(len(produced), len(received))
+
+        self.assertEqual(received, [b"Hello", b" Human"])
+        mock_stream.assert_called_once_with("Hello", unique_user, [file_path])
+        draft_chat = await LibChat.objects.aget(user=LibraryTestCase.test_user, is_draft=True)
+        self.assertEqual(await LibMessage.objects.filter(chat=draft_chat).acount(), 2)
+
+    @patch("library.views.stream_user_message_library")
+    def test_answer_input_lib_stream_retrieval_raises_exception(self, mock_stream_response):
+        url = reverse("answer_user_input_lib_stream")
+        mock_stream_response.side_effect = Exception
+
+        response = self.authenticated_client.post(url, data={"user_msg": "Hello", "user_docs": []},
+                                                  content_type="application/json")
+        self.assertEqual(json.loads(str(response.content, 'utf-8')),
+                         {"message": "Problem with chatbot response please contact the System Administrator"})
+        self.assertNotIn('draft_lib_chat_id', self.authenticated_client.session)
+
+    @patch("library.views.aanswer_user_message_library")
     def test_answer_input_lib_success_multiple_msg(self, mock_chatbot_response):
         url = reverse("answer_user_input_lib")
         user_message = "Hello World multiple"
@@ -237,48 +377,38 @@ class LibraryTestCase(TestCase):
             file_path = os.path.join(settings.MEDIA_ROOT, lib_doc.upload_file.name)
             filter_docs.append(file_path)
 
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_lib_chats'] = 4
-        session['library_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_lib_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"user_msg": user_message, "user_docs": user_docs}, content_type="application/json")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(str(response.content, 'utf-8')), {"message": llm_message})
 
-        message_dict = {f"user_msg": user_message, f"llm_msg": llm_message, "chat_number": 4}
-
-        message_session.append(message_dict)
-
-        self.assertEqual(self.authenticated_client.session['number_lib_chats'], 5)
-        self.assertEqual(self.authenticated_client.session['library_messages'], message_session)
+        self.assertEqual(self.authenticated_client.session['draft_lib_chat_id'], draft_chat.pk)
+        self.assert_lib_chat_messages(draft_chat, [
+            (1, "user_msg_1", False), (2, "llm_msg_1", True),
+            (3, "user_msg_2", False), (4, "llm_msg_2", True),
+            (5, "user_msg_3", False), (6, "llm_msg_3", True),
+            (7, user_message, False), (8, llm_message, True),
+        ])
 
         mock_chatbot_response.assert_called_once_with(user_message, unique_user, filter_docs)
 
-    @patch("library.views.answer_user_message_library")
+    @patch("library.views.aanswer_user_message_library")
     def test_answer_input_lib_chatbot_response_raises_exception(self, mock_chatbot_response):
         url = reverse("answer_user_input_lib")
         user_message = "Hello World multiple"
         mock_chatbot_response.side_effect = Exception
         user_docs = []
         unique_user = f'user_{LibraryTestCase.test_user.id}'
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_lib_chats'] = 4
-        session['library_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_lib_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"user_msg": user_message, "user_docs": user_docs}, content_type="application/json")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(str(response.content, 'utf-8')),
                          {"message": "Problem with chatbot response please contact the System Administrator"})
 
+        self.assertEqual(LibMessage.objects.filter(chat=draft_chat).count(), 6)
         mock_chatbot_response.assert_called_once_with(user_message, unique_user, [])
 
-    @patch("library.views.answer_user_message_library")
+    @patch("library.views.aanswer_user_message_library")
     def test_answer_input_lib_unauthorised(self, mock_chatbot_response):
         url = reverse("answer_user_input_lib")
         user_message = "Hello World"
@@ -293,19 +423,19 @@ class LibraryTestCase(TestCase):
     def test_save_lib_chat_success(self):
         url = reverse("save_lib_chat")
         new_chat_title = 'Save Lib Chat Test'
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_lib_chats'] = 4
-        session['library_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_lib_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"name_title": new_chat_title})
         self.assertEqual(response.status_code, 302)
         new_chat_queryset = LibChat.objects.filter(title=new_chat_title, user=LibraryTestCase.test_user)
         self.assertTrue(new_chat_queryset.exists())
         self.assertEqual(new_chat_queryset.count(), 1)
         new_chat_obj = new_chat_queryset.first()
+
+        # Saving names the draft in place rather than copying its messages
+        self.assertEqual(new_chat_obj.pk, draft_chat.pk)
+        self.assertFalse(new_chat_obj.is_draft)
+        self.assertNotIn('draft_lib_chat_id', self.authenticated_client.session)
+
         messages_queryset = LibMessage.objects.filter(chat=new_chat_obj).order_by('order_number')
         self.assertEqual(messages_queryset.count(), 6)
 
@@ -332,32 +462,39 @@ class LibraryTestCase(TestCase):
 
             count += 1
 
+    def test_save_lib_chat_100_turns(self):
+        draft_chat = self.start_draft_lib_chat(self.authenticated_client, turns=0)
+
+        with self.assertNumQueries(3):
+            append_chat_turns(LibMessage, draft_chat, [(f"user_msg_{i}", f"llm_msg_{i}") for i in range(1, 101)])
+
+        response = self.authenticated_client.post(reverse("save_lib_chat"), data={"name_title": "Hundred turns"})
+        self.assertEqual(response.status_code, 302)
+
+        saved_chat = LibChat.objects.get(title="Hundred turns", user=LibraryTestCase.test_user)
+        self.assertEqual(saved_chat.pk, draft_chat.pk)
+        self.assert_lib_chat_messages(saved_chat, [
+            (order_number, f"{'llm' if order_number % 2 == 0 else 'user'}_msg_{(order_number + 1) // 2}",
+             order_number % 2 == 0)
+            for order_number in range(1, 201)
+        ])
+
     def test_save_lib_form_not_valid(self):
         url = reverse("save_lib_chat")
         new_chat_title = 'Save Chat Test dhbbbbbbsnjssssssssssssssss22888888888888888888dbbdbdbdbdbdbbdbdbhddhwkebwefbwedkbfhewfbefbwekfbfhjfbkrwfdkdjkdjdjjdjdjddjd'
 
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_lib_chats'] = 4
-        session['library_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_lib_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"name_title": new_chat_title})
         self.assertEqual(response.status_code, 400)
         self.assertEqual(json.loads(str(response.content, 'utf-8'))['error'], "Please fix chat name")
+        draft_chat.refresh_from_db()
+        self.assertTrue(draft_chat.is_draft)
 
     def test_save_lib_form_error_save_chat(self):
         url = reverse("save_lib_chat")
         new_chat_title = 'test chat'
 
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.authenticated_client.session
-        session['number_lib_chats'] = 4
-        session['library_messages'] = message_session
-        session.save()
+        draft_chat = self.start_draft_lib_chat(self.authenticated_client, turns=3)
         response = self.authenticated_client.post(url, data={"name_title": new_chat_title})
         self.assertEqual(response.status_code, 500)
         self.assertEqual(json.loads(str(response.content, 'utf-8'))['error'], "Error when saving chat")
@@ -365,17 +502,14 @@ class LibraryTestCase(TestCase):
         self.assertTrue(number_chat_queryset.exists())
         self.assertEqual(number_chat_queryset.count(), 1)
 
+        # The draft is kept so the user can pick another name
+        draft_chat.refresh_from_db()
+        self.assertTrue(draft_chat.is_draft)
+
     def test_save_lib_unauthenticated_user(self):
         url = reverse("save_lib_chat")
         new_chat_title = 'test chat22'
 
-        message_session = [{f"user_msg": "user_msg_1", f"llm_msg": "llm_msg_1", "chat_number": 1},
-                           {f"user_msg": "user_msg_2", f"llm_msg": "llm_msg_2", "chat_number": 2},
-                           {f"user_msg": "user_msg_3", f"llm_msg": "llm_msg_3", "chat_number": 3}]
-        session = self.unauthenticated_client.session
-        session['number_lib_chats'] = 4
-        session['library_messages'] = message_session
-        session.save()
         response = self.unauthenticated_client.post(url, data={"name_title": new_chat_title})
         self.assertEqual(response.status_code, 302)
 
@@ -603,6 +737,7 @@ class LibraryTestCase(TestCase):
 
         embeddings = LibDocumentEmbeddings.objects.get(document=document)
         self.assertEqual(embeddings.start_id, 1)
+        self.assertEqual(embeddings.id_prefix, f"doc{document.pk}_id")
 
     @patch("library.views.upload_document_to_library.delay_on_commit")
     def test_upload_document_lib_embeddings_fail_test_user_save_successful_not_first_doc(self, chroma_upload_func):
@@ -620,8 +755,8 @@ class LibraryTestCase(TestCase):
             content=pdf_content_test,
             content_type='application/pdf'
         )
-        expected_start_id = 342
-        expected_end_id = 350
+        # Ids are scoped to the document so they no longer carry on from the previous document's end_id
+        expected_start_id = 1
         post_data = {"upload_file": mock_pdf}
         response = self.authenticated_client.post(url, post_data)
 
@@ -644,6 +779,7 @@ class LibraryTestCase(TestCase):
 
         embeddings = LibDocumentEmbeddings.objects.get(document=document)
         self.assertEqual(embeddings.start_id, expected_start_id)
+        self.assertEqual(embeddings.id_prefix, f"doc{document.pk}_id")
 
     @patch("library.views.delete_document_from_library.delay_on_commit")
     def test_lib_doc_delete_different_user(self, delete_chroma_func):
@@ -667,6 +803,32 @@ class LibraryTestCase(TestCase):
         self.assertEqual(first_response.status_code, 404)
         delete_chroma_func.assert_not_called()
 
+    @patch("library.views.delete_document_from_library.delay_on_commit")
+    def test_lib_doc_delete_while_processing_removes_stored_chunks(self, delete_chroma_func):
+        document = LibraryTestCase.document_2
+        LibDocuments.objects.filter(pk=document.pk).update(status="processing")
+        LibDocumentEmbeddings.objects.filter(document=document).update(end_id=None, last_chunk_id=300)
+
+        response = self.authenticated_client.post(reverse("delete_document", args=[document.pk]))
+        self.assertEqual(response.status_code, 302)
+
+        delete_chroma_func.assert_called_once_with(
+            number_of_documents=2, unique_user=f'user_{LibraryTestCase.test_user.id}', document_id=document.pk,
+            start_id=272, end_id=None, id_prefix='id')
+
+    @patch("library.views.delete_document_from_library.delay_on_commit")
+    def test_lib_doc_delete_failed_upload_without_embeddings(self, delete_chroma_func):
+        document = LibraryTestCase.document_2
+        LibDocuments.objects.filter(pk=document.pk).update(status="error")
+        LibDocumentEmbeddings.objects.filter(document=document).delete()
+
+        response = self.authenticated_client.post(reverse("delete_document", args=[document.pk]))
+        self.assertEqual(response.status_code, 302)
+
+        delete_chroma_func.assert_called_once_with(
+            number_of_documents=2, unique_user=f'user_{LibraryTestCase.test_user.id}', document_id=document.pk,
+            start_id=None, end_id=None, id_prefix='id')
+
     @patch("library.views.delete_document_from_library.delay_on_commit")
     def test_lib_doc_delete_success(self, delete_chroma_func):
 
@@ -684,7 +846,6 @@ class LibraryTestCase(TestCase):
         file_path = specific_document.upload_file.path
         document_embedding = LibDocumentEmbeddings.objects.filter(document=specific_document)
         doc_embedding_obj = document_embedding.first()
-        list_of_ids = get_list_of_ids_for_chroma_deletion(doc_embedding_obj.start_id, doc_embedding_obj.end_id)
         unique_user = f'user_{LibraryTestCase.test_user.id}'
 
         self.assertTrue(document_delete.exists())
@@ -709,8 +870,9 @@ class LibraryTestCase(TestCase):
         self.assertFalse(document_delete.exists())
         self.assertFalse(document_embedding.exists())
         self.assertFalse(os.path.exists(file_path))
-        delete_chroma_func.assert_called_once_with(number_of_documents=before_count, list_of_ids=list_of_ids,
-                                                   unique_user=unique_user)
+        delete_chroma_func.assert_called_once_with(number_of_documents=before_count, unique_user=unique_user,
+                                                   document_id=pk, start_id=doc_embedding_obj.start_id,
+                                                   end_id=doc_embedding_obj.end_id, id_prefix='id')
 
 
 class UtilsTestCase(unittestTestCase):
@@ -797,3 +959,534 @@ class UtilsTestCase(unittestTestCase):
 
         self.assertEqual(actual_list_of_ids, expected_list_of_ids)
 
+    def test_get_final_id_document_prefix(self):
+        output = get_final_id(num=f"{get_document_id_prefix(12)}456")
+        self.assertEqual(output, 456)
+
+    def test_get_lists_for_chroma_upsert_document_prefix(self):
+        id_list, metadata_list = get_lists_for_chroma_upsert(
+            all_splits=["a", "b"], new_id=1, metadata={"page": 0}, id_prefix=get_document_id_prefix(7))
+
+        self.assertEqual(id_list, ["doc7_id1", "doc7_id2"])
+        self.assertEqual(metadata_list, [{"page": 0}, {"page": 0}])
+
+    def test_get_list_ids_chroma_deletion_document_prefix(self):
+        list_of_ids = get_list_of_ids_for_chroma_deletion(start_id=1, end_id=3, id_prefix=get_document_id_prefix(7))
+
+        self.assertEqual(list_of_ids, ["doc7_id1", "doc7_id2", "doc7_id3"])
+
+    def test_batch_chunks_by_tokens_respects_token_budget(self):
+        chunks = [(f"id{i}", text, {"page": 0}) for i, text in enumerate(["a b c", "d e", "f", "g h i j", "k"], 1)]
+
+        batches = list(batch_chunks_by_tokens(chunks, max_tokens=5, max_items=10,
+                                              count_tokens=lambda text: len(text.split())))
+
+        self.assertEqual([[chunk[0] for chunk in batch] for batch in batches],
+                         [["id1", "id2"], ["id3", "id4"], ["id5"]])
+
+    def test_batch_chunks_by_tokens_respects_max_items(self):
+        chunks = [(f"id{i}", "word", {"page": 0}) for i in range(1, 6)]
+
+        batches = list(batch_chunks_by_tokens(chunks, max_tokens=100, max_items=2, count_tokens=lambda text: 1))
+
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+    def test_batch_chunks_by_tokens_oversized_chunk_gets_own_batch(self):
+        chunks = [("id1", "small", {}), ("id2", "huge", {}), ("id3", "small", {})]
+        token_counts = {"small": 1, "huge": 50}
+
+        batches = list(batch_chunks_by_tokens(chunks, max_tokens=10, max_items=10,
+                                              count_tokens=lambda text: token_counts[text]))
+
+        self.assertEqual([[chunk[0] for chunk in batch] for batch in batches], [["id1"], ["id2"], ["id3"]])
+
+    def test_pack_retrieved_context_best_score_first_with_sources(self):
+        results = {
+            "documents": [["second best", "best", "worst"]],
+            "metadatas": [[{"source": "/media/user_1/b.pdf", "page": 4}, {"source": "/media/user_1/a.pdf", "page": 0},
+                           {"source": "/media/user_1/c.pdf"}]],
+            "distances": [[0.4, 0.1, 0.9]],
+        }
+
+        context = pack_retrieved_context(results, max_tokens=100, count_tokens=lambda text: len(text.split()))
+
+        self.assertEqual(context, "[Source: a.pdf, page 1]\nbest\n\n"
+                                  "[Source: b.pdf, page 5]\nsecond best\n\n"
+                                  "[Source: c.pdf]\nworst")
+
+    def test_pack_retrieved_context_trims_chunk_overlap(self):
+        text = " ".join(f"word{i}" for i in range(200))
+        splitter = RecursiveCharacterTextSplitter(chunk_size=LIBRARY_CHUNK_SIZE, chunk_overlap=LIBRARY_CHUNK_OVERLAP,
+                                                  length_function=len, separators=["\n\n", "\n", " ", ""])
+        chunks = splitter.split_text(text)
+        metadata = {"source": "a.pdf", "page": 0}
+        # The later chunk scores better so it is packed before the chunk it overlaps with
+        results = {"documents": [[chunks[1], chunks[0]]], "metadatas": [[metadata, metadata]],
+                   "distances": [[0.1, 0.2]]}
+
+        context = pack_retrieved_context(results, max_tokens=1000, count_tokens=lambda text: len(text.split()))
+
+        first_section, second_section = context.split("\n\n")
+        second_text = second_section.split("\n", 1)[1]
+        self.assertEqual(first_section.split("\n", 1)[1], chunks[1])
+        # Only the words the two chunks share are dropped
+        self.assertNotEqual(second_text, chunks[0])
+        self.assertTrue(text.startswith(f"{second_text} {chunks[1]}"))
+
+    def test_pack_retrieved_context_drops_repeated_chunks(self):
+        results = {"documents": [["same text", "same text"]],
+                   "metadatas": [[{"source": "a.pdf", "page": 0}, {"source": "copy_of_a.pdf", "page": 0}]],
+                   "distances": [[0.1, 0.1]]}
+
+        context = pack_retrieved_context(results, max_tokens=100, count_tokens=lambda text: len(text.split()))
+
+        self.assertEqual(context, "[Source: a.pdf, page 1]\nsame text")
+
+    def test_pack_retrieved_context_skips_chunks_past_budget(self):
+        results = {"documents": [["short one", " ".join(["long"] * 50), "short two"]],
+                   "metadatas": [[{"source": "a.pdf", "page": 0}, {"source": "a.pdf", "page": 1},
+                                  {"source": "a.pdf", "page": 2}]],
+                   "distances": [[0.1, 0.2, 0.3]]}
+
+        context = pack_retrieved_context(results, max_tokens=20, count_tokens=lambda text: len(text.split()))
+
+        self.assertEqual(context, "[Source: a.pdf, page 1]\nshort one\n\n[Source: a.pdf, page 3]\nshort two")
+        self.assertEqual(pack_retrieved_context({"documents": [[]]}, max_tokens=20, count_tokens=len), "")
+
+
+@override_settings(LIBRARY_EMBEDDING_BATCH_SIZE=2, LIBRARY_EMBEDDING_MAX_CONCURRENCY=2)
+@patch("library.utils.count_embedding_tokens", lambda text: 1)
+class UploadDocumentTaskTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.test_user = User.objects.create_user(username='testuser', password='password')
+
+    def setUp(self):
+        pdf_file = NamedTemporaryFile(suffix=".pdf", delete=False)
+        pdf_file.write(build_test_pdf(["First page text", "Second page text", "Third page text"]))
+        pdf_file.close()
+        self.addCleanup(os.remove, pdf_file.name)
+        self.file_path = pdf_file.name
+
+        self.document = LibDocuments.objects.create(name='upload.pdf', user=self.test_user,
+                                                    upload_file='user_1/upload.pdf', status='uploaded')
+        self.document_embeddings = LibDocumentEmbeddings.objects.create(document=self.document, start_id=1)
+
+        self.collection = MagicMock()
+        patcher = patch("library.tasks.run_on_user_collection",
+                        side_effect=lambda unique_user, operation: operation(self.collection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("library.tasks.get_embedding_function")
+    def test_chunks_are_embedded_in_batches_and_upserted_with_vectors(self, mock_embedding_function):
+        embedding_function = MagicMock(side_effect=lambda input: [[float(len(text))] for text in input])
+        mock_embedding_function.return_value = embedding_function
+
+        output = upload_document_to_library(file_path=self.file_path, unique_user="user_1", new_id=1,
+                                            document_pk=self.document.pk)
+
+        self.assertEqual(output, "Success")
+        self.assertEqual(embedding_function.call_count, 2)
+        upserts = self.collection.upsert.call_args_list
+        self.assertEqual([call.kwargs["ids"] for call in upserts], [["id1", "id2"], ["id3"]])
+        self.assertEqual(upserts[0].kwargs["documents"], ["First page text", "Second page text"])
+        self.assertEqual(upserts[0].kwargs["embeddings"], [[15.0], [16.0]])
+        self.assertEqual(upserts[1].kwargs["metadatas"],
+                         [{"source": self.file_path, "page": 2, "document_id": self.document.pk}])
+
+        self.document.refresh_from_db()
+        self.document_embeddings.refresh_from_db()
+        self.assertEqual(self.document.status, "completed")
+        self.assertEqual(self.document_embeddings.end_id, 3)
+
+    @patch("library.tasks.get_embedding_function")
+    def test_chunk_ids_use_document_prefix(self, mock_embedding_function):
+        mock_embedding_function.return_value = MagicMock(side_effect=lambda input: [[1.0] for _ in input])
+        self.document_embeddings.id_prefix = get_document_id_prefix(self.document.pk)
+        self.document_embeddings.save()
+
+        upload_document_to_library(file_path=self.file_path, unique_user="user_1", new_id=1,
+                                   document_pk=self.document.pk)
+
+        prefix = f"doc{self.document.pk}_id"
+        self.assertEqual([call.kwargs["ids"] for call in self.collection.upsert.call_args_list],
+                         [[f"{prefix}1", f"{prefix}2"], [f"{prefix}3"]])
+        self.document_embeddings.refresh_from_db()
+        self.assertEqual(self.document_embeddings.end_id, 3)
+
+    @patch("library.tasks.get_embedding_function")
+    def test_failed_batch_keeps_vectors_and_checkpoint(self, mock_embedding_function):
+        def embed(input):
+            if "Third page text" in input:
+                raise Exception("rate limited")
+            return [[1.0] for _ in input]
+
+        mock_embedding_function.return_value = MagicMock(side_effect=embed)
+
+        with self.assertRaises(Exception):
+            upload_document_to_library(file_path=self.file_path, unique_user="user_1", new_id=1,
+                                       document_pk=self.document.pk)
+
+        self.document.refresh_from_db()
+        self.document_embeddings.refresh_from_db()
+        self.assertEqual(self.document.status, "processing")
+        self.assertEqual(self.collection.upsert.call_count, 1)
+        self.collection.delete.assert_not_called()
+        self.assertEqual(self.document_embeddings.last_page, 1)
+        self.assertEqual(self.document_embeddings.last_chunk_id, 2)
+
+    @patch("library.tasks.get_embedding_function")
+    def test_retry_resumes_from_checkpoint(self, mock_embedding_function):
+        attempts = []
+
+        def embed(input):
+            attempts.append(input)
+            if "Third page text" in input and len(attempts) == 2:
+                raise Exception("rate limited")
+            return [[1.0] for _ in input]
+
+        mock_embedding_function.return_value = MagicMock(side_effect=embed)
+
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": self.document.pk})
+
+        self.assertEqual(result.get(), "Success")
+        # The first two pages are not embedded again on the retry
+        self.assertEqual(attempts, [["First page text", "Second page text"], ["Third page text"],
+                                    ["Third page text"]])
+        self.assertEqual([call.kwargs["ids"] for call in self.collection.upsert.call_args_list],
+                         [["id1", "id2"], ["id3"]])
+
+        self.document.refresh_from_db()
+        self.document_embeddings.refresh_from_db()
+        self.assertEqual(self.document.status, "completed")
+        self.assertEqual(self.document_embeddings.end_id, 3)
+
+    def test_task_is_redelivered_if_its_worker_is_lost(self):
+        self.assertTrue(upload_document_to_library.acks_late)
+        self.assertTrue(upload_document_to_library.reject_on_worker_lost)
+
+    @patch("library.tasks.get_embedding_function")
+    def test_redelivered_task_resumes_from_checkpoint(self, mock_embedding_function):
+        embedding_function = MagicMock(side_effect=lambda input: [[1.0] for _ in input])
+        mock_embedding_function.return_value = embedding_function
+
+        # State left behind by a worker killed after the first batch was stored
+        self.document.status = "processing"
+        self.document.save()
+        self.document_embeddings.last_page = 1
+        self.document_embeddings.last_chunk_id = 2
+        self.document_embeddings.save()
+
+        # A redelivery is a fresh delivery of the same message, not a retry
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": self.document.pk})
+
+        self.assertEqual(result.get(), "Success")
+        embedding_function.assert_called_once_with(input=["Third page text"])
+        self.assertEqual([call.kwargs["ids"] for call in self.collection.upsert.call_args_list], [["id3"]])
+
+        self.document.refresh_from_db()
+        self.document_embeddings.refresh_from_db()
+        self.assertEqual(self.document.status, "completed")
+        self.assertEqual(self.document_embeddings.end_id, 3)
+
+    @patch("library.tasks.collection_pool")
+    @patch("library.tasks.get_embedding_function")
+    def test_redelivery_past_attempt_limit_fails_document(self, mock_embedding_function, mock_collection_pool):
+        # Every earlier delivery was killed along with its worker, e.g. out of memory
+        self.document.status = "processing"
+        self.document.save()
+        self.document_embeddings.last_page = 1
+        self.document_embeddings.last_chunk_id = 2
+        self.document_embeddings.delivery_attempts = settings.LIBRARY_INGEST_MAX_RETRIES + 1
+        self.document_embeddings.save()
+
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": self.document.pk})
+
+        self.assertTrue(result.failed())
+        mock_embedding_function.assert_not_called()
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, "error")
+        self.assertFalse(LibDocumentEmbeddings.objects.filter(document=self.document).exists())
+        mock_collection_pool.delete.assert_called_once_with("user_1")
+
+    @patch("library.tasks.get_embedding_function")
+    def test_retries_count_as_delivery_attempts(self, mock_embedding_function):
+        calls = []
+
+        def embed(input):
+            calls.append(input)
+            if len(calls) == 1:
+                raise Exception("rate limited")
+            return [[1.0] for _ in input]
+
+        mock_embedding_function.return_value = MagicMock(side_effect=embed)
+
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": self.document.pk})
+
+        self.assertEqual(result.get(), "Success")
+        self.document_embeddings.refresh_from_db()
+        self.assertEqual(self.document_embeddings.delivery_attempts, 2)
+
+    @override_settings(LIBRARY_INGEST_PAGES_PER_BATCH=1)
+    @patch("library.tasks.get_embedding_function")
+    def test_pages_are_checkpointed_before_the_next_is_extracted(self, mock_embedding_function):
+        extracted = []
+
+        def record_pages(*args, **kwargs):
+            for page in iter_pdf_pages(*args, **kwargs):
+                extracted.append(page[0])
+                yield page
+
+        def embed(input):
+            if "Second page text" in input:
+                raise Exception("worker ran out of memory")
+            return [[1.0] for _ in input]
+
+        mock_embedding_function.return_value = MagicMock(side_effect=embed)
+
+        with patch("library.tasks.iter_pdf_pages", side_effect=record_pages), self.assertRaises(Exception):
+            upload_document_to_library(file_path=self.file_path, unique_user="user_1", new_id=1,
+                                       document_pk=self.document.pk)
+
+        # The third page was never extracted and the first is already stored and checkpointed
+        self.assertEqual(extracted, [0, 1])
+        self.assertEqual([call.kwargs["ids"] for call in self.collection.upsert.call_args_list], [["id1"]])
+        self.document_embeddings.refresh_from_db()
+        self.assertEqual(self.document_embeddings.last_page, 0)
+        self.assertEqual(self.document_embeddings.last_chunk_id, 1)
+
+    def test_deleted_document_vectors_are_removed_on_redelivery(self):
+        self.document.delete()
+
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": self.document.pk})
+
+        self.assertTrue(result.failed())
+        self.collection.delete.assert_called_once_with(where={"document_id": self.document.pk})
+        self.collection.upsert.assert_not_called()
+
+    @patch("library.tasks.get_embedding_function")
+    def test_document_deleted_during_ingestion_is_not_brought_back(self, mock_embedding_function):
+        document_pk = self.document.pk
+        mock_embedding_function.return_value = MagicMock(side_effect=lambda input: [[1.0] for _ in input])
+        # The user deletes the document while its first batch is being stored
+        self.collection.upsert.side_effect = lambda **kwargs: LibDocuments.objects.filter(pk=document_pk).delete()
+
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": document_pk})
+
+        self.assertTrue(result.failed())
+        self.assertFalse(LibDocuments.objects.filter(pk=document_pk).exists())
+        self.collection.delete.assert_called_with(where={"document_id": document_pk})
+
+    @patch("library.tasks.get_embedding_function")
+    def test_redelivered_completed_task_does_nothing(self, mock_embedding_function):
+        self.document.status = "completed"
+        self.document.save()
+
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": self.document.pk})
+
+        self.assertEqual(result.get(), "Success")
+        mock_embedding_function.assert_not_called()
+        self.collection.upsert.assert_not_called()
+
+    @patch("library.tasks.collection_pool")
+    @patch("library.tasks.get_embedding_function")
+    @patch("library.tasks.iter_pdf_pages", side_effect=lambda *args, **kwargs: iter([(0, "")]))
+    def test_document_without_text_fails_without_retrying(self, mock_iter_pdf_pages, mock_embedding_function,
+                                                          mock_collection_pool):
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": self.document.pk})
+
+        self.assertTrue(result.failed())
+        mock_iter_pdf_pages.assert_called_once()
+        mock_embedding_function.return_value.assert_not_called()
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, "error")
+        self.assertFalse(LibDocumentEmbeddings.objects.filter(document=self.document).exists())
+
+    @override_settings(LIBRARY_INGEST_MAX_RETRIES=1)
+    @patch("library.tasks.collection_pool")
+    @patch("library.tasks.get_embedding_function")
+    def test_exhausted_retries_mark_document_error(self, mock_embedding_function, mock_collection_pool):
+        def embed(input):
+            if "Third page text" in input:
+                raise Exception("rate limited")
+            return [[1.0] for _ in input]
+
+        mock_embedding_function.return_value = MagicMock(side_effect=embed)
+
+        result = upload_document_to_library.apply(kwargs={
+            "file_path": self.file_path, "unique_user": "user_1", "new_id": 1, "document_pk": self.document.pk})
+
+        self.assertTrue(result.failed())
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, "error")
+        self.assertFalse(LibDocumentEmbeddings.objects.filter(document=self.document).exists())
+        # Only document for the user so the whole collection is dropped
+        mock_collection_pool.delete.assert_called_once_with("user_1")
+
+
+class DeleteDocumentVectorsTestCase(unittestTestCase):
+
+    def setUp(self):
+        client = chromadb.EphemeralClient()
+        self.collection = client.get_or_create_collection(name="delete_document_vectors_test")
+        self.addCleanup(client.delete_collection, name="delete_document_vectors_test")
+
+        legacy_ids = [f"id{i}" for i in range(1, 6)]
+        self.collection.add(ids=legacy_ids, embeddings=[[1.0, 0.0]] * 5, metadatas=[{"page": 0}] * 5)
+        other_legacy_ids = [f"id{i}" for i in range(6, 8)]
+        self.collection.add(ids=other_legacy_ids, embeddings=[[1.0, 0.0]] * 2, metadatas=[{"page": 0}] * 2)
+        for document_id in (9, 10):
+            ids = [f"doc{document_id}_id{i}" for i in range(1, 4)]
+            self.collection.add(ids=ids, embeddings=[[0.0, 1.0]] * 3,
+                                metadatas=[{"page": 0, "document_id": document_id}] * 3)
+
+        patcher = patch("library.tasks.run_on_user_collection",
+                        side_effect=lambda unique_user, operation: operation(self.collection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def remaining_ids(self):
+        return sorted(self.collection.get(include=[])["ids"])
+
+    def test_document_chunks_deleted_with_metadata_filter(self):
+        delete_document_vectors(unique_user="user_1", document_id=9, start_id=1, end_id=3,
+                                id_prefix=get_document_id_prefix(9))
+
+        self.assertEqual(self.remaining_ids(), sorted([f"id{i}" for i in range(1, 8)] +
+                                                      [f"doc10_id{i}" for i in range(1, 4)]))
+
+    def test_legacy_document_chunks_deleted_in_id_batches(self):
+        with override_settings(LIBRARY_DELETE_BATCH_SIZE=2):
+            with patch.object(self.collection, "delete", wraps=self.collection.delete) as mock_delete:
+                delete_document_vectors(unique_user="user_1", document_id=3, start_id=1, end_id=5)
+
+        # One filtered delete followed by batches of at most two ids
+        self.assertEqual([len(call.kwargs.get("ids", [])) for call in mock_delete.call_args_list], [0, 2, 2, 1])
+        self.assertEqual(self.remaining_ids(), sorted(["id6", "id7"] + [f"doc{d}_id{i}" for d in (9, 10)
+                                                                        for i in range(1, 4)]))
+
+
+class ChromaPoolTestCase(unittestTestCase):
+
+    def setUp(self):
+        self.mock_client = MockChromaClient()
+        patcher = patch("library.chroma_pool.get_chroma_client", return_value=self.mock_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = CollectionPool(max_size=2)
+
+    def test_get_chroma_client_is_only_constructed_once(self):
+        get_chroma_client.cache_clear()
+        self.addCleanup(get_chroma_client.cache_clear)
+        with patch("library.chroma_pool.chromadb.PersistentClient") as mock_persistent_client:
+            first = get_chroma_client()
+            second = get_chroma_client()
+
+        self.assertIs(first, second)
+        mock_persistent_client.assert_called_once_with(path=str(settings.CHROMA_DB_PATH))
+
+    def test_collection_is_reused_for_same_user(self):
+        first = self.pool.get("user_1")
+        second = self.pool.get("user_1")
+
+        self.assertIs(first, second)
+        self.assertEqual(self.mock_client.opened, ["user_1"])
+
+    def test_least_recently_used_collection_is_evicted(self):
+        self.pool.get("user_1")
+        self.pool.get("user_2")
+        # Touch user_1 so user_2 becomes the least recently used
+        self.pool.get("user_1")
+        self.pool.get("user_3")
+
+        self.assertEqual(len(self.pool), 2)
+        self.assertIn("user_1", self.pool)
+        self.assertNotIn("user_2", self.pool)
+        self.assertIn("user_3", self.pool)
+
+    def test_delete_drops_pooled_collection(self):
+        self.pool.get("user_1")
+        self.pool.delete("user_1")
+
+        self.assertNotIn("user_1", self.pool)
+        self.assertEqual(self.mock_client.deleted, ["user_1"])
+
+        self.pool.get("user_1")
+        self.assertEqual(self.mock_client.opened, ["user_1", "user_1"])
+
+    def test_run_on_user_collection_reopens_stale_collection(self):
+        calls = []
+
+        def operation(collection):
+            calls.append(collection)
+            if len(calls) == 1:
+                raise InvalidCollectionException("Collection does not exist.")
+            return "result"
+
+        with patch("library.chroma_pool.collection_pool", self.pool):
+            output = run_on_user_collection("user_1", operation)
+
+        self.assertEqual(output, "result")
+        self.assertEqual(len(calls), 2)
+        self.assertIsNot(calls[0], calls[1])
+        self.assertEqual(self.mock_client.opened, ["user_1", "user_1"])
+
+
+@patch("library.utils.count_chat_tokens", lambda text: len(text.split()))
+class AnswerUserMessageLibraryTestCase(unittestTestCase):
+
+    def setUp(self):
+        caches[EMBEDDING_CACHE_ALIAS].clear()
+        self.addCleanup(caches[EMBEDDING_CACHE_ALIAS].clear)
+
+    @patch("library.helpers.get_chat_model")
+    @patch("library.helpers.run_on_user_collection")
+    @patch("library.helpers.get_embedding_function")
+    def test_repeat_question_reuses_query_embedding(self, mock_embedding_function, mock_run_on_collection,
+                                                     mock_chat_model):
+        embedding_function = MagicMock(side_effect=lambda input: [[0.5, 0.5] for _ in input])
+        mock_embedding_function.return_value = embedding_function
+        collection = MagicMock()
+        collection.query.return_value = {"documents": [["retrieved context"]], "metadatas": [[{"source": "a.pdf"}]],
+                                         "distances": [[0.1]]}
+        mock_run_on_collection.side_effect = lambda unique_user, operation: operation(collection)
+        mock_chat_model.return_value = FakeListChatModel(responses=["first answer", "second answer"])
+
+        first = answer_user_message_library("What is a cell?", "user_1", [])
+        second = answer_user_message_library("what is a  cell?", "user_1", [])
+
+        self.assertEqual(first.content, "first answer")
+        self.assertEqual(second.content, "second answer")
+        embedding_function.assert_called_once_with(input=["What is a cell?"])
+        collection.query.assert_called_with(query_embeddings=[[0.5, 0.5]], n_results=10,
+                                            include=["documents", "metadatas", "distances"])
+
+    @patch("library.helpers.get_chat_model")
+    @patch("library.helpers.run_on_user_collection")
+    @patch("library.helpers.get_embedding_function")
+    def test_stream_user_message_library_yields_chunks(self, mock_embedding_function, mock_run_on_collection,
+                                                        mock_chat_model):
+        mock_embedding_function.return_value = MagicMock(side_effect=lambda input: [[0.5, 0.5] for _ in input])
+        collection = MagicMock()
+        collection.query.return_value = {"documents": [["retrieved context"]], "metadatas": [[{"source": "a.pdf"}]],
+                                         "distances": [[0.1]]}
+        mock_run_on_collection.side_effect = lambda unique_user, operation: operation(collection)
+        mock_chat_model.return_value = FakeListChatModel(responses=["streamed answer"])
+
+        message_chunks = stream_user_message_library("What is a cell?", "user_1", [])
+
+        # Retrieval has already happened before the first chunk is requested
+        collection.query.assert_called_once()
+        chunks = [chunk.content for chunk in message_chunks]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), "streamed answer")
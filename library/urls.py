@@ -12,6 +12,7 @@ urlpatterns = [
     path('document/<int:pk>/', views.LibDocumentsDetailView.as_view(), name='libdocuments_detail'),
     path('delete/document/<int:pk>', views.LibraryDocumentsDeleteView.as_view(), name='delete_document'),
     path("answer_user", views.answer_user_input_library, name="answer_user_input_lib"),
+    path("answer_user_stream", views.answer_user_input_library_stream, name="answer_user_input_lib_stream"),
     path("save_chat", views.save_lib_chat, name="save_lib_chat"),
     path("download_file/<int:pk>", views.download_file, name="download_file"),
     path('delete/<int:pk>', views.LibChatDeleteView.as_view(), name='delete_lib_chat')
@@ -1,3 +1,16 @@
+import os
+from functools import lru_cache
+
+import tiktoken
+
+# Library documents are split into chunks of this many characters, neighbouring chunks share up to the overlap
+LIBRARY_CHUNK_SIZE = 500
+LIBRARY_CHUNK_OVERLAP = 20
+
+# Shorter matches between the end of one chunk and the start of another are more likely chance than overlap
+MIN_CHUNK_OVERLAP_MATCH = 4
+
+
 def get_final_id(num: str):
     n = num.split('id')
     try:
@@ -9,21 +22,151 @@ def get_final_id(num: str):
         return fin
 
 
-def get_lists_for_chroma_upsert(all_splits: list, new_id: int, metadata: dict):
+def get_document_id_prefix(document_pk: int):
+    # Scoping chunk ids to the document means concurrent uploads never need to agree on an id range
+    return f'doc{document_pk}_id'
+
+
+def get_lists_for_chroma_upsert(all_splits: list, new_id: int, metadata: dict, id_prefix: str = 'id'):
 
     id_list = []
     metadata_list = []
 
     for split in all_splits:
-        id_list.append(f'id{new_id}')
+        id_list.append(f'{id_prefix}{new_id}')
         metadata_list.append(metadata)
         new_id += 1
 
     return id_list, metadata_list
 
 
-def get_list_of_ids_for_chroma_deletion(start_id: int, end_id: int):
+def get_list_of_ids_for_chroma_deletion(start_id: int, end_id: int, id_prefix: str = 'id'):
+
+    list_of_ids = [f"{id_prefix}{i}" for i in range(start_id, end_id + 1)]
+
+    return list_of_ids
+
+@lru_cache(maxsize=1)
+def get_embedding_encoding():
+    return tiktoken.encoding_for_model("text-embedding-3-large")
+
+
+def count_embedding_tokens(text: str):
+    return len(get_embedding_encoding().encode(text, disallowed_special=()))
+
+
+def batch_chunks_by_tokens(chunks: list, max_tokens: int, max_items: int, count_tokens=None):
+    """
+    Groups (id, text, metadata) chunks into batches of at most max_items chunks whose texts add up to at most
+    max_tokens tokens. A chunk that is larger than max_tokens on its own is sent as a batch by itself.
+    """
+
+    count_tokens = count_tokens or count_embedding_tokens
+    batch = []
+    batch_tokens = 0
+
+    for chunk in chunks:
+        chunk_tokens = count_tokens(chunk[1])
+
+        if batch and (batch_tokens + chunk_tokens > max_tokens or len(batch) >= max_items):
+            yield batch
+            batch = []
+            batch_tokens = 0
+
+        batch.append(chunk)
+        batch_tokens += chunk_tokens
+
+    if batch:
+        yield batch
+
+
+@lru_cache(maxsize=1)
+def get_chat_encoding():
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+
+def count_chat_tokens(text: str):
+    return len(get_chat_encoding().encode(text, disallowed_special=()))
+
+
+def get_source_marker(metadata: dict):
+    metadata = metadata or {}
+    source = os.path.basename(metadata.get("source") or "unknown")
+
+    if metadata.get("page") is None:
+        return f"[Source: {source}]"
+
+    return f"[Source: {source}, page {metadata['page'] + 1}]"
+
+
+def get_overlap_length(first: str, second: str, max_overlap: int = LIBRARY_CHUNK_OVERLAP):
+    """Length of the longest end of first, up to max_overlap characters, that second starts with."""
+
+    for length in range(min(max_overlap, len(first), len(second)), MIN_CHUNK_OVERLAP_MATCH - 1, -1):
+        if second.startswith(first[-length:]):
+            return length
+
+    return 0
+
+
+def trim_chunk_overlap(text: str, neighbours: list):
+    """Removes the text this chunk shares with the end or start of chunks from the same page already packed."""
+
+    for neighbour in neighbours:
+        text = text[get_overlap_length(neighbour, text):]
+        overlap = get_overlap_length(text, neighbour)
+        if overlap:
+            text = text[:-overlap]
+
+    return text.strip()
+
+
+def pack_retrieved_context(results: dict, max_tokens: int, count_tokens=None):
+    """
+    Builds the prompt context from a chroma query result. Chunks are taken best score first and each one is
+    marked with the document and page it came from. Repeated chunks and the overlap neighbouring chunks share are
+    dropped, then chunks are added while they fit in max_tokens, a chunk that doesn't fit is skipped so a shorter
+    one further down can still use the space.
+    """
+
+    count_tokens = count_tokens or count_chat_tokens
+
+    documents = (results.get("documents") or [[]])[0]
+    metadatas = (results.get("metadatas") or [[None] * len(documents)])[0]
+    distances = (results.get("distances") or [[0] * len(documents)])[0]
+
+    ranked = sorted(zip(distances, range(len(documents)), documents, metadatas), key=lambda result: result[:2])
+
+    packed = []
+    packed_by_page = {}
+    # The same text can come back from more than one document, e.g. if a file was uploaded twice
+    seen_texts = set()
+    used_tokens = 0
+
+    for _, _, text, metadata in ranked:
+        if not text:
+            continue
+
+        page_key = ((metadata or {}).get("source"), (metadata or {}).get("page"))
+        neighbours = packed_by_page.setdefault(page_key, [])
+
+        if text in seen_texts:
+            continue
+
+        trimmed_text = trim_chunk_overlap(text, neighbours)
+        if not trimmed_text:
+            continue
+
+        section = f"{get_source_marker(metadata)}\n{trimmed_text}"
+        # Sections after the first are joined on a blank line which costs tokens too
+        section_tokens = count_tokens(section if not packed else f"\n\n{section}")
+
+        if used_tokens + section_tokens > max_tokens:
+            continue
 
-    list_of_ids = [f"id{i}" for i in range(start_id, end_id + 1)]
+        packed.append(section)
+        neighbours.append(text)
+        seen_texts.add(text)
+        used_tokens += section_tokens
 
-    return list_of_ids
\ No newline at end of file
+    return "\n\n".join(packed)
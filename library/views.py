@@ -3,6 +3,8 @@ import json
 import os
 import time
 
+from asgiref.sync import sync_to_async
+
 from django.contrib import messages
 from django.db import transaction
 from django.shortcuts import redirect, render, get_object_or_404
@@ -18,13 +20,19 @@ from django.urls import reverse_lazy
 
 from library.forms import LibDocForm, LibChatTitleForm, SaveLibChatTitleForm
 from library.models import LibChat, LibMessage, LibDocuments, LibDocumentEmbeddings
-from library.helpers import answer_user_message_library
+from MCQ_Generator.chat_history import adelete_stale_drafts, append_chat_turns, aappend_chat_turns, delete_stale_drafts
+from MCQ_Generator.streaming import is_asgi_request, streaming_llm_response
+from library.helpers import aanswer_user_message_library, astream_user_message_library, stream_user_message_library
 from library.tasks import upload_document_to_library, delete_document_from_library
-from library.utils import get_list_of_ids_for_chroma_deletion
+from library.utils import get_document_id_prefix
 
 
 logger = logging.getLogger("django_mcq")
 
+LIBRARY_CHAT_ERROR_MESSAGE = "Problem with chatbot response please contact the System Administrator"
+
+DRAFT_LIB_CHAT_SESSION_KEY = "draft_lib_chat_id"
+
 
 class LibChatListView(LoginRequiredMixin, ListView):
     model = LibChat
@@ -34,13 +42,13 @@ class LibChatListView(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         # Filter quizzes by the current logged-in user
-        return LibChat.objects.filter(user=self.request.user)
+        return LibChat.objects.filter(user=self.request.user, is_draft=False)
 
 @login_required(login_url='login')
 def get_lib_chat_data(request, pk):
 
     # Get the quiz by pk or return 404 if not found
-    chat = get_object_or_404(LibChat, pk=pk, user=request.user)
+    chat = get_object_or_404(LibChat, pk=pk, user=request.user, is_draft=False)
 
     logger.debug(chat)
 
@@ -67,8 +75,9 @@ class LibDocListView(LoginRequiredMixin, ListView):
 
 @login_required
 def lib_chatbot_new_chat(request):
-    request.session['library_messages'] = []
-    request.session['number_lib_chats'] = 1
+    # An unsaved conversation is thrown away when the user starts a new one
+    draft_chat_id = request.session.pop(DRAFT_LIB_CHAT_SESSION_KEY, None)
+    LibChat.objects.filter(pk=draft_chat_id, user=request.user, is_draft=True).delete()
 
     number_of_docs = LibDocuments.objects.filter(user=request.user, status="completed").count()
 
@@ -93,14 +102,6 @@ def upload_document(request):
             logger.debug("form_valid 1")
             time_1 = time.time()
 
-            latest_doc = LibDocuments.objects.filter(user=request.user).order_by('-datetime_added').first()
-
-            if latest_doc:
-                latest_embedding = LibDocumentEmbeddings.objects.filter(document=latest_doc).first()
-                last_id = latest_embedding.end_id
-            else:
-                last_id = 0
-
             lib_doc = form.save(commit=False)  # Don't save yet
             lib_doc.user = request.user  # Assign the logged-in user
             lib_doc.name = lib_doc.upload_file.name  # Save original filename
@@ -110,7 +111,8 @@ def upload_document(request):
             logger.debug(time_2 - time_1)
             unique_user = f'user_{request.user.id}'
 
-            new_id = last_id + 1
+            # Chunk ids are prefixed with the document pk so every document numbers its chunks from 1
+            new_id = 1
 
             try:
                 with transaction.atomic():
@@ -134,6 +136,7 @@ def upload_document(request):
             lib_doc_embeddings = LibDocumentEmbeddings()
             lib_doc_embeddings.document = lib_doc
             lib_doc_embeddings.start_id = new_id
+            lib_doc_embeddings.id_prefix = get_document_id_prefix(lib_doc.pk)
 
             try:
                 lib_doc_embeddings.save()
@@ -203,22 +206,25 @@ class LibraryDocumentsDeleteView(LoginRequiredMixin, DeleteView):
 
         unique_user = f'user_{self.request.user.id}'
 
-        list_of_ids = None
+        start_id = None
+        end_id = None
+        id_prefix = 'id'
 
-        if instance.status == "completed":
+        # Documents still being ingested already have chunks in chroma, those are found by their document_id
+        lib_doc = LibDocumentEmbeddings.objects.filter(document_id=instance.pk).first()
 
-            if number_documents > 1:
-                lib_doc = LibDocumentEmbeddings.objects.get(document_id=instance.pk)
+        if number_documents > 1 and lib_doc is not None:
 
-                start_id = lib_doc.start_id
+            start_id = lib_doc.start_id
 
-                end_id = lib_doc.end_id
+            end_id = lib_doc.end_id
 
-                list_of_ids = get_list_of_ids_for_chroma_deletion(start_id=start_id, end_id=end_id)
+            id_prefix = lib_doc.id_prefix
 
 
-            delete_document_from_library.delay_on_commit(
-                number_of_documents=number_documents, list_of_ids=list_of_ids, unique_user=unique_user)
+        delete_document_from_library.delay_on_commit(
+            number_of_documents=number_documents, unique_user=unique_user, document_id=instance.pk,
+            start_id=start_id, end_id=end_id, id_prefix=id_prefix)
 
 
         # Perform custom logic, e.g., delete the uploaded file from storage
@@ -232,54 +238,145 @@ class LibraryDocumentsDeleteView(LoginRequiredMixin, DeleteView):
         # Proceed with the standard delete operation
         return super().form_valid(form)
 
+@transaction.non_atomic_requests
 @login_required(login_url='login')
-def answer_user_input_library(request):
+async def answer_user_input_library(request):
 
     post_data = json.loads(request.body.decode("utf-8"))
 
+    user_message = post_data['user_msg']
+    user = await request.auser()
+    unique_user = f'user_{user.id}'
+
+    filter_docs = await aget_filter_docs(user, post_data['user_docs'])
+
     try:
-        chat_number = request.session["number_lib_chats"]
-    except KeyError:
-        chat_number = 1
-    else:
-        chat_number = int(chat_number)
+        chatbot_res = await aanswer_user_message_library(user_message, unique_user, filter_docs)
+    except Exception as e:
+        logger.error(e)
+        return JsonResponse({"message": LIBRARY_CHAT_ERROR_MESSAGE})
+
+    chatbot_res_content = chatbot_res.content
+
+    draft_chat = await aget_draft_lib_chat(request.session, user)
+    await arecord_lib_chat_message(draft_chat, user_message, chatbot_res_content)
+
+    return JsonResponse({"message": chatbot_res_content})
+
 
+@transaction.non_atomic_requests
+@login_required(login_url='login')
+async def answer_user_input_library_stream(request):
+
+    post_data = json.loads(request.body.decode("utf-8"))
 
     user_message = post_data['user_msg']
+
+    if not is_asgi_request(request):
+        return await sync_to_async(stream_library_answer_sync)(request, user_message, post_data['user_docs'])
+
+    user = await request.auser()
+    unique_user = f'user_{user.id}'
+
+    filter_docs = await aget_filter_docs(user, post_data['user_docs'])
+
+    try:
+        message_chunks = await astream_user_message_library(user_message, unique_user, filter_docs)
+    except Exception as e:
+        logger.error(e)
+        return JsonResponse({"message": LIBRARY_CHAT_ERROR_MESSAGE})
+
+    async def on_complete(chatbot_res_content):
+        draft_chat = await aget_draft_lib_chat(request.session, user)
+        await arecord_lib_chat_message(draft_chat, user_message, chatbot_res_content)
+        # The session middleware has already run by the time the stream finishes so save it here
+        await request.session.asave()
+
+    return streaming_llm_response(message_chunks, on_complete, LIBRARY_CHAT_ERROR_MESSAGE)
+
+
+def stream_library_answer_sync(request, user_message, user_docs):
+    """The WSGI version of answer_user_input_library_stream, WSGI servers only send sync iterators as they go."""
+
     unique_user = f'user_{request.user.id}'
 
-    user_docs = post_data['user_docs']
+    filter_docs = get_filter_docs(request.user, user_docs)
+
+    try:
+        message_chunks = stream_user_message_library(user_message, unique_user, filter_docs)
+    except Exception as e:
+        logger.error(e)
+        return JsonResponse({"message": LIBRARY_CHAT_ERROR_MESSAGE})
+
+    def on_complete(chatbot_res_content):
+        draft_chat = get_draft_lib_chat(request.session, request.user)
+        record_lib_chat_message(draft_chat, user_message, chatbot_res_content)
+        request.session.save()
+
+    return streaming_llm_response(message_chunks, on_complete, LIBRARY_CHAT_ERROR_MESSAGE)
+
+
+def get_filter_docs(user, user_docs):
 
     filter_docs = []
 
     for doc in user_docs:
-        lib_doc = LibDocuments.objects.filter(user=request.user, pk=doc).first()
+        lib_doc = LibDocuments.objects.filter(user=user, pk=doc).first()
         file_path = os.path.join(settings.MEDIA_ROOT, lib_doc.upload_file.name)
         filter_docs.append(file_path)
 
-    try:
-        chatbot_res = answer_user_message_library(user_message, unique_user, filter_docs)
-    except Exception as e:
-        logger.error(e)
-        return JsonResponse({"message": "Problem with chatbot response please contact the System Administrator"})
+    return filter_docs
 
-    chatbot_res_content = chatbot_res.content
 
-    message_dict = {f"user_msg": user_message, f"llm_msg": chatbot_res_content, "chat_number": chat_number}
+async def aget_filter_docs(user, user_docs):
+
+    filter_docs = []
+
+    for doc in user_docs:
+        lib_doc = await LibDocuments.objects.filter(user=user, pk=doc).afirst()
+        file_path = os.path.join(settings.MEDIA_ROOT, lib_doc.upload_file.name)
+        filter_docs.append(file_path)
 
-    chat_messages = request.session.get("library_messages", [])
-    chat_messages.append(message_dict)
-    request.session["library_messages"] = chat_messages  # Save back to the session
+    return filter_docs
 
-    new_chat_number = chat_number + 1
-    request.session["number_lib_chats"] = new_chat_number
 
-    logger.debug("This is session at end of logic lib")
+def get_draft_lib_chat(session, user):
+    """
+    Returns the draft library chat for this session, creating it on the first message. Only the draft's id is kept
+    in the session, the transcript itself is appended to the LibMessage table one turn at a time.
+    """
 
-    logger.debug(request.session["library_messages"])
-    logger.debug(request.session["number_lib_chats"])
+    draft_chat = LibChat.objects.filter(pk=session.get(DRAFT_LIB_CHAT_SESSION_KEY), user=user,
+                                        is_draft=True).first()
 
-    return JsonResponse({"message": chatbot_res_content})
+    if draft_chat is None:
+        # Starting a draft is rare enough to also clear out the ones left behind by expired sessions
+        delete_stale_drafts(LibChat)
+        draft_chat = LibChat.objects.create(user=user, is_draft=True)
+        session[DRAFT_LIB_CHAT_SESSION_KEY] = draft_chat.pk
+
+    return draft_chat
+
+
+async def aget_draft_lib_chat(session, user):
+
+    draft_chat = await LibChat.objects.filter(pk=await session.aget(DRAFT_LIB_CHAT_SESSION_KEY), user=user,
+                                              is_draft=True).afirst()
+
+    if draft_chat is None:
+        await adelete_stale_drafts(LibChat)
+        draft_chat = await LibChat.objects.acreate(user=user, is_draft=True)
+        await session.aset(DRAFT_LIB_CHAT_SESSION_KEY, draft_chat.pk)
+
+    return draft_chat
+
+
+def record_lib_chat_message(chat, user_message, llm_message):
+    append_chat_turns(LibMessage, chat, [(user_message, llm_message)])
+
+
+async def arecord_lib_chat_message(chat, user_message, llm_message):
+    await aappend_chat_turns(LibMessage, chat, [(user_message, llm_message)])
 
 
 @login_required(login_url='login')
@@ -288,8 +385,6 @@ def save_lib_chat(request):
         return HttpResponseForbidden('DONT HIT THIS')
 
     logger.debug(request.POST['name_title'])
-    logger.debug(request.session["library_messages"])
-    logger.debug(request.session["number_lib_chats"])
 
     submitted_form = SaveLibChatTitleForm(request.POST)
 
@@ -298,45 +393,22 @@ def save_lib_chat(request):
         messages.error(request, 'Please fix chat name')
         return JsonResponse({"error": "Please fix chat name"}, status=400)
 
-    new_chat = LibChat()
-    new_chat.user = request.user
-    new_chat.title = submitted_form.cleaned_data['name_title']
+    title = submitted_form.cleaned_data['name_title']
+    draft_chat_id = request.session.get(DRAFT_LIB_CHAT_SESSION_KEY)
 
     try:
-        new_chat.save()
+        with transaction.atomic():
+            # The messages are already stored against the draft so saving just names it
+            saved = LibChat.objects.filter(pk=draft_chat_id, user=request.user, is_draft=True).update(
+                title=title, is_draft=False)
+            if not saved:
+                LibChat.objects.create(user=request.user, title=title)
     except Exception as e:
         logger.error(e)
         messages.error(request, f"An error occurred: {str(e)}")
         return JsonResponse({"error": "Error when saving chat"}, status=500)
 
-    for message in request.session["library_messages"]:
-
-        user_chat_number = message["chat_number"] * 2 - 1
-        llm_chat_number = message["chat_number"] * 2
-
-        new_user_message = LibMessage()
-        new_llm_message = LibMessage()
-
-        new_user_message.chat = new_chat
-        new_llm_message.chat = new_chat
-
-        new_user_message.message_text = message['user_msg']
-        new_user_message.order_number = user_chat_number
-        new_user_message.llm_response = False
-
-        new_llm_message.message_text = message['llm_msg']
-        new_llm_message.order_number = llm_chat_number
-        new_llm_message.llm_response = True
-
-        try:
-            # Unable to test as unsure how I will hit this in a unit test
-            new_user_message.save()
-            new_llm_message.save()
-
-        except Exception as e:
-            logger.error(e)
-            messages.error(request, f"An error occurred: {str(e)}")
-            return JsonResponse({"error": "Error when saving Messaged"}, status=500)
+    request.session.pop(DRAFT_LIB_CHAT_SESSION_KEY, None)
 
     messages.success(request, "Data saved successfully!")
     return redirect("library_index")
@@ -369,7 +441,7 @@ class LibChatDeleteView(LoginRequiredMixin, DeleteView):
         """
         Limit the queryset to quizzes owned by the logged-in user.
         """
-        return LibChat.objects.filter(user=self.request.user)
+        return LibChat.objects.filter(user=self.request.user, is_draft=False)
 
     def handle_no_permission(self):
         """
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.db.models import Count
-from quiz.models import Quiz, Question, Answer
+from quiz.models import Quiz, Question, Answer, QuizGenerationJob, CachedQuiz, QuizCacheCounter
 
 
 class QuizAdmin(admin.ModelAdmin):
@@ -24,6 +24,30 @@ class QuizAdmin(admin.ModelAdmin):
 
         return super().changelist_view(request, extra_context=extra_context)
 
+
+class CachedQuizAdmin(admin.ModelAdmin):
+    list_display = ('key', 'hits', 'datetime_added', 'last_accessed')
+    search_fields = ('key',)
+
+    change_list_template = "admin/quizcache_changelist.html"
+
+    def changelist_view(self, request, extra_context=None):
+        counters = dict(QuizCacheCounter.objects.values_list('name', 'value'))
+        cache_hits = counters.get('hits', 0)
+        cache_misses = counters.get('misses', 0)
+        total_lookups = cache_hits + cache_misses
+
+        extra_context = extra_context or {}
+        extra_context['total_cached_quizzes'] = CachedQuiz.objects.count()
+        extra_context['cache_hits'] = cache_hits
+        extra_context['cache_misses'] = cache_misses
+        extra_context['cache_hit_rate'] = round(cache_hits / total_lookups * 100, 1) if total_lookups else 0
+
+        return super().changelist_view(request, extra_context=extra_context)
+
 admin.site.register(Quiz, QuizAdmin)
 admin.site.register(Question)
 admin.site.register(Answer)
+admin.site.register(QuizGenerationJob)
+admin.site.register(CachedQuiz, CachedQuizAdmin)
+admin.site.register(QuizCacheCounter)
@@ -0,0 +1,75 @@
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from quiz.llm_integration import PROMPT_TEMPLATE_VERSION
+from quiz.models import CachedQuiz, QuizCacheCounter
+
+logger = logging.getLogger("django_mcq")
+
+
+def get_quiz_cache_key(file, number_of_questions: int, file_type: str):
+
+    sha = hashlib.sha256()
+
+    for chunk in file.chunks():
+        sha.update(chunk)
+
+    # Leave the file ready to be read again by the llm integration
+    file.seek(0)
+
+    sha.update(f"|{number_of_questions}|{file_type}|{PROMPT_TEMPLATE_VERSION}".encode("utf-8"))
+
+    return sha.hexdigest()
+
+
+def increment_cache_counter(name: str):
+    counter, _ = QuizCacheCounter.objects.get_or_create(name=name)
+    QuizCacheCounter.objects.filter(pk=counter.pk).update(value=F('value') + 1)
+
+
+def get_cached_quiz(key: str):
+
+    cutoff = timezone.now() - timedelta(seconds=settings.QUIZ_CACHE_TTL)
+
+    entry = CachedQuiz.objects.filter(key=key, datetime_added__gte=cutoff).first()
+
+    if entry is None:
+        increment_cache_counter("misses")
+        return None
+
+    CachedQuiz.objects.filter(pk=entry.pk).update(hits=F('hits') + 1, last_accessed=timezone.now())
+    increment_cache_counter("hits")
+
+    logger.info(f"Quiz cache hit for key {key}")
+
+    return entry.result
+
+
+def store_cached_quiz(key: str, result: dict):
+
+    now = timezone.now()
+
+    CachedQuiz.objects.update_or_create(key=key, defaults={"result": result, "datetime_added": now,
+                                                           "last_accessed": now, "hits": 0})
+
+    evict_cached_quizzes()
+
+
+def evict_cached_quizzes():
+
+    cutoff = timezone.now() - timedelta(seconds=settings.QUIZ_CACHE_TTL)
+    CachedQuiz.objects.filter(datetime_added__lt=cutoff).delete()
+
+    # Least recently used entries go first once the cache is over its size limit
+    stale_pks = CachedQuiz.objects.order_by('-last_accessed', '-pk').values_list(
+        'pk', flat=True)[settings.QUIZ_CACHE_MAX_ENTRIES:]
+
+    stale_pks = list(stale_pks)
+
+    if stale_pks:
+        CachedQuiz.objects.filter(pk__in=stale_pks).delete()
@@ -1,20 +1,26 @@
 import json
 import logging
-from tempfile import NamedTemporaryFile
-from typing import List
+import math
+import re
+from typing import List, Optional
 
 from openai import OpenAI
 from django.conf import settings
 from pydantic import BaseModel
 
-from langchain_openai import ChatOpenAI
-from langchain_community.document_loaders import TextLoader, PyPDFLoader
 from langchain.output_parsers import PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from MCQ_Generator.document_extraction import iter_pdf_pages, read_text_file
+from MCQ_Generator.llm_clients import get_chat_model
 
 
 logger = logging.getLogger("django_mcq")
 
+# Bump this whenever the prompts below change so cached quizzes built from the old prompts are not reused
+PROMPT_TEMPLATE_VERSION = 1
+
 
 class MultiChoiceQuestion(BaseModel):
     question: str
@@ -96,18 +102,9 @@ def execute_llm_prompt_open_ai(temperature):
 
 
 def execute_llm_prompt_langchain(number_of_questions: int, quiz_name: str, file):
-    model = ChatOpenAI(model="gpt-4o-mini", api_key=settings.OPEN_API_KEY)
-
-    with NamedTemporaryFile() as tempfile:
-
-        tempfile.write(file.read())
-        tempfile.seek(0)
-
-        loader = TextLoader(tempfile.name)
-        documents = loader.load()
-
-    file_content = documents[0].page_content
+    model = get_chat_model()
 
+    file_content = read_text_file(file)
 
     # Set up a parser + inject instructions into the prompt template.
     parser = PydanticOutputParser(pydantic_object=MultiChoiceQuizFormat)
@@ -124,22 +121,19 @@ def execute_llm_prompt_langchain(number_of_questions: int, quiz_name: str, file)
 
     return output.model_dump()
 
-def execute_llm_prompt_pdf(number_of_questions: int, quiz_name: str, file):
-
-    model = ChatOpenAI(model="gpt-4o-mini", api_key=settings.OPEN_API_KEY)
+def execute_llm_prompt_pdf(number_of_questions: int, quiz_name: str, file, chunked: Optional[bool] = None):
 
-    with NamedTemporaryFile() as tempfile:
+    model = get_chat_model()
 
-        tempfile.write(file.read())
-        tempfile.seek(0)
+    file_content = " ".join(page_content for _, page_content in iter_pdf_pages(file))
 
-        loader = PyPDFLoader(tempfile.name)
-        pages = []
+    if chunked is None:
+        chunked = len(file_content) > settings.QUIZ_CHUNKED_THRESHOLD
 
-        for page in loader.lazy_load():
-            pages.append(page.page_content)
+    if chunked:
+        return execute_llm_prompt_chunked(number_of_questions=number_of_questions, quiz_name=quiz_name,
+                                          file_content=file_content, model=model)
 
-    file_content = " ".join(pages)
     # Set up a parser + inject instructions into the prompt template.
     parser = PydanticOutputParser(pydantic_object=MultiChoiceQuizFormat)
 
@@ -156,3 +150,102 @@ def execute_llm_prompt_pdf(number_of_questions: int, quiz_name: str, file):
     return output.model_dump()
 
 
+def execute_llm_prompt_chunked(number_of_questions: int, quiz_name: str, file_content: str, model):
+    """
+    Map-reduce generation for documents too large for a single prompt. Candidate questions are generated for
+    each chunk concurrently, then deduplicated and cut down to number_of_questions.
+    """
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=settings.QUIZ_CHUNK_SIZE,  # Maximum number of characters in each chunk
+        chunk_overlap=20,  # Number of characters to overlap between chunks
+        length_function=len,  # Use standard Python len() function to measure chunk size
+        separators=["\n\n", "\n", " ", ""]  # Progressively try these separators
+    )
+
+    chunks = sample_chunks(text_splitter.split_text(file_content), max_chunks=settings.QUIZ_MAX_CHUNKS)
+
+    if not chunks:
+        raise ValueError("No text found in document")
+
+    # Ask for one more question than an even share so there is room to drop duplicates
+    questions_per_chunk = math.ceil(number_of_questions / len(chunks)) + 1
+
+    parser = PydanticOutputParser(pydantic_object=MultiChoiceQuizFormat)
+
+    prompt = PromptTemplate(
+        template=test_input,
+        input_variables=["number_of_questions", "response_json", "quiz_name", "file_content"],
+    )
+
+    chain = prompt | model | parser
+
+    inputs = [{"number_of_questions": questions_per_chunk, "response_json": example_response_json,
+               "quiz_name": quiz_name, "file_content": chunk} for chunk in chunks]
+
+    outputs = chain.batch(inputs, config={"max_concurrency": settings.QUIZ_CHUNK_MAX_CONCURRENCY},
+                          return_exceptions=True)
+
+    candidate_lists = []
+
+    for output in outputs:
+        if isinstance(output, Exception):
+            logger.error(output)
+            continue
+        candidate_lists.append(output.items)
+
+    if not candidate_lists:
+        raise Exception("Every chunk failed to generate questions")
+
+    items = select_quiz_questions(candidate_lists=candidate_lists, number_of_questions=number_of_questions)
+
+    return MultiChoiceQuizFormat(quiz_name=quiz_name, items=items).model_dump()
+
+
+def sample_chunks(chunks: List[str], max_chunks: int):
+    """
+    Evenly spaced selection of at most max_chunks chunks so very large documents still finish in a single
+    round of concurrent calls.
+    """
+
+    if len(chunks) <= max_chunks:
+        return chunks
+
+    step = len(chunks) / max_chunks
+
+    return [chunks[int(i * step)] for i in range(max_chunks)]
+
+
+def normalise_question_text(question: str):
+    return re.sub(r"[^a-z0-9]+", " ", question.casefold()).strip()
+
+
+def select_quiz_questions(candidate_lists: List[List[MultiChoiceQuestion]], number_of_questions: int):
+    """
+    Picks questions round-robin across the chunk results so the quiz covers the whole document. Duplicate
+    questions and questions whose correct answer is not one of the options are skipped.
+    """
+
+    selected = []
+    seen = set()
+
+    for round_number in range(max(len(candidates) for candidates in candidate_lists)):
+
+        for candidates in candidate_lists:
+
+            if len(selected) == number_of_questions:
+                break
+
+            if round_number >= len(candidates):
+                continue
+
+            question = candidates[round_number]
+            key = normalise_question_text(question.question)
+
+            if key in seen or question.correct_answer not in question.answers:
+                continue
+
+            seen.add(key)
+            selected.append(question.model_copy(update={"question_number": len(selected) + 1}))
+
+    return selected
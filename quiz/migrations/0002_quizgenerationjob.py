@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-17 11:48
+
+import django.db.models.deletion
+import quiz.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuizGenerationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quiz_name', models.CharField(max_length=128)),
+                ('number_of_questions', models.IntegerField(default=1)),
+                ('upload_file', models.FileField(blank=True, null=True, upload_to=quiz.models.quiz_job_directory_path)),
+                ('status', models.CharField(choices=[('uploaded', 'Uploaded'), ('processing', 'Processing'), ('completed', 'Completed'), ('error', 'Error')], default='uploaded', max_length=20)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error_message', models.CharField(blank=True, max_length=255, null=True)),
+                ('datetime_added', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
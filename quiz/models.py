@@ -24,3 +24,48 @@ class Answer(models.Model):
     correct = models.BooleanField(default=False)
     selected = models.BooleanField(default=False)
     answer_number = models.IntegerField(default=0)
+
+
+STATUS_CHOICES = [
+        ('uploaded', 'Uploaded'),
+        ('processing', 'Processing'),
+        ('completed', 'Completed'),
+        ('error', 'Error'),
+    ]
+
+def quiz_job_directory_path(instance, filename):
+    # file will be uploaded to MEDIA_ROOT / quiz_jobs / user_<id>/<filename>
+    return 'quiz_jobs/user_{0}/{1}'.format(instance.user.id, filename)
+
+class QuizGenerationJob(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    quiz_name = models.CharField(max_length=128)
+    number_of_questions = models.IntegerField(default=1)
+    upload_file = models.FileField(upload_to=quiz_job_directory_path, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploaded')
+    result = models.JSONField(null=True, blank=True)
+    error_message = models.CharField(max_length=255, null=True, blank=True)
+    datetime_added = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.quiz_name} ({self.status})"
+
+
+class CachedQuiz(models.Model):
+    # sha256 of the uploaded file bytes, number of questions, file type and prompt template version
+    key = models.CharField(max_length=64, unique=True)
+    result = models.JSONField()
+    hits = models.IntegerField(default=0)
+    datetime_added = models.DateTimeField(auto_now_add=True)
+    last_accessed = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
+
+
+class QuizCacheCounter(models.Model):
+    name = models.CharField(max_length=20, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
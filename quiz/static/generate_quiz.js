@@ -66,6 +66,54 @@ const generateQuiz = (event) => {
             });
             return
         }
+
+        if (data.error){
+            throw new Error(data.error);
+        }
+
+        // Quiz is generated in the background so poll the job until it is finished
+        return pollQuizJob(data['status_url'], data['timeout']).then(renderQuiz);
+    }
+        ).catch(error => {
+            const quizContainer = document.getElementById('new_quiz_elems');
+            // Create the error heading
+            const errorElement = document.createElement('h2');
+            errorElement.textContent = `Cannot generate quiz at the moment please try again later`;
+            quizContainer.appendChild(errorElement);
+
+
+    })
+}
+
+const pollQuizJob = (statusUrl, timeout, interval = 2000) => {
+    // The server fails the job after timeout seconds, stop a little after that in case it never answers with it
+    const deadline = Date.now() + (timeout + 30) * 1000;
+
+    return new Promise((resolve, reject) => {
+        const checkStatus = () => {
+            if (Date.now() > deadline){
+                reject(new Error('Quiz generation timed out'));
+                return;
+            }
+
+            fetch(statusUrl)
+            .then(response => response.json())
+            .then(data => {
+                if (data.status === 'completed'){
+                    resolve(data.quiz);
+                } else if (data.status === 'error'){
+                    reject(new Error(data.error));
+                } else {
+                    setTimeout(checkStatus, interval);
+                }
+            })
+            .catch(reject);
+        }
+        checkStatus();
+    });
+}
+
+const renderQuiz = (data) => {
         // Handle the parsed JSON data here
         const items = data['items']
         const wholeQuiz = document.createElement('input');
@@ -153,17 +201,6 @@ const generateQuiz = (event) => {
         quizContainer.appendChild(saveQuizLink);
         quizContainer.appendChild(wholeQuiz);
         quizContainer.appendChild(quiz_name);
-
-            }
-        ).catch(error => {
-            const quizContainer = document.getElementById('new_quiz_elems');
-            // Create the error heading
-            const errorElement = document.createElement('h2');
-            errorElement.textContent = `Cannot generate quiz at the moment please try again later`;
-            quizContainer.appendChild(errorElement);
-
-
-    })
 }
 
 
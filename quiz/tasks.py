@@ -0,0 +1,118 @@
+from celery import shared_task
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from quiz.cache import get_quiz_cache_key, get_cached_quiz, store_cached_quiz
+from quiz.llm_integration import execute_llm_prompt_langchain, execute_llm_prompt_pdf
+from quiz.models import QuizGenerationJob
+
+logger = logging.getLogger("django_mcq")
+
+
+@shared_task
+def generate_quiz_from_file(job_pk: int):
+
+    try:
+        job = QuizGenerationJob.objects.get(pk=job_pk)
+    except QuizGenerationJob.DoesNotExist:
+        raise Exception("Quiz generation job not found.")
+
+    if job.status == "error":
+        # It waited in the queue past QUIZ_JOB_TIMEOUT and the user has already been told it failed
+        return job.status
+
+    job.status = "processing"
+    job.save(update_fields=["status"])
+
+    pdf = job.upload_file.name.endswith('.pdf')
+
+    try:
+        with job.upload_file.open('rb') as file:
+
+            cache_key = get_quiz_cache_key(file=file, number_of_questions=job.number_of_questions,
+                                           file_type="pdf" if pdf else "txt")
+            llm_quiz_data = get_cached_quiz(cache_key)
+            cache_hit = llm_quiz_data is not None
+
+            if not cache_hit and not pdf:
+                llm_quiz_data = execute_llm_prompt_langchain(number_of_questions=job.number_of_questions,
+                                                             quiz_name=job.quiz_name, file=file)
+            elif not cache_hit:
+                llm_quiz_data = execute_llm_prompt_pdf(number_of_questions=job.number_of_questions,
+                                                       quiz_name=job.quiz_name, file=file)
+
+    except Exception as e:
+        logger.error(e)
+        job.status = "error"
+        job.error_message = "Error from llm integration"
+
+    else:
+        if isinstance(llm_quiz_data, dict):
+
+            if not cache_hit:
+                try:
+                    store_cached_quiz(key=cache_key, result=llm_quiz_data)
+                except Exception as e:
+                    # A failed cache write shouldn't lose the quiz that has already been paid for
+                    logger.error(e)
+
+            if not pdf or cache_hit:
+                # Force it to have quiz name of user input
+                llm_quiz_data['quiz_name'] = job.quiz_name
+
+            job.status = "completed"
+            job.result = llm_quiz_data
+        else:
+            logger.error(f"Unexpected llm response type {type(llm_quiz_data)}")
+            job.status = "error"
+            job.error_message = "Error when trying to make a JSONResponse."
+
+    finally:
+        # The uploaded file is only needed to build the prompt so don't keep it around
+        job.upload_file.delete(save=False)
+
+    job.save()
+
+    try:
+        prune_quiz_generation_jobs()
+    except Exception as e:
+        logger.error(e)
+
+    return job.status
+
+
+def expire_stale_quiz_job(job: QuizGenerationJob) -> QuizGenerationJob:
+    """
+    Fails a job that is still unfinished QUIZ_JOB_TIMEOUT seconds after it was created, its worker has most likely
+    died with it. Only marked if it hasn't finished in the meantime so a late result isn't overwritten.
+    """
+
+    cutoff = timezone.now() - timedelta(seconds=settings.QUIZ_JOB_TIMEOUT)
+
+    if job.status not in ("uploaded", "processing") or job.datetime_added >= cutoff:
+        return job
+
+    expired = QuizGenerationJob.objects.filter(pk=job.pk, status__in=("uploaded", "processing")).update(
+        status="error", error_message="Quiz generation timed out")
+    job.refresh_from_db()
+
+    if expired and job.upload_file:
+        job.upload_file.delete()
+
+    return job
+
+
+def prune_quiz_generation_jobs() -> int:
+    """Deletes jobs older than QUIZ_JOB_RETENTION along with any upload they still hold."""
+
+    stale_jobs = QuizGenerationJob.objects.filter(
+        datetime_added__lt=timezone.now() - timedelta(seconds=settings.QUIZ_JOB_RETENTION))
+
+    for job in stale_jobs.exclude(upload_file="").exclude(upload_file__isnull=True).iterator():
+        job.upload_file.delete(save=False)
+
+    return stale_jobs.delete()[0]
@@ -1,13 +1,36 @@
 from io import BytesIO
 import json
-from unittest.mock import patch
-
-from django.db import transaction
-from django.test import TestCase, Client
+import multiprocessing
+import os
+import shutil
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from tempfile import NamedTemporaryFile
+from unittest import TestCase as unittestTestCase
+from unittest.mock import MagicMock, patch
+
+import billiard
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile, UploadedFile
 from django.contrib.auth.models import User
-
-from quiz.models import Quiz, Question, Answer
+from django.urls import reverse
+from django.utils import timezone
+from langchain_core.language_models import FakeListChatModel
+from pypdf import PdfReader
+
+from MCQ_Generator.document_extraction import (extract_page_range, get_pdf_process_pool, iter_pdf_pages,
+                                                read_text_file)
+
+from quiz.llm_integration import (MultiChoiceQuestion, execute_llm_prompt_chunked, sample_chunks,
+                                  select_quiz_questions)
+from quiz.cache import get_cached_quiz, store_cached_quiz
+from quiz.models import Quiz, Question, Answer, QuizGenerationJob, CachedQuiz, QuizCacheCounter
 from quiz.forms import QuizForm
+from quiz.tasks import generate_quiz_from_file
 
 
 
@@ -99,6 +122,37 @@ error_request_json = """
 """
 
 
+def build_test_pdf(page_texts):
+    """Builds a minimal PDF with one line of Helvetica text on each page."""
+
+    font_obj = 3 + 2 * len(page_texts)
+    objects = [b"<</Type/Catalog/Pages 2 0 R>>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(page_texts)))
+    objects.append(f"<</Type/Pages/Kids[{kids}]/Count {len(page_texts)}>>".encode())
+
+    for i, text in enumerate(page_texts):
+        objects.append(f"<</Type/Page/MediaBox[0 0 595 842]/Parent 2 0 R/Contents {4 + 2 * i} 0 R"
+                       f"/Resources<</Font<</F1 {font_obj} 0 R>>>>>>".encode())
+        stream = f"BT /F1 12 Tf 72 712 Td ({text}) Tj ET".encode()
+        objects.append(b"<</Length %d>>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+    objects.append(b"<</Type/Font/Subtype/Type1/BaseFont/Helvetica>>")
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<</Size %d/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF" % (len(objects) + 1, xref_offset)
+
+    return pdf
+
+
 class QuizTestCase(TestCase):
 
     @classmethod
@@ -129,6 +183,14 @@ class QuizTestCase(TestCase):
                                   correct=i == 3)
             setattr(cls, f'question_3_answer_{i}', a_three)
 
+    @classmethod
+    def tearDownClass(cls):
+        # Clean up any uploaded quiz files left behind by the generate tests
+        file_path = os.path.join(settings.MEDIA_ROOT, 'quiz_jobs', f'user_{QuizTestCase.test_user.id}')
+        shutil.rmtree(file_path, ignore_errors=True)
+
+        super().tearDownClass()
+
     def setUp(self):
         # Every test needs a client.
         self.authenticated_client = Client()
@@ -173,6 +235,27 @@ class QuizTestCase(TestCase):
             self.assertEqual(
                 list(response.context['quiz_data'][index]['answers']), list(quiz_data[index]['answers']))
 
+    def test_quiz_detail_query_count_does_not_grow_with_questions(self):
+        large_quiz = Quiz.objects.create(title='large quiz', user=QuizTestCase.test_user)
+        for i in range(1, 21):
+            question = Question.objects.create(question_text=f'large_question_{i}', question_number=i, quiz=large_quiz)
+            Answer.objects.bulk_create([
+                Answer(answer_text=f'large_answer_{j}', answer_number=j, question=question, correct=j == 1)
+                for j in range(1, 5)
+            ])
+
+        # savepoint pair from ATOMIC_REQUESTS, session, user, quiz, questions and one prefetch query for every answer
+        with self.assertNumQueries(7):
+            response = self.authenticated_client.get(f'/quiz/{QuizTestCase.test_quiz.pk}')
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(7):
+            response = self.authenticated_client.get(f'/quiz/{large_quiz.pk}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['quiz_data']), 20)
+        self.assertEqual([answer.answer_number for answer in response.context['quiz_data'][0]['answers']],
+                         [1, 2, 3, 4])
+
     def test_random_authenticated_client_get_quiz_detail_fail(self):
         self.random_client = Client()
         self.random_client.login(username='randomuser', password='random')
@@ -216,111 +299,64 @@ class QuizTestCase(TestCase):
         # Client not logged in so will do a redirect
         self.assertEqual(response.status_code, 302)
 
-    @patch("quiz.views.execute_llm_prompt_pdf")
-    @patch("quiz.views.execute_llm_prompt_langchain")
-    def test_generate_quiz_file_txt_success_response_quiz_name_different(self, txt_langchain, pdf_langchain):
+    @patch("quiz.views.generate_quiz_from_file.delay_on_commit")
+    def test_generate_quiz_file_txt_creates_job(self, generate_task):
         # Create a mock file
         file_content = b"Hello, this is a test file"
         mock_file = BytesIO(file_content)
         mock_file.name = "test_file.txt"
 
-        txt_langchain.return_value = json.loads(example_response_json)
-
         post_data = {"file": mock_file, "quiz_name": "Example Quiz Name Forced", "number_of_questions": 9}
 
         response = self.authenticated_client.post('/quiz/generate', post_data)
 
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(json.loads(str(response.content, 'utf-8'))['items'],
-                         json.loads(example_response_json)['items'])
-        self.assertEqual(json.loads(str(response.content, 'utf-8'))['quiz_name'],
-                         post_data['quiz_name'])
-
-        self.assertTrue(txt_langchain.called)
+        self.assertEqual(response.status_code, 202)
 
-        self.assertFalse(pdf_langchain.called)
+        response_json = json.loads(str(response.content, 'utf-8'))
+        job = QuizGenerationJob.objects.get(pk=response_json['job_id'])
 
-        txt_langchain_call_kwargs = txt_langchain.call_args[1]  # Get the kwargs from the call
+        self.assertEqual(response_json['status'], "uploaded")
+        self.assertEqual(response_json['status_url'], reverse("quiz_job_status", args=[job.pk]))
+        self.assertEqual(response_json['timeout'], settings.QUIZ_JOB_TIMEOUT)
+        self.assertEqual(job.user, QuizTestCase.test_user)
+        self.assertEqual(job.quiz_name, post_data["quiz_name"])
+        self.assertEqual(job.number_of_questions, post_data["number_of_questions"])
+        self.assertEqual(job.status, "uploaded")
+        self.assertTrue(job.upload_file.name.endswith('.txt'))
 
-        # Assert other arguments
-        self.assertEqual(txt_langchain_call_kwargs["number_of_questions"], post_data["number_of_questions"])
-        self.assertEqual(txt_langchain_call_kwargs["quiz_name"], post_data["quiz_name"])
-        self.assertEqual(txt_langchain_call_kwargs["file"].name, "test_file.txt")
+        generate_task.assert_called_once_with(job_pk=job.pk)
 
-    @patch("quiz.views.execute_llm_prompt_pdf")
-    @patch("quiz.views.execute_llm_prompt_langchain")
-    def test_generate_quiz_file_txt_success_response_quiz_name_not_different(self, txt_langchain, pdf_langchain):
-        # Create a mock file
-        file_content = b"Hello, this is a test file"
-        mock_file = BytesIO(file_content)
-        mock_file.name = "test_file.txt"
-
-        txt_langchain.return_value = json.loads(example_response_json)
-
-        post_data = {"file": mock_file, "quiz_name": "Example Quiz Name", "number_of_questions": 9}
-
-        response = self.authenticated_client.post('/quiz/generate', post_data)
-
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(json.loads(str(response.content, 'utf-8')), json.loads(example_response_json))
-
-
-        self.assertTrue(txt_langchain.called)
-
-        self.assertFalse(pdf_langchain.called)
-
-        txt_langchain_call_kwargs = txt_langchain.call_args[1]  # Get the kwargs from the call
-
-        # Assert other arguments
-        self.assertEqual(txt_langchain_call_kwargs["number_of_questions"], post_data["number_of_questions"])
-        self.assertEqual(txt_langchain_call_kwargs["quiz_name"], post_data["quiz_name"])
-        self.assertEqual(txt_langchain_call_kwargs["file"].name, "test_file.txt")
-
-
-    @patch("quiz.views.execute_llm_prompt_pdf")
-    @patch("quiz.views.execute_llm_prompt_langchain")
-    def test_generate_quiz_file_pdf_success_response(self, txt_langchain, pdf_langchain):
+    @patch("quiz.views.generate_quiz_from_file.delay_on_commit")
+    def test_generate_quiz_file_pdf_creates_job(self, generate_task):
         # Create a mock file
         file_content = b"%PDF-1.4\n%Test PDF Content"
 
         pdf_file = BytesIO(file_content)
         pdf_file.name = "test.pdf"  # Name the file
 
-        pdf_langchain.return_value = json.loads(example_response_json)
-
         post_data = {"file": pdf_file, "quiz_name": "Example Quiz Name", "number_of_questions": 9}
 
         response = self.authenticated_client.post('/quiz/generate', post_data)
 
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(json.loads(str(response.content, 'utf-8')), json.loads(example_response_json))
-
-        self.assertTrue(pdf_langchain.called)
+        self.assertEqual(response.status_code, 202)
 
-        self.assertFalse(txt_langchain.called)
+        job = QuizGenerationJob.objects.get(pk=json.loads(str(response.content, 'utf-8'))['job_id'])
+        self.assertTrue(job.upload_file.name.endswith('.pdf'))
 
-        pdf_langchain_call_kwargs = pdf_langchain.call_args[1]  # Get the kwargs from the call
-
-        # Assert other arguments
-        self.assertEqual(pdf_langchain_call_kwargs["number_of_questions"], post_data["number_of_questions"])
-        self.assertEqual(pdf_langchain_call_kwargs["quiz_name"], post_data["quiz_name"])
-        self.assertEqual(pdf_langchain_call_kwargs["file"].name, "test.pdf")
+        generate_task.assert_called_once_with(job_pk=job.pk)
 
     def test_unauthenticated_client_generate_quiz(self):
         response = self.unauthenticated_client.get('/quiz/generate')
         # Client not logged in so will do a redirect
         self.assertEqual(response.status_code, 302)
 
-    @patch("quiz.views.execute_llm_prompt_pdf")
-    @patch("quiz.views.execute_llm_prompt_langchain")
-    def test_generate_quiz_file_txt_form_not_valid_number_of_questions_missing(self, txt_langchain, pdf_langchain):
+    @patch("quiz.views.generate_quiz_from_file.delay_on_commit")
+    def test_generate_quiz_file_txt_form_not_valid_number_of_questions_missing(self, generate_task):
         # Create a mock file
         file_content = b"Hello, this is a test file"
         mock_file = BytesIO(file_content)
         mock_file.name = "test_file.txt"
 
-        txt_langchain.return_value = json.loads(example_response_json)
-
         post_data = {"file": mock_file, "quiz_name": "Example Quiz Name"}
 
         response = self.authenticated_client.post('/quiz/generate', post_data)
@@ -336,45 +372,259 @@ class QuizTestCase(TestCase):
             self.assertIsInstance(v, list)
             self.assertTrue(v)
 
-    @patch("quiz.views.execute_llm_prompt_pdf")
-    @patch("quiz.views.execute_llm_prompt_langchain", side_effect=Exception)
-    def test_generate_quiz_file_txt_llm_prompt_langchain_function_raises_exception(self, txt_langchain, pdf_langchain):
-        # Create a mock file
-        file_content = b"Hello, this is a test file"
-        mock_file = BytesIO(file_content)
-        mock_file.name = "test_file.txt"
+        self.assertFalse(QuizGenerationJob.objects.exists())
+        generate_task.assert_not_called()
 
-        post_data = {"file": mock_file, "quiz_name": "Example Quiz Name", "number_of_questions": 9}
+    def create_generation_job(self, name="test_file.txt", content=b"Hello, this is a test file",
+                              quiz_name="Example Quiz Name Forced"):
+        return QuizGenerationJob.objects.create(
+            user=QuizTestCase.test_user, quiz_name=quiz_name, number_of_questions=9,
+            upload_file=SimpleUploadedFile(name=name, content=content))
 
-        response = self.authenticated_client.post('/quiz/generate', post_data)
+    @patch("quiz.tasks.execute_llm_prompt_pdf")
+    @patch("quiz.tasks.execute_llm_prompt_langchain")
+    def test_generate_quiz_task_file_txt_success_quiz_name_different(self, txt_langchain, pdf_langchain):
+        job = self.create_generation_job()
+        file_path = job.upload_file.path
+
+        txt_langchain.return_value = json.loads(example_response_json)
+
+        output = generate_quiz_from_file(job_pk=job.pk)
+
+        job.refresh_from_db()
+
+        self.assertEqual(output, "completed")
+        self.assertEqual(job.status, "completed")
+        self.assertEqual(job.result['items'], json.loads(example_response_json)['items'])
+        self.assertEqual(job.result['quiz_name'], "Example Quiz Name Forced")
+        # The uploaded file is removed once the prompt has been built
+        self.assertFalse(job.upload_file)
+        self.assertFalse(os.path.exists(file_path))
 
-        self.assertEqual(response.status_code, 500)
         self.assertTrue(txt_langchain.called)
         self.assertFalse(pdf_langchain.called)
-        self.assertEqual(json.loads(str(response.content, 'utf-8'))['error'],"Error from llm integration")
 
-    @patch("quiz.views.execute_llm_prompt_pdf")
-    @patch("quiz.views.execute_llm_prompt_langchain")
-    def test_generate_quiz_file_txt_llm_prompt_langchain_successful_type_error_raises_on_json_response(
-            self, txt_langchain, pdf_langchain):
+        txt_langchain_call_kwargs = txt_langchain.call_args[1]  # Get the kwargs from the call
 
-        # Create a mock file
-        file_content = b"Hello, this is a test file"
-        mock_file = BytesIO(file_content)
-        mock_file.name = "test_file.txt"
+        # Assert other arguments
+        self.assertEqual(txt_langchain_call_kwargs["number_of_questions"], 9)
+        self.assertEqual(txt_langchain_call_kwargs["quiz_name"], "Example Quiz Name Forced")
 
-        txt_langchain.return_value = example_response_json
+    @patch("quiz.tasks.execute_llm_prompt_pdf")
+    @patch("quiz.tasks.execute_llm_prompt_langchain")
+    def test_generate_quiz_task_file_txt_success_quiz_name_not_different(self, txt_langchain, pdf_langchain):
+        job = self.create_generation_job(quiz_name="Example Quiz Name")
 
-        post_data = {"file": mock_file, "quiz_name": "Example Quiz Name", "number_of_questions": 9}
+        txt_langchain.return_value = json.loads(example_response_json)
 
-        response = self.authenticated_client.post('/quiz/generate', post_data)
+        generate_quiz_from_file(job_pk=job.pk)
 
-        self.assertEqual(response.status_code, 500)
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, "completed")
+        self.assertEqual(job.result, json.loads(example_response_json))
         self.assertTrue(txt_langchain.called)
         self.assertFalse(pdf_langchain.called)
-        self.assertEqual(json.loads(str(response.content, 'utf-8'))['error'],
-                         "Error when trying to make a JSONResponse.")
 
+    @patch("quiz.tasks.execute_llm_prompt_pdf")
+    @patch("quiz.tasks.execute_llm_prompt_langchain")
+    def test_generate_quiz_task_file_pdf_success(self, txt_langchain, pdf_langchain):
+        job = self.create_generation_job(name="test.pdf", content=b"%PDF-1.4\n%Test PDF Content",
+                                         quiz_name="Example Quiz Name")
+
+        pdf_langchain.return_value = json.loads(example_response_json)
+
+        generate_quiz_from_file(job_pk=job.pk)
+
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, "completed")
+        self.assertEqual(job.result, json.loads(example_response_json))
+        self.assertTrue(pdf_langchain.called)
+        self.assertFalse(txt_langchain.called)
+
+        pdf_langchain_call_kwargs = pdf_langchain.call_args[1]  # Get the kwargs from the call
+
+        self.assertEqual(pdf_langchain_call_kwargs["number_of_questions"], 9)
+        self.assertEqual(pdf_langchain_call_kwargs["quiz_name"], "Example Quiz Name")
+
+    @patch("quiz.tasks.execute_llm_prompt_pdf")
+    @patch("quiz.tasks.execute_llm_prompt_langchain", side_effect=Exception)
+    def test_generate_quiz_task_llm_prompt_langchain_function_raises_exception(self, txt_langchain, pdf_langchain):
+        job = self.create_generation_job()
+
+        output = generate_quiz_from_file(job_pk=job.pk)
+
+        job.refresh_from_db()
+
+        self.assertEqual(output, "error")
+        self.assertEqual(job.status, "error")
+        self.assertEqual(job.error_message, "Error from llm integration")
+        self.assertIsNone(job.result)
+        self.assertTrue(txt_langchain.called)
+        self.assertFalse(pdf_langchain.called)
+
+    @patch("quiz.tasks.execute_llm_prompt_pdf")
+    @patch("quiz.tasks.execute_llm_prompt_langchain")
+    def test_generate_quiz_task_llm_prompt_langchain_returns_non_dict(self, txt_langchain, pdf_langchain):
+        job = self.create_generation_job()
+
+        txt_langchain.return_value = example_response_json
+
+        generate_quiz_from_file(job_pk=job.pk)
+
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, "error")
+        self.assertEqual(job.error_message, "Error when trying to make a JSONResponse.")
+        self.assertIsNone(job.result)
+
+    @patch("quiz.tasks.execute_llm_prompt_pdf")
+    @patch("quiz.tasks.execute_llm_prompt_langchain")
+    def test_generate_quiz_task_cache_hit_skips_llm(self, txt_langchain, pdf_langchain):
+        txt_langchain.return_value = json.loads(example_response_json)
+
+        first_job = self.create_generation_job(quiz_name="First Quiz Name")
+        generate_quiz_from_file(job_pk=first_job.pk)
+
+        second_job = self.create_generation_job(quiz_name="Second Quiz Name")
+        generate_quiz_from_file(job_pk=second_job.pk)
+
+        second_job.refresh_from_db()
+
+        txt_langchain.assert_called_once()
+        self.assertEqual(second_job.status, "completed")
+        self.assertEqual(second_job.result['items'], json.loads(example_response_json)['items'])
+        self.assertEqual(second_job.result['quiz_name'], "Second Quiz Name")
+
+        self.assertEqual(CachedQuiz.objects.count(), 1)
+        self.assertEqual(CachedQuiz.objects.first().hits, 1)
+        self.assertEqual(QuizCacheCounter.objects.get(name="hits").value, 1)
+        self.assertEqual(QuizCacheCounter.objects.get(name="misses").value, 1)
+
+    @patch("quiz.tasks.execute_llm_prompt_pdf")
+    @patch("quiz.tasks.execute_llm_prompt_langchain")
+    def test_generate_quiz_task_cache_miss_different_number_of_questions(self, txt_langchain, pdf_langchain):
+        txt_langchain.return_value = json.loads(example_response_json)
+
+        first_job = self.create_generation_job()
+        generate_quiz_from_file(job_pk=first_job.pk)
+
+        second_job = self.create_generation_job()
+        second_job.number_of_questions = 5
+        second_job.save()
+        generate_quiz_from_file(job_pk=second_job.pk)
+
+        self.assertEqual(txt_langchain.call_count, 2)
+        self.assertEqual(CachedQuiz.objects.count(), 2)
+        self.assertFalse(QuizCacheCounter.objects.filter(name="hits").exists())
+        self.assertEqual(QuizCacheCounter.objects.get(name="misses").value, 2)
+
+    @override_settings(QUIZ_CACHE_TTL=0)
+    def test_get_cached_quiz_expired_entry_is_a_miss(self):
+        store_cached_quiz(key="expired_key", result=json.loads(example_response_json))
+
+        self.assertIsNone(get_cached_quiz("expired_key"))
+
+    @override_settings(QUIZ_CACHE_MAX_ENTRIES=2)
+    def test_store_cached_quiz_evicts_least_recently_used(self):
+        store_cached_quiz(key="key_1", result={"quiz_name": "1"})
+        store_cached_quiz(key="key_2", result={"quiz_name": "2"})
+
+        # Reading key_1 makes key_2 the least recently used entry
+        self.assertEqual(get_cached_quiz("key_1"), {"quiz_name": "1"})
+
+        store_cached_quiz(key="key_3", result={"quiz_name": "3"})
+
+        self.assertEqual(set(CachedQuiz.objects.values_list('key', flat=True)), {"key_1", "key_3"})
+
+    def test_quiz_job_status_completed(self):
+        job = QuizGenerationJob.objects.create(user=QuizTestCase.test_user, quiz_name="Example Quiz Name",
+                                               status="completed", result=json.loads(example_response_json))
+
+        response = self.authenticated_client.get(reverse("quiz_job_status", args=[job.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(str(response.content, 'utf-8')),
+                         {"status": "completed", "quiz": json.loads(example_response_json)})
+
+    def test_quiz_job_status_processing(self):
+        job = QuizGenerationJob.objects.create(user=QuizTestCase.test_user, quiz_name="Example Quiz Name",
+                                               status="processing")
+
+        response = self.authenticated_client.get(reverse("quiz_job_status", args=[job.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(str(response.content, 'utf-8')), {"status": "processing"})
+
+    def test_quiz_job_status_error(self):
+        job = QuizGenerationJob.objects.create(user=QuizTestCase.test_user, quiz_name="Example Quiz Name",
+                                               status="error", error_message="Error from llm integration")
+
+        response = self.authenticated_client.get(reverse("quiz_job_status", args=[job.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(str(response.content, 'utf-8')),
+                         {"status": "error", "error": "Error from llm integration"})
+
+    def test_quiz_job_status_times_out_abandoned_job(self):
+        job = self.create_generation_job()
+        job.status = "processing"
+        job.save()
+        file_path = job.upload_file.path
+        QuizGenerationJob.objects.filter(pk=job.pk).update(
+            datetime_added=timezone.now() - timedelta(seconds=settings.QUIZ_JOB_TIMEOUT + 1))
+
+        response = self.authenticated_client.get(reverse("quiz_job_status", args=[job.pk]))
+
+        self.assertEqual(json.loads(str(response.content, 'utf-8')),
+                         {"status": "error", "error": "Quiz generation timed out"})
+        job.refresh_from_db()
+        self.assertEqual(job.status, "error")
+        self.assertFalse(job.upload_file)
+        self.assertFalse(os.path.exists(file_path))
+
+    @patch("quiz.tasks.execute_llm_prompt_langchain")
+    def test_generate_quiz_task_skips_timed_out_job(self, txt_langchain):
+        job = self.create_generation_job()
+        job.status = "error"
+        job.save()
+
+        self.assertEqual(generate_quiz_from_file(job_pk=job.pk), "error")
+
+        txt_langchain.assert_not_called()
+
+    @patch("quiz.tasks.execute_llm_prompt_langchain")
+    def test_generate_quiz_task_prunes_old_jobs(self, txt_langchain):
+        txt_langchain.return_value = json.loads(example_response_json)
+        old_job = self.create_generation_job()
+        old_file_path = old_job.upload_file.path
+        QuizGenerationJob.objects.filter(pk=old_job.pk).update(
+            datetime_added=timezone.now() - timedelta(seconds=settings.QUIZ_JOB_RETENTION + 1))
+        job = self.create_generation_job()
+
+        generate_quiz_from_file(job_pk=job.pk)
+
+        self.assertFalse(QuizGenerationJob.objects.filter(pk=old_job.pk).exists())
+        self.assertFalse(os.path.exists(old_file_path))
+        self.assertTrue(QuizGenerationJob.objects.filter(pk=job.pk).exists())
+
+    def test_quiz_job_status_different_user(self):
+        job = QuizGenerationJob.objects.create(user=QuizTestCase.test_user, quiz_name="Example Quiz Name",
+                                               status="completed", result=json.loads(example_response_json))
+        self.random_client = Client()
+        self.random_client.login(username='randomuser', password='random')
+
+        response = self.random_client.get(reverse("quiz_job_status", args=[job.pk]))
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_unauthenticated_client_quiz_job_status(self):
+        job = QuizGenerationJob.objects.create(user=QuizTestCase.test_user, quiz_name="Example Quiz Name")
+
+        response = self.unauthenticated_client.get(reverse("quiz_job_status", args=[job.pk]))
+
+        self.assertEqual(response.status_code, 302)
 
     def test_generate_quiz_get_request_returns_forbidden(self):
         # Simulate a POST request to the view
@@ -494,6 +744,26 @@ class QuizTestCase(TestCase):
             else:
                 self.assertFalse(answer_2.correct)
 
+    def test_save_method_bulk_inserts_questions_and_answers(self):
+        ten_question_quiz = json.dumps([
+            {"question": f"Question {i}", "answers": ["A", "B", "C", "D"], "question_number": i,
+             "correct_answer": "B"} for i in range(1, 11)])
+        post_data = {"whole_quiz": ten_question_quiz, "quiz_name_user": "Ten Question Quiz"}
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.authenticated_client.post('/quiz/save', post_data)
+
+        self.assertEqual(response.status_code, 302)
+
+        # One INSERT each for the quiz, all of its questions and all of its answers
+        inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+
+        new_quiz_obj = Quiz.objects.get(title="Ten Question Quiz", user=QuizTestCase.test_user)
+        self.assertEqual(Question.objects.filter(quiz=new_quiz_obj).count(), 10)
+        self.assertEqual(Answer.objects.filter(question__quiz=new_quiz_obj).count(), 40)
+        self.assertEqual(Answer.objects.filter(question__quiz=new_quiz_obj, correct=True).count(), 10)
+
     def test_save_method_invalid_json_error(self):
         post_data = {"whole_quiz": error_request_json, "quiz_name_user": "New Test Quiz Name"}
         quiz_queryset = Quiz.objects.filter(title="New Test Quiz Name", user=QuizTestCase.test_user)
@@ -550,3 +820,186 @@ class QuizTestCase(TestCase):
         response = self.unauthenticated_client.post(f'/quiz/save', post_data)
         # Client not logged in so will do a redirect
         self.assertEqual(response.status_code, 302)
+
+
+class LLMIntegrationHelpersTestCase(unittestTestCase):
+
+    def make_question(self, text, correct_answer="A", question_number=1):
+        return MultiChoiceQuestion(question=text, answers=["A", "B", "C", "D"], question_number=question_number,
+                                   correct_answer=correct_answer)
+
+    def test_sample_chunks_returns_all_chunks_under_limit(self):
+        chunks = ["chunk_1", "chunk_2", "chunk_3"]
+        self.assertEqual(sample_chunks(chunks, max_chunks=5), chunks)
+
+    def test_sample_chunks_evenly_spaced_over_limit(self):
+        chunks = [f"chunk_{i}" for i in range(100)]
+        sampled = sample_chunks(chunks, max_chunks=4)
+        self.assertEqual(sampled, ["chunk_0", "chunk_25", "chunk_50", "chunk_75"])
+
+    def test_select_quiz_questions_round_robin_and_renumbered(self):
+        candidate_lists = [
+            [self.make_question("Chunk one question one"), self.make_question("Chunk one question two")],
+            [self.make_question("Chunk two question one"), self.make_question("Chunk two question two")],
+        ]
+
+        selected = select_quiz_questions(candidate_lists=candidate_lists, number_of_questions=3)
+
+        self.assertEqual([q.question for q in selected],
+                         ["Chunk one question one", "Chunk two question one", "Chunk one question two"])
+        self.assertEqual([q.question_number for q in selected], [1, 2, 3])
+
+    def test_select_quiz_questions_skips_duplicates_and_bad_answers(self):
+        candidate_lists = [
+            [self.make_question("What is the capital of France?"), self.make_question("Bad", correct_answer="E")],
+            [self.make_question("what is the capital of france"), self.make_question("Another question")],
+        ]
+
+        selected = select_quiz_questions(candidate_lists=candidate_lists, number_of_questions=4)
+
+        self.assertEqual([q.question for q in selected], ["What is the capital of France?", "Another question"])
+
+    @patch("quiz.llm_integration.settings")
+    def test_execute_llm_prompt_chunked_dedupes_across_chunks(self, mock_settings):
+        mock_settings.QUIZ_CHUNK_SIZE = 100
+        mock_settings.QUIZ_MAX_CHUNKS = 10
+        mock_settings.QUIZ_CHUNK_MAX_CONCURRENCY = 2
+
+        file_content = " ".join(["word"] * 200)
+        # Every chunk returns the same two questions so only two survive
+        model = FakeListChatModel(responses=[example_response_json] * 10)
+
+        output = execute_llm_prompt_chunked(number_of_questions=5, quiz_name="Chunked Quiz",
+                                            file_content=file_content, model=model)
+
+        self.assertEqual(output["quiz_name"], "Chunked Quiz")
+        self.assertEqual(len(output["items"]), 2)
+        self.assertEqual([item["question_number"] for item in output["items"]], [1, 2])
+
+
+def extract_pages_in_worker(pdf_path):
+    with patch("MCQ_Generator.document_extraction.get_pdf_process_pool", wraps=get_pdf_process_pool) as mock_pool:
+        pages = list(iter_pdf_pages(pdf_path))
+
+    return multiprocessing.current_process().daemon, mock_pool.call_count, pages
+
+
+class DocumentExtractionTestCase(unittestTestCase):
+
+    def test_iter_pdf_pages_in_memory_upload(self):
+        upload = SimpleUploadedFile(name="test.pdf", content=build_test_pdf(["Hello page one", "Second page"]))
+
+        pages = iter_pdf_pages(upload)
+
+        self.assertIsInstance(pages, types.GeneratorType)
+        self.assertEqual(list(pages), [(0, "Hello page one"), (1, "Second page")])
+
+    def test_iter_pdf_pages_temporary_upload_reads_from_disk(self):
+        upload = TemporaryUploadedFile(name="test.pdf", content_type="application/pdf", size=0, charset=None)
+        upload.write(build_test_pdf(["Page on disk"]))
+        upload.flush()
+
+        with patch("MCQ_Generator.document_extraction.PdfReader", wraps=PdfReader) as mock_reader:
+            pages = list(iter_pdf_pages(upload))
+
+        mock_reader.assert_called_once_with(upload.temporary_file_path())
+        self.assertEqual(pages, [(0, "Page on disk")])
+        upload.close()
+
+    def test_iter_pdf_pages_file_path(self):
+        with NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            pdf_file.write(build_test_pdf(["Page from path"]))
+            pdf_file.flush()
+
+            self.assertEqual(list(iter_pdf_pages(pdf_file.name)), [(0, "Page from path")])
+
+    @override_settings(PDF_EXTRACTION_WORKERS=2, PDF_EXTRACTION_MIN_PAGES=4, PDF_EXTRACTION_PAGES_PER_TASK=2)
+    def test_iter_pdf_pages_parallel_keeps_page_order(self):
+        page_texts = [f"Parallel page {i}" for i in range(7)]
+        upload = SimpleUploadedFile(name="test.pdf", content=build_test_pdf(page_texts))
+
+        with patch("MCQ_Generator.document_extraction.get_pdf_process_pool",
+                   wraps=get_pdf_process_pool) as mock_pool:
+            pages = list(iter_pdf_pages(upload))
+
+        # Four page ranges, one pool sized for them
+        mock_pool.assert_called_once_with(4)
+
+        self.assertEqual(pages, list(enumerate(page_texts)))
+
+        with NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            pdf_file.write(build_test_pdf(page_texts))
+            pdf_file.flush()
+
+            self.assertEqual(list(iter_pdf_pages(pdf_file.name, start_page=3)), list(enumerate(page_texts))[3:])
+
+    @override_settings(PDF_EXTRACTION_WORKERS=2, PDF_EXTRACTION_MIN_PAGES=4, PDF_EXTRACTION_PAGES_PER_TASK=2)
+    def test_iter_pdf_pages_parallel_sends_workers_one_path(self):
+        page_texts = [f"Spooled page {i}" for i in range(6)]
+        upload = SimpleUploadedFile(name="test.pdf", content=build_test_pdf(page_texts))
+        pool = ThreadPoolExecutor(max_workers=2)
+
+        with patch("MCQ_Generator.document_extraction.get_pdf_process_pool", return_value=pool), \
+                patch("MCQ_Generator.document_extraction.extract_page_range",
+                      wraps=extract_page_range) as mock_extract:
+            pages = list(iter_pdf_pages(upload))
+
+        self.assertEqual(pages, list(enumerate(page_texts)))
+        # The in-memory upload is written out once and every range gets its path, not a copy of the PDF
+        pdf_paths = {call.args[0] for call in mock_extract.call_args_list}
+        self.assertEqual(mock_extract.call_count, 3)
+        self.assertEqual(len(pdf_paths), 1)
+        self.assertFalse(os.path.exists(pdf_paths.pop()))
+        # The pool is shut down once the document is done
+        self.assertTrue(pool._shutdown)
+
+    def test_iter_pdf_pages_field_file_reads_from_storage_path(self):
+        with NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            pdf_file.write(build_test_pdf(["Stored page"]))
+            pdf_file.flush()
+            field_file = MagicMock(spec=["path", "seek", "read"], path=pdf_file.name)
+
+            with patch("MCQ_Generator.document_extraction.PdfReader", wraps=PdfReader) as mock_reader:
+                pages = list(iter_pdf_pages(field_file))
+
+        mock_reader.assert_called_once_with(pdf_file.name)
+        self.assertEqual(pages, [(0, "Stored page")])
+
+    @override_settings(PDF_EXTRACTION_WORKERS=2, PDF_EXTRACTION_MIN_PAGES=4)
+    def test_iter_pdf_pages_small_file_parsed_serially(self):
+        upload = SimpleUploadedFile(name="test.pdf", content=build_test_pdf(["One", "Two", "Three"]))
+
+        with patch("MCQ_Generator.document_extraction.get_pdf_process_pool") as mock_pool:
+            pages = list(iter_pdf_pages(upload))
+
+        mock_pool.assert_not_called()
+        self.assertEqual(pages, [(0, "One"), (1, "Two"), (2, "Three")])
+
+    @override_settings(PDF_EXTRACTION_WORKERS=2, PDF_EXTRACTION_MIN_PAGES=4, PDF_EXTRACTION_PAGES_PER_TASK=2)
+    def test_iter_pdf_pages_parallel_in_daemonic_celery_worker(self):
+        page_texts = [f"Worker page {i}" for i in range(5)]
+
+        with NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            pdf_file.write(build_test_pdf(page_texts))
+            pdf_file.flush()
+
+            # Celery's prefork pool runs tasks in billiard workers like this one
+            with billiard.Pool(processes=1) as worker:
+                is_daemon, pool_calls, pages = worker.apply(extract_pages_in_worker, (pdf_file.name,))
+
+        self.assertTrue(is_daemon)
+        self.assertEqual(pool_calls, 1)
+        self.assertEqual(pages, list(enumerate(page_texts)))
+
+    def test_read_text_file_character_split_across_chunks(self):
+        # The three byte tick straddles the end of the first 64KB chunk
+        content = "a" * (UploadedFile.DEFAULT_CHUNK_SIZE - 1) + "✓ done"
+        upload = SimpleUploadedFile(name="test.txt", content=content.encode("utf-8"))
+
+        self.assertEqual(read_text_file(upload), content)
+
+    def test_read_text_file_upload(self):
+        upload = SimpleUploadedFile(name="test.txt", content="Hello, this is a test file ✓".encode("utf-8"))
+        upload.read()
+
+        self.assertEqual(read_text_file(upload), "Hello, this is a test file ✓")
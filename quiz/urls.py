@@ -8,6 +8,7 @@ urlpatterns = [
     path('<int:pk>', views.get_quiz_data, name='q_detail'),
     path('create', create_quiz, name='create_quiz'),
     path('generate', views.generate_quiz, name='generate_quiz'),
+    path('generate/<int:pk>', views.get_quiz_job_status, name='quiz_job_status'),
     path('save', views.save_quiz, name='save_quiz'),
     path('delete/<int:pk>', views.QuizDeleteView.as_view(), name='delete_quiz'),
 ]
\ No newline at end of file
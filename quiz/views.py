@@ -3,12 +3,16 @@ import json
 import logging
 
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
+from django.db import transaction
+from django.db.models import Prefetch
 from django.shortcuts import render, redirect
 from django.http import HttpResponseRedirect, JsonResponse, Http404
 from .forms import QuizForm
-from .models import Quiz, Question, Answer
-from .llm_integration import execute_llm_prompt_langchain, execute_llm_prompt_pdf
+from .models import Quiz, Question, Answer, QuizGenerationJob
+from .tasks import expire_stale_quiz_job, generate_quiz_from_file
 from .utils import handle_uploaded_file
 from django.http import HttpResponse
 from django.views.generic.list import ListView
@@ -18,7 +22,7 @@ from django.shortcuts import get_object_or_404
 from django.http import HttpResponseForbidden
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 
 logger = logging.getLogger("django_mcq")
 
@@ -43,22 +47,16 @@ def get_quiz_data(request, pk):
     quiz = get_object_or_404(Quiz, pk=pk)
 
     # Check if the logged-in user is associated with the quiz
-    if quiz.user != request.user:
+    if quiz.user_id != request.user.id:
         return HttpResponseForbidden("You are not allowed to access this quiz.")
 
     logger.debug(quiz)
 
-    # Get the questions associated with this quiz
-    questions = Question.objects.filter(quiz=quiz).order_by('question_number')
+    # Get the questions associated with this quiz along with all of their answers in a single extra query
+    questions = Question.objects.filter(quiz=quiz).order_by('question_number').prefetch_related(
+        Prefetch('answer_set', queryset=Answer.objects.order_by('answer_number'), to_attr='ordered_answers'))
 
-    # For each question, get its answers
-    quiz_data = []
-    for question in questions:
-        answers = Answer.objects.filter(question=question).order_by('answer_number')
-        quiz_data.append({
-            'question': question,
-            'answers': answers
-        })
+    quiz_data = [{'question': question, 'answers': question.ordered_answers} for question in questions]
 
     # Send the structured data to the template
     context = {
@@ -81,50 +79,35 @@ def create_quiz(request):
 
     return render(request, "quiz/create_quiz.html", {"form": form})
 
+@transaction.non_atomic_requests
 @login_required(login_url='login')
-def generate_quiz(request):
+async def generate_quiz(request):
 
     if request.method == 'POST':
         form = QuizForm(request.POST, request.FILES)
 
         if form.is_valid():
 
-            name_of_file = request.FILES['file'].name
-
-            if name_of_file.endswith('.pdf'):
-                pdf = True
-            else:
-                # file is .txt
-                pdf = False
-
+            job = QuizGenerationJob()
+            job.user = await request.auser()
+            job.quiz_name = form.cleaned_data['quiz_name']
+            job.number_of_questions = form.cleaned_data['number_of_questions']
+            job.upload_file = form.cleaned_data['file']
+            job.status = "uploaded"
 
             try:
-                if not pdf:
-                    llm_quiz_data = execute_llm_prompt_langchain(number_of_questions=form.cleaned_data['number_of_questions'],
-                                                                 quiz_name=form.cleaned_data['quiz_name'],
-                                                                 file=form.cleaned_data['file'])
-                else:
-                    llm_quiz_data = execute_llm_prompt_pdf(number_of_questions=form.cleaned_data['number_of_questions'],
-                                                                 quiz_name=form.cleaned_data['quiz_name'],
-                                                                 file=form.cleaned_data['file'])
+                await job.asave()
             except Exception as e:
                 logger.error(e)
-                return JsonResponse({"error": "Error from llm integration"}, status=500)
-
-            try:
-
-                if not pdf:
-                    # Force it to have quiz name of user input
-                    llm_quiz_data['quiz_name'] = form.cleaned_data['quiz_name']
+                return JsonResponse({"error": "Error when creating quiz generation job"}, status=500)
 
-                success_response = JsonResponse(llm_quiz_data)
-
-            except TypeError as e:
-                logger.error(e)
-                return JsonResponse({"error": "Error when trying to make a JSONResponse."}, status=500)
+            # The LLM round-trip happens on a celery worker so this request returns straight away, publishing to
+            # the broker is blocking I/O so it is done off the event loop
+            await sync_to_async(generate_quiz_from_file.delay_on_commit)(job_pk=job.pk)
 
-            else:
-                return success_response
+            return JsonResponse({"job_id": job.pk, "status": job.status,
+                                 "status_url": reverse("quiz_job_status", args=[job.pk]),
+                                 "timeout": settings.QUIZ_JOB_TIMEOUT}, status=202)
         else:
             form_errors_dict = dict(form.errors)
             return JsonResponse({"error": "Validation error", "form_errors": form_errors_dict}, status=200)
@@ -133,6 +116,20 @@ def generate_quiz(request):
         return HttpResponseForbidden('DONT HIT THIS')
 
 
+@login_required(login_url='login')
+def get_quiz_job_status(request, pk):
+
+    job = expire_stale_quiz_job(get_object_or_404(QuizGenerationJob, pk=pk, user=request.user))
+
+    if job.status == "completed":
+        return JsonResponse({"status": job.status, "quiz": job.result})
+
+    if job.status == "error":
+        return JsonResponse({"status": job.status, "error": job.error_message})
+
+    return JsonResponse({"status": job.status})
+
+
 @login_required(login_url='login')
 def save_quiz(request):
     whole_quiz = request.POST['whole_quiz']
@@ -157,21 +154,29 @@ def save_quiz(request):
         messages.error(request, f"An error occurred: {str(e)}")
         return JsonResponse({"error": "Error when saving quiz"}, status=500)
 
+    new_questions = []
+
     for question in whole_quiz_qs:
         new_question = Question()
         new_question.quiz = new_quiz
         new_question.question_text = question.get('question')
         new_question.question_number = question.get('question_number')
+        new_questions.append(new_question)
+
+    try:
+        # One INSERT for every question, bulk_create sets the primary keys the answers need
+        Question.objects.bulk_create(new_questions)
+    except Exception as e:
+        logger.error(e)
+        # I have changed the DB Setup to mean that the DB transaction only gets saved when the HTTP request is finished
+        # and not after each .save()
+        # new_quiz.delete()
+        messages.error(request, f"An error occurred: {str(e)}")
+        return JsonResponse({"error": "Error when saving question"}, status=500)
 
-        try:
-            new_question.save()
-        except Exception as e:
-            logger.error(e)
-            # I have changed the DB Setup to mean that the DB transaction only gets saved when the HTTP request is finished
-            # and not after each .save()
-            # new_quiz.delete()
-            messages.error(request, f"An error occurred: {str(e)}")
-            return JsonResponse({"error": "Error when saving question"}, status=500)
+    new_answers = []
+
+    for question, new_question in zip(whole_quiz_qs, new_questions):
 
         for answer_key, answer_value in enumerate(question['answers']):
 
@@ -185,16 +190,18 @@ def save_quiz(request):
             else:
                 new_answer.correct = False
 
-            try:
-                new_answer.save()
-            except Exception as e:
-                # Unable to test as unsure how I will hit this in a unit test
-                logger.error(e)
-                # I have changed the DB Setup to mean that the DB transaction only gets saved when the HTTP request is finished
-                # and not after each .save()
-                # new_quiz.delete()
-                messages.error(request, f"An error occurred: {str(e)}")
-                return JsonResponse({"error": "Error when saving answer"}, status=500)
+            new_answers.append(new_answer)
+
+    try:
+        Answer.objects.bulk_create(new_answers)
+    except Exception as e:
+        # Unable to test as unsure how I will hit this in a unit test
+        logger.error(e)
+        # I have changed the DB Setup to mean that the DB transaction only gets saved when the HTTP request is finished
+        # and not after each .save()
+        # new_quiz.delete()
+        messages.error(request, f"An error occurred: {str(e)}")
+        return JsonResponse({"error": "Error when saving answer"}, status=500)
 
     messages.success(request, "Data saved successfully!")
     return redirect("index")
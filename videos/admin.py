@@ -1,11 +1,11 @@
 from django.contrib import admin
 from django.db.models import Count
 
-from videos.models import Video
+from videos.models import CircuitBreaker, Video
 
 class VideoAdmin(admin.ModelAdmin):
-    list_display = ('title', 'user')
-    list_filter = ('user',)
+    list_display = ('title', 'user', 'status', 'priority', 'queued_at')
+    list_filter = ('user', 'status')
     search_fields = ('title', 'user__username')
 
     change_list_template = "admin/video_changelist.html"
@@ -26,3 +26,8 @@ class VideoAdmin(admin.ModelAdmin):
 
 admin.site.register(Video, VideoAdmin)
 
+
+class CircuitBreakerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'state', 'failure_count', 'opened_at', 'next_probe_at')
+
+admin.site.register(CircuitBreaker, CircuitBreakerAdmin)
@@ -0,0 +1,135 @@
+import logging
+from datetime import timedelta
+from functools import partial
+
+from celery import current_app
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from videos.models import CircuitBreaker
+
+logger = logging.getLogger("django_mcq")
+
+VIDEO_API_CIRCUIT = "video_api"
+
+# What acquire_video_api_permit lets the caller do
+ALLOW = "allow"
+PROBE = "probe"
+DENY = "deny"
+
+
+def get_locked_circuit(name: str = VIDEO_API_CIRCUIT) -> CircuitBreaker:
+    circuit, _ = CircuitBreaker.objects.select_for_update().get_or_create(name=name)
+    return circuit
+
+
+def acquire_video_api_permit() -> str:
+    """
+    Whether a job may be sent to the video API. While the circuit is closed every job is allowed without a health
+    check, while it is open jobs are denied until VIDEO_API_RESET_TIMEOUT has passed. After that a single worker is
+    given PROBE, it checks /health and sends its job as the trial, everyone else stays denied until the trial
+    succeeds or its VIDEO_API_PROBE_LEASE runs out.
+    """
+
+    if CircuitBreaker.objects.filter(name=VIDEO_API_CIRCUIT, state="closed").exists():
+        return ALLOW
+
+    now = timezone.now()
+
+    with transaction.atomic():
+        circuit = get_locked_circuit()
+
+        if circuit.state == "closed":
+            return ALLOW
+
+        if circuit.next_probe_at and circuit.next_probe_at > now:
+            return DENY
+
+        circuit.state = "half_open"
+        circuit.next_probe_at = now + timedelta(seconds=settings.VIDEO_API_PROBE_LEASE)
+        circuit.save()
+
+        # If this worker dies with the probe nothing would report back, the queue is looked at again once the
+        # lease has run out
+        transaction.on_commit(partial(schedule_video_api_probe, circuit.next_probe_at))
+
+    logger.info("Video API circuit is half open, probing")
+    return PROBE
+
+
+def schedule_video_api_probe(eta):
+    # Sent by name as videos.tasks imports this module
+    current_app.send_task("videos.tasks.dispatch_video_queue", eta=eta)
+
+
+def is_video_api_circuit_closed() -> bool:
+    return not CircuitBreaker.objects.filter(name=VIDEO_API_CIRCUIT).exclude(state="closed").exists()
+
+
+def get_video_api_retry_at():
+    """
+    While jobs would only be denied, i.e. the circuit is open or a probe is in flight, returns when the next probe
+    is due. None when jobs can be sent.
+    """
+
+    return CircuitBreaker.objects.filter(name=VIDEO_API_CIRCUIT, next_probe_at__gt=timezone.now()).exclude(
+        state="closed").values_list("next_probe_at", flat=True).first()
+
+
+def record_video_api_failure() -> bool:
+    """
+    Counts a failed call, VIDEO_API_FAILURE_THRESHOLD failures in a row open the circuit and a failed probe opens it
+    again. Each time it opens a dispatch is booked for next_probe_at, as with the circuit open nothing else would
+    wake the queue up. Returns True only for the failure that starts an outage, so the caller sends one alert per
+    outage.
+    """
+
+    now = timezone.now()
+
+    with transaction.atomic():
+        circuit = get_locked_circuit()
+        circuit.failure_count += 1
+
+        below_threshold = circuit.state == "closed" and circuit.failure_count < settings.VIDEO_API_FAILURE_THRESHOLD
+
+        # A call that was already in flight when the circuit opened doesn't push the probe back
+        if below_threshold or circuit.state == "open":
+            circuit.save()
+            return False
+
+        new_outage = circuit.opened_at is None
+        circuit.state = "open"
+        circuit.next_probe_at = now + timedelta(seconds=settings.VIDEO_API_RESET_TIMEOUT)
+        if new_outage:
+            circuit.opened_at = now
+        circuit.save()
+
+        transaction.on_commit(partial(schedule_video_api_probe, circuit.next_probe_at))
+
+    if new_outage:
+        logger.error(f"Video API circuit opened after {circuit.failure_count} failures")
+
+    return new_outage
+
+
+def record_video_api_success() -> bool:
+    """Closes the circuit. Returns True if it wasn't closed, so the videos held back by the outage can be requeued."""
+
+    if CircuitBreaker.objects.filter(name=VIDEO_API_CIRCUIT, state="closed", failure_count=0).exists():
+        return False
+
+    with transaction.atomic():
+        circuit = get_locked_circuit()
+        was_open = circuit.state != "closed"
+
+        if was_open:
+            logger.info(f"Video API circuit closed, it was down since {circuit.opened_at}")
+
+        circuit.state = "closed"
+        circuit.failure_count = 0
+        circuit.opened_at = None
+        circuit.next_probe_at = None
+        circuit.save()
+
+    return was_open
@@ -1,9 +1,11 @@
 import requests
 from videos.models import Video
 from django.conf import settings
-from django.db import transaction
+from django.db.models.functions import Coalesce, Now
+from django.utils import timezone
 
 from accounts.tasks import send_ses_email
+from videos.circuit_breaker import DENY, PROBE, acquire_video_api_permit, record_video_api_failure
 from functools import wraps
 
 import logging
@@ -20,28 +22,34 @@ def is_fastapi_online():
 def mark_video_for_retry_if_fastapi_down(task_func):
     @wraps(task_func)
     def wrapper(self, video_id, *args, **kwargs):
-        if not is_fastapi_online():
-            # Update video status to "retry"
-            with transaction.atomic():
-                try:
-                    video = Video.objects.select_for_update().get(id=video_id)
-                    video.status = "retry"
-                    video.save()
-                except Video.DoesNotExist:
-                    logger.error(f"Video doesn not exist with id === {video_id}")
-                    pass
-                else:
-                    subject, message = prepare_message_api_down(video)
-                    send_ses_email.delay(to_email=[settings.CONTACT_FORM_RECIPIENT],
-                                         from_email=settings.DEFAULT_FROM_EMAIL,
-                                         subject=subject,
-                                         body_text=message)
+        permit = acquire_video_api_permit()
+
+        # Only the one worker probing a half open circuit checks /health, the outage alert went out when it opened
+        if permit == PROBE and not is_fastapi_online():
+            record_video_api_failure()
+            permit = DENY
+
+        if permit == DENY:
+            # Back in the queue in its old place, the probe booked when the circuit opened dispatches it again
+            requeued = Video.objects.filter(id=video_id).update(status="queued",
+                                                                queued_at=Coalesce("queued_at", Now()),
+                                                                status_updated_at=timezone.now())
+            if not requeued:
+                logger.error(f"Video doesn not exist with id === {video_id}")
 
             return  # skip running the task
         return task_func(self, video_id, *args, **kwargs)
     return wrapper
 
 
+def send_api_down_alert(video: Video):
+    subject, message = prepare_message_api_down(video)
+    send_ses_email.delay(to_email=[settings.CONTACT_FORM_RECIPIENT],
+                         from_email=settings.DEFAULT_FROM_EMAIL,
+                         subject=subject,
+                         body_text=message)
+
+
 def prepare_message_api_down(video: Video):
     subject = "API is DOWN Please Start"
 
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.2 on 2026-10-17 12:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('videos', '0004_video_progress_video_status_message_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='priority',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='status',
+            field=models.CharField(choices=[('uploaded', 'Uploaded'), ('queued', 'Queued'), ('processing', 'Processing'), ('completed', 'Completed'), ('error', 'Error'), ('retry', 'Retry')], default='uploaded', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['status', '-priority', 'queued_at'], name='video_queue_idx'),
+        ),
+    ]
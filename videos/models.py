@@ -4,6 +4,7 @@ from videos.validators import validate_prompt_token_length
 
 STATUS_CHOICES = [
         ('uploaded', 'Uploaded'),
+        ('queued', 'Queued'),
         ('processing', 'Processing'),
         ('completed', 'Completed'),
         ('error', 'Error'),
@@ -19,8 +20,39 @@ class Video(models.Model):
     celery_task_id = models.CharField(null=True, blank=True)
     prompt = models.CharField(validators=[validate_prompt_token_length])
     s_three_url = models.URLField(null=True)
+    # Pushed by the video API's progress webhook, status_updated_at lets the browser wait for the next change
+    progress = models.PositiveSmallIntegerField(default=0)
+    status_message = models.CharField(max_length=255, blank=True, default="")
+    status_updated_at = models.DateTimeField(auto_now=True)
+    # Queued videos are sent to the video API highest priority first, then in the order they were queued
+    priority = models.SmallIntegerField(default=0)
+    queued_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['user', 'title'], name='unique_video_title_per_user')
         ]
+        indexes = [
+            models.Index(fields=['status', '-priority', 'queued_at'], name='video_queue_idx')
+        ]
+
+
+CIRCUIT_STATE_CHOICES = [
+        ('closed', 'Closed'),
+        ('open', 'Open'),
+        ('half_open', 'Half open'),
+    ]
+
+
+class CircuitBreaker(models.Model):
+    """Health of an external service shared by every web and celery worker, see videos/circuit_breaker.py."""
+    name = models.CharField(max_length=64, unique=True)
+    state = models.CharField(max_length=20, choices=CIRCUIT_STATE_CHOICES, default='closed')
+    failure_count = models.PositiveIntegerField(default=0)
+    # Start of the current outage, the outage alert is only sent when this is first set
+    opened_at = models.DateTimeField(null=True, blank=True)
+    next_probe_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.state})"
@@ -0,0 +1,67 @@
+import logging
+from datetime import timedelta
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from videos.models import Video
+
+logger = logging.getLogger("django_mcq")
+
+# Key for pg_advisory_xact_lock, every dispatcher takes it so two workers never hand out the same free slot
+VIDEO_QUEUE_LOCK_ID = 7351024
+
+STALE_VIDEO_MESSAGE = "The video API stopped reporting progress"
+
+
+def get_running_video_count() -> int:
+    """Videos holding one of the VIDEO_JOB_SLOTS, stale ones are expired first so they don't hold a slot."""
+
+    return Video.objects.filter(status="processing").count()
+
+
+def expire_stale_videos(**filters) -> int:
+    """
+    Progress webhooks keep status_updated_at fresh, so a processing video that has been silent for
+    VIDEO_JOB_STALE_AFTER seconds is treated as lost. It is failed rather than requeued as the API may still finish
+    it, and a second run would be paid for twice.
+    """
+
+    stale_before = timezone.now() - timedelta(seconds=settings.VIDEO_JOB_STALE_AFTER)
+    expired = Video.objects.filter(status="processing", status_updated_at__lt=stale_before, **filters).update(
+        status="error", status_message=STALE_VIDEO_MESSAGE, status_updated_at=timezone.now())
+
+    if expired:
+        logger.warning(f"Marked {expired} silent processing videos as failed")
+
+    return expired
+
+
+def claim_queued_videos(max_videos: Optional[int] = None) -> List[Video]:
+    """
+    Moves as many queued videos as there are free slots, at most max_videos, to processing and returns them. The
+    caller is responsible for sending them to the video API.
+    """
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [VIDEO_QUEUE_LOCK_ID])
+
+        expire_stale_videos()
+        free_slots = settings.VIDEO_JOB_SLOTS - get_running_video_count()
+        if max_videos is not None:
+            free_slots = min(free_slots, max_videos)
+        if free_slots <= 0:
+            return []
+
+        videos = list(Video.objects.filter(status="queued").order_by("-priority", "queued_at", "pk")[:free_slots])
+
+        Video.objects.filter(pk__in=[video.pk for video in videos]).update(
+            status="processing", progress=0, status_message="", status_updated_at=timezone.now()
+        )
+
+    logger.info(f"Dispatching {len(videos)} queued videos, {free_slots - len(videos)} slots left free")
+    return videos
+
@@ -0,0 +1,37 @@
+// Polls the video's status endpoint. Under ASGI the server holds each request until a webhook changes the video so
+// the delay is 0, under WSGI it answers straight away and the page waits between requests
+const videoStatus = document.getElementById("video_status")
+const pollDelay = Number(videoStatus.getAttribute("data-poll-delay"))
+const videoProgress = document.getElementById("video_progress")
+const videoStatusMessage = document.getElementById("video_status_message")
+
+const pollVideoStatus = (updatedAt) => {
+    const url = `${videoStatus.getAttribute("data-url")}?since=${encodeURIComponent(updatedAt)}`
+
+    fetch(url)
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(`Status request failed with ${response.status}`)
+        }
+        return response.json()
+    })
+    .then(data => {
+        if (data.status !== videoStatus.getAttribute("data-status")) {
+            // Started, completed or failed, reload to show the progress, the video or the delete button
+            window.location.reload()
+            return
+        }
+
+        videoProgress.value = data.progress
+        videoProgress.textContent = `${data.progress}%`
+        videoStatusMessage.textContent = data.message
+        setTimeout(() => pollVideoStatus(data.updated_at), pollDelay)
+    })
+    .catch(error => {
+        console.error(error)
+        // Back off before trying again so a failing server isn't hammered
+        setTimeout(() => pollVideoStatus(updatedAt), 5000)
+    })
+}
+
+pollVideoStatus(videoStatus.getAttribute("data-updated-at"))
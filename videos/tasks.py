@@ -5,14 +5,18 @@ from botocore.exceptions import ClientError
 from django.http import JsonResponse
 from django.conf import settings
 from celery import shared_task
-from celery.exceptions import Retry
+from django.db.models.functions import Coalesce, Now
+from django.utils import timezone
 
 from videos.utils import get_s3_client
 
 import logging
 
 from videos.models import Video
-from videos.decorators import mark_video_for_retry_if_fastapi_down
+from videos.circuit_breaker import (get_video_api_retry_at, is_video_api_circuit_closed, record_video_api_failure,
+                                    record_video_api_success)
+from videos.decorators import mark_video_for_retry_if_fastapi_down, send_api_down_alert
+from videos.scheduler import claim_queued_videos
 
 logger = logging.getLogger("django_mcq")
 
@@ -38,16 +42,10 @@ def send_request_to_text_to_vid_api(self, video_id: int, prompt: str):
 
     status_msg = "uploaded"
     json_resp_err = False
+    outage_started = False
 
     try:
 
-        processing_vid_count = Video.objects.filter(status="processing").count()
-
-        if processing_vid_count > 4:
-            # Delay the sending of task if more than 4 videos processing this can be modified later
-            raise self.retry(video_id=video_id, prompt=prompt, countdown=120)
-
-
         # Step 1: Submit job to FastAPI
         response = requests.post(
             f"{settings.VIDEOAPI_BASE_URL}/generate",
@@ -60,6 +58,10 @@ def send_request_to_text_to_vid_api(self, video_id: int, prompt: str):
         )
         response.raise_for_status()
 
+        if record_video_api_success():
+            # First job through after an outage, send the videos held back by it
+            retry_failed_fastapi_jobs.delay_on_commit()
+
         # Parse and check the response content
         data = response.json()
         if data.get("message") == "Video generation started. Use the job_id to check status.":
@@ -71,10 +73,13 @@ def send_request_to_text_to_vid_api(self, video_id: int, prompt: str):
             json_resp_err = True
 
     except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
-        status_msg = "error"
-        raise e
-
-    except Retry as e:
+        if e.response is None or e.response.status_code >= 500:
+            # The API is unreachable or failing rather than rejecting this video, so it goes back in the queue. If
+            # this opened the circuit the queue waits for the probe, otherwise it is sent again straight away
+            status_msg = "queued"
+            outage_started = record_video_api_failure()
+        else:
+            status_msg = "error"
         raise e
 
     except Exception as e:
@@ -91,8 +96,17 @@ def send_request_to_text_to_vid_api(self, video_id: int, prompt: str):
         video = Video.objects.get(pk=video_id)
         video.status = status_msg
         video.celery_task_id = self.request.id
+        if status_msg == "queued" and video.queued_at is None:
+            video.queued_at = timezone.now()
         video.save()
 
+        if outage_started:
+            send_api_down_alert(video)
+
+        if status_msg in ("error", "queued"):
+            # The video gave up its slot so the next queued one can go
+            dispatch_video_queue.delay_on_commit()
+
 
 @shared_task
 def send_test_request():
@@ -114,9 +128,34 @@ def send_test_request():
         return "Successfully sent to FASTAPI TEST"
 
 
+@shared_task
+def dispatch_video_queue():
+    """
+    Sends queued videos to the video API while there are free slots. Runs whenever a video is queued or a slot is
+    given up, so a queued video goes as soon as there is room for it.
+    """
+
+    retry_at = get_video_api_retry_at()
+
+    if retry_at is not None:
+        # Jobs would only be turned away. This run may have come early or the probe may have been lost, so another
+        # is booked for when the next probe is due rather than relying on something else to wake the queue up
+        dispatch_video_queue.apply_async(eta=retry_at)
+        return 0
+
+    # While the circuit is half open only the trial job goes, the rest follow once it has closed the circuit
+    videos = claim_queued_videos(None if is_video_api_circuit_closed() else 1)
+
+    for video in videos:
+        send_request_to_text_to_vid_api.delay(video_id=video.pk, prompt=video.prompt)
+
+    return len(videos)
+
+
 @shared_task
 def retry_failed_fastapi_jobs():
-    retry_videos = Video.objects.filter(status="retry")
-    for video in retry_videos:
-        send_request_to_text_to_vid_api.delay(video.id, video.prompt)
+    # Videos left in retry by earlier releases go back in the queue, keeping their original place in it
+    Video.objects.filter(status="retry").update(status="queued", queued_at=Coalesce("queued_at", Now()),
+                                                status_updated_at=timezone.now())
+    dispatch_video_queue.delay()
 
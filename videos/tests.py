@@ -1,18 +1,26 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.contrib.auth.models import User
-from videos.models import Video
+from videos.models import CircuitBreaker, Video
+from videos.circuit_breaker import PROBE, acquire_video_api_permit
+from videos.scheduler import STALE_VIDEO_MESSAGE
 from videos.forms import VideoForm
 from videos.validators import validate_prompt_token_length
-from videos.utils import get_s3_client
-from videos.tasks import delete_s3_file, send_request_to_text_to_vid_api
+from videos.utils import (create_s3_client, get_cached_s3_client, get_s3_client, get_s3_range,
+                          get_video_presigned_url)
+from videos.tasks import (delete_s3_file, dispatch_video_queue, retry_failed_fastapi_jobs,
+                          send_request_to_text_to_vid_api)
 import requests
 from io import BytesIO
 import json
+import time
+from datetime import timedelta
 
 from django.urls import reverse
 from django.http import FileResponse
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 from unittest.mock import patch, MagicMock
 
@@ -59,7 +67,9 @@ class MockS3Client:
             raise Exception
         return MockS3Client.presigned_url
 
-    def get_object(self, Bucket, Key):
+    video_content = b'test video content'
+
+    def get_object(self, Bucket, Key, Range=None):
         if self.raise_exception:
             if self.generic_exception:
                 raise Exception
@@ -69,25 +79,20 @@ class MockS3Client:
                 else:
                     raise ClientError
 
-        return {
-            'Body': BytesIO(b'test video content')
-        }
-
-
-class MockAPIResponse:
-
-    def __init__(self, raise_exception=False):
-        self.raise_exception = raise_exception
-
-    mock_response = {"status": "processing", "message": "Still Processing"}
+        if Range is None:
+            return {'Body': BytesIO(self.video_content), 'ContentLength': len(self.video_content)}
 
-    def json(self):
-        return self.mock_response
+        start, end = Range[len("bytes="):].split("-")
+        if not start:
+            start, end = len(self.video_content) - int(end), len(self.video_content) - 1
+        end = min(int(end), len(self.video_content) - 1) if end else len(self.video_content) - 1
+        content = self.video_content[int(start):end + 1]
 
-    def raise_for_status(self):
-        if self.raise_exception:
-            raise requests.RequestException
-        return True
+        return {
+            'Body': BytesIO(content),
+            'ContentLength': len(content),
+            'ContentRange': f"bytes {start}-{end}/{len(self.video_content)}",
+        }
 
 
 class VideoTestCase(TestCase):
@@ -135,6 +140,8 @@ class VideoTestCase(TestCase):
         self.unauthenticated_client = Client()
         self.random_client = Client()
         self.random_client.login(username='randomuser', password='random')
+        cache.clear()
+        self.addCleanup(cache.clear)
 
 
     def test_authenticated_client_get_all_lib_chats_test_user(self):
@@ -165,7 +172,7 @@ class VideoTestCase(TestCase):
         # Client not logged in so will do a redirect
         self.assertEqual(response.status_code, 302)
 
-    @patch("videos.views.get_s3_client")
+    @patch("videos.utils.get_s3_client")
     def test_authenticated_client_get_video_detail_data_completed_no_errors(self, s3_client):
         video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{1}").first()
         video_pk = video.pk
@@ -176,8 +183,6 @@ class VideoTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['video'], video)
         self.assertEqual(response.context['video_url'], fake_s3_client.presigned_url)
-        self.assertIsNone(response.context['status'])
-        self.assertIsNone(response.context['message'])
         self.assertTemplateUsed(response, "videos/video_detail.html")
 
     def test_unauthenticated_client_get_video_detail_data(self):
@@ -196,7 +201,7 @@ class VideoTestCase(TestCase):
         # Client not logged in so will do a redirect
         self.assertEqual(response.status_code, 404)
 
-    @patch("videos.views.get_s3_client")
+    @patch("videos.utils.get_s3_client")
     def test_authenticated_client_get_video_detail_data_completed_errors_when_s3_client_got(self, s3_client):
         video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{1}").first()
         video_pk = video.pk
@@ -208,11 +213,35 @@ class VideoTestCase(TestCase):
         self.assertEqual(response.context['video'], video)
         self.assertEqual(response.context['video_url_error'], "Could not load video.")
         self.assertIsNone(response.context['video_url'])
-        self.assertIsNone(response.context['status'])
-        self.assertIsNone(response.context['message'])
         self.assertTemplateUsed(response, "videos/video_detail.html")
 
-    @patch("videos.views.get_s3_client")
+    @patch("videos.utils.get_s3_client")
+    def test_video_detail_reuses_signed_url(self, s3_client):
+        video = Video.objects.filter(user=VideoTestCase.test_user, status="completed").first()
+        fake_s3_client = MagicMock()
+        fake_s3_client.generate_presigned_url.return_value = MockS3Client.presigned_url
+        s3_client.return_value = fake_s3_client
+        url = reverse("video_detail", args=[video.pk])
+
+        for _ in range(3):
+            response = self.authenticated_client.get(url)
+            self.assertEqual(response.context['video_url'], MockS3Client.presigned_url)
+
+        fake_s3_client.generate_presigned_url.assert_called_once()
+
+    @patch("videos.utils.get_s3_client")
+    def test_video_list_has_playback_links_for_completed_videos(self, s3_client):
+        s3_client.return_value = MockS3Client()
+
+        response = self.authenticated_client.get(reverse("video_index"))
+
+        self.assertEqual(response.status_code, 200)
+        video_urls = {video.status: video.video_url for video in response.context['videos']}
+        self.assertEqual(video_urls, {"completed": MockS3Client.presigned_url, "processing": None, "error": None,
+                                      "uploaded": None})
+        self.assertContains(response, MockS3Client.presigned_url)
+
+    @patch("videos.utils.get_s3_client")
     def test_authenticated_client_get_video_detail_data_completed_s3_client_none(self, s3_client):
         video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{1}").first()
         video_pk = video.pk
@@ -223,39 +252,101 @@ class VideoTestCase(TestCase):
         self.assertEqual(response.context['video'], video)
         self.assertEqual(response.context['video_url_error'], "Could not load video.")
         self.assertIsNone(response.context['video_url'])
-        self.assertIsNone(response.context['status'])
-        self.assertIsNone(response.context['message'])
         self.assertTemplateUsed(response, "videos/video_detail.html")
 
-    @patch("videos.views.requests.get")
-    def test_authenticated_client_get_video_detail_data_processing_no_errors(self, api_call):
+    @patch("videos.utils.get_s3_client")
+    def test_authenticated_client_get_video_detail_data_processing_shows_pushed_progress(self, s3_client):
         video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
-        video_pk = video.pk
-        url = reverse("video_detail", args=[video_pk])
-        mock_api_obj = MockAPIResponse()
-        api_call.return_value = mock_api_obj
+        Video.objects.filter(pk=video.pk).update(progress=40, status_message="Rendering scenes")
+        url = reverse("video_detail", args=[video.pk])
         response = self.authenticated_client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['video'], video)
         self.assertIsNone(response.context['video_url'])
-        self.assertEqual(response.context['status'], mock_api_obj.mock_response["status"])
-        self.assertEqual(response.context['message'], mock_api_obj.mock_response["message"])
+        self.assertContains(response, 'value="40"')
+        self.assertContains(response, "Rendering scenes")
+        self.assertContains(response, reverse("video_status", args=[video.pk]))
         self.assertTemplateUsed(response, "videos/video_detail.html")
+        s3_client.assert_not_called()
+
+    def test_queued_video_detail_polls_and_hides_delete(self):
+        video = self.create_queued_videos([0])[0]
+
+        response = self.authenticated_client.get(reverse("video_detail", args=[video.pk]))
+
+        self.assertContains(response, reverse("video_status", args=[video.pk]))
+        self.assertContains(response, 'data-status="queued"')
+        self.assertContains(response, "video_status.js")
+        self.assertNotContains(response, reverse("delete_video", args=[video.pk]))
+
+    @patch("videos.views.delete_s3_file.delay_on_commit")
+    def test_queued_video_cannot_be_deleted(self, delete_video_func):
+        video = self.create_queued_videos([0])[0]
+        url = reverse("delete_video", args=[video.pk])
+
+        self.assertEqual(self.authenticated_client.get(url).status_code, 404)
+        self.assertEqual(self.authenticated_client.post(url).status_code, 404)
 
-    @patch("videos.views.requests.get")
-    def test_authenticated_client_get_video_detail_data_processing_errors(self, api_call):
+        self.assertTrue(Video.objects.filter(pk=video.pk).exists())
+        delete_video_func.assert_not_called()
+
+    def test_video_status_without_since_answers_immediately(self):
         video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
-        video_pk = video.pk
-        url = reverse("video_detail", args=[video_pk])
-        mock_api_obj = MockAPIResponse(raise_exception=True)
-        api_call.return_value = mock_api_obj
-        response = self.authenticated_client.get(url)
+        response = self.authenticated_client.get(reverse("video_status", args=[video.pk]))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.context['video'], video)
-        self.assertIsNone(response.context['video_url'])
-        self.assertEqual(response.context['status'], "error")
-        self.assertEqual(response.context['message'], f"Error connecting to API")
-        self.assertTemplateUsed(response, "videos/video_detail.html")
+        self.assertEqual(response.json(), {"status": "processing", "progress": 0, "message": "",
+                                           "updated_at": video.status_updated_at.isoformat()})
+
+    def test_video_status_answers_once_status_changed_since(self):
+        video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
+        since = video.status_updated_at.isoformat()
+        Video.objects.filter(pk=video.pk).update(progress=75, status_message="Encoding",
+                                                 status_updated_at=video.status_updated_at + timedelta(seconds=1))
+
+        response = self.authenticated_client.get(reverse("video_status", args=[video.pk]), {"since": since})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["progress"], 75)
+        self.assertEqual(response.json()["message"], "Encoding")
+
+    @override_settings(VIDEO_STATUS_LONG_POLL_TIMEOUT=0.2, VIDEO_STATUS_POLL_INTERVAL=0.05)
+    async def test_video_status_waits_for_a_change_then_times_out_under_asgi(self):
+        video = await Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").afirst()
+        await self.async_client.aforce_login(VideoTestCase.test_user)
+        url = reverse("video_status", args=[video.pk])
+
+        start = time.monotonic()
+        response = await self.async_client.get(url, {"since": video.status_updated_at.isoformat()})
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["updated_at"], video.status_updated_at.isoformat())
+
+    @override_settings(VIDEO_STATUS_LONG_POLL_TIMEOUT=5, VIDEO_STATUS_POLL_INTERVAL=2)
+    def test_video_status_answers_unchanged_straight_away_under_wsgi(self):
+        video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
+        url = reverse("video_status", args=[video.pk])
+
+        start = time.monotonic()
+        response = self.authenticated_client.get(url, {"since": video.status_updated_at.isoformat()})
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(response.json()["updated_at"], video.status_updated_at.isoformat())
+
+        # So the page waits between requests instead
+        detail_response = self.authenticated_client.get(reverse("video_detail", args=[video.pk]))
+        self.assertEqual(detail_response.context["status_poll_delay"], 2000)
+        self.assertContains(detail_response, 'data-poll-delay="2000"')
+
+    def test_video_status_wrong_user(self):
+        video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
+        response = self.random_client.get(reverse("video_status", args=[video.pk]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_video_status_unauthenticated_user(self):
+        video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
+        response = self.unauthenticated_client.get(reverse("video_status", args=[video.pk]))
+        self.assertEqual(response.status_code, 302)
 
     def test_authenticated_client_get_request_upload_video(self):
         url = reverse("create_video")
@@ -269,7 +360,7 @@ class VideoTestCase(TestCase):
         response = self.unauthenticated_client.get(url)
         self.assertEqual(response.status_code, 302)
 
-    @patch("videos.views.send_request_to_text_to_vid_api.delay_on_commit")
+    @patch("videos.views.dispatch_video_queue.delay_on_commit")
     def test_authenticated_client_post_request_upload_video_success(self, celery_task_pch):
         url = reverse("create_video")
         prompt = "Test prompt"
@@ -280,12 +371,13 @@ class VideoTestCase(TestCase):
         self.assertEqual(videos.count(), 5)
         video = videos.filter(title=title).first()
         self.assertEqual(video.prompt, prompt)
-        self.assertEqual(video.status, "uploaded")
+        self.assertEqual(video.status, "queued")
+        self.assertIsNotNone(video.queued_at)
         self.assertIsNone(video.celery_task_id)
         self.assertIsNone(video.s_three_url)
         celery_task_pch.assert_called_once()
 
-    @patch("videos.views.send_request_to_text_to_vid_api.delay_on_commit")
+    @patch("videos.views.dispatch_video_queue.delay_on_commit")
     def test_authenticated_client_post_request_upload_video_form_not_valid(self, celery_task_pch):
         url = reverse("create_video")
         prompt = "Test prompt"
@@ -295,7 +387,7 @@ class VideoTestCase(TestCase):
         self.assertTemplateUsed(response, "videos/upload_video.html")
         celery_task_pch.assert_not_called()
 
-    @patch("videos.views.send_request_to_text_to_vid_api.delay_on_commit")
+    @patch("videos.views.dispatch_video_queue.delay_on_commit")
     def test_unauthenticated_client_post_request_upload_video(self, celery_task_pch):
         url = reverse("create_video")
         prompt = "Test prompt"
@@ -320,6 +412,8 @@ class VideoTestCase(TestCase):
         self.assertEqual(first_response.status_code, 200)
         self.assertTemplateUsed(first_response, "videos/confirm_vid_delete.html")
 
+        cache.set(f"video_presigned_url:{pk}", "http://signed.url")
+
         second_response = self.authenticated_client.post(url)
         self.assertEqual(second_response.status_code, 302)
         redirect_url = reverse("video_index")
@@ -333,6 +427,7 @@ class VideoTestCase(TestCase):
         self.assertFalse(video_after.exists())
 
         delete_video_func.assert_called_with(video_id=pk)
+        self.assertIsNone(cache.get(f"video_presigned_url:{pk}"))
 
     @patch("videos.views.delete_s3_file.delay_on_commit")
     def test_lib_doc_delete_success_not_completed_vid(self, delete_video_func):
@@ -406,6 +501,70 @@ class VideoTestCase(TestCase):
         self.assertIsInstance(response, FileResponse)
         self.assertEqual(response['Content-Disposition'], f'attachment; filename="{pk}.mp4"')
         self.assertEqual(response.getvalue(), b'test video content')
+        self.assertEqual(response['Content-Length'], '18')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    @override_settings(VIDEO_DOWNLOAD_CHUNK_SIZE=4)
+    @patch('videos.views.get_s3_client')
+    def test_download_video_streams_in_chunks(self, mock_get_s3_client):
+        mock_get_s3_client.return_value = MockS3Client()
+        response = self.authenticated_client.get(reverse("download_video", args=[1]))
+
+        self.assertTrue(response.streaming)
+        chunks = list(response.streaming_content)
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 4, 4, 2])
+        self.assertEqual(b"".join(chunks), b'test video content')
+
+    @override_settings(VIDEO_DOWNLOAD_CHUNK_SIZE=4)
+    @patch('videos.views.get_s3_client')
+    async def test_download_video_streams_in_chunks_under_asgi(self, mock_get_s3_client):
+        mock_get_s3_client.return_value = MockS3Client()
+        await self.async_client.aforce_login(VideoTestCase.test_user)
+
+        response = await self.async_client.get(reverse("download_video", args=[1]))
+
+        self.assertTrue(response.is_async)
+        self.assertEqual(response["Content-Length"], str(len(MockS3Client.video_content)))
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 4, 4, 2])
+        self.assertEqual(b"".join(chunks), b'test video content')
+
+    @patch('videos.views.get_s3_client')
+    def test_download_video_range_request(self, mock_get_s3_client):
+        mock_get_s3_client.return_value = MockS3Client()
+        url = reverse("download_video", args=[1])
+
+        response = self.authenticated_client.get(url, headers={"Range": "bytes=5-9"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.getvalue(), b'video')
+        self.assertEqual(response['Content-Range'], 'bytes 5-9/18')
+        self.assertEqual(response['Content-Length'], '5')
+
+        response = self.authenticated_client.get(url, headers={"Range": "bytes=-7"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.getvalue(), b'content')
+
+    @patch('videos.views.get_s3_client')
+    def test_download_video_unsupported_range_sends_whole_video(self, mock_get_s3_client):
+        mock_get_s3_client.return_value = MockS3Client()
+        url = reverse("download_video", args=[1])
+
+        response = self.authenticated_client.get(url, headers={"Range": "bytes=0-1,4-5"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.getvalue(), b'test video content')
+
+    @override_settings(VIDEO_DOWNLOAD_MODE="redirect")
+    @patch('videos.views.get_s3_client')
+    def test_download_video_redirect_mode(self, mock_get_s3_client):
+        mock_s3_client = MockS3Client()
+        mock_s3_client.get_object = MagicMock()
+        mock_get_s3_client.return_value = mock_s3_client
+
+        response = self.authenticated_client.get(reverse("download_video", args=[1]))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, MockS3Client.presigned_url)
+        mock_s3_client.get_object.assert_not_called()
 
     @patch('videos.views.get_s3_client')
     def test_download_video_raise_generic_exception(self, mock_get_s3_client):
@@ -484,6 +643,89 @@ class VideoTestCase(TestCase):
 
         self.assertEqual(video.status, "completed")
         self.assertEqual(video.s_three_url, payload['video_url'])
+        self.assertEqual(video.progress, 100)
+
+    @patch("videos.views.dispatch_video_queue.delay_on_commit")
+    def test_video_complete_notification_frees_slot_for_queue(self, dispatch_pch):
+        payload = {'video_id': 2, 'job_id': 'ce7744f9-a0ad-4339-bbcc-0cadfd79b26543', 'status': 'error',
+                   'completed_at': '2025-06-26T17:59:07.389738', 'video_url': None, 'error_message': "Render failed"}
+        headers = {"Authorization": f"Bearer {settings.DJANGO_API_KEY}"}
+
+        response = self.client.post(reverse("video_complete_notification"), data=payload, headers=headers,
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Video.objects.get(pk=2).status_message, "Render failed")
+        dispatch_pch.assert_called_once()
+
+    def create_queued_videos(self, priorities):
+        queued_at = timezone.now()
+        videos = []
+        for i, priority in enumerate(priorities):
+            videos.append(Video.objects.create(title=f"Queued_{i}", prompt=f"Queued prompt {i}",
+                                               user=VideoTestCase.test_user, status="queued", priority=priority,
+                                               queued_at=queued_at + timedelta(seconds=i)))
+        return videos
+
+    @override_settings(VIDEO_JOB_SLOTS=5)
+    @patch("videos.tasks.send_request_to_text_to_vid_api.delay")
+    def test_dispatch_video_queue_fills_free_slots_by_priority_then_age(self, send_pch):
+        # Videos 2 and 7 are already processing, leaving 3 of the 5 slots
+        queued = self.create_queued_videos([0, 1, 0, 0, 1])
+
+        dispatched = dispatch_video_queue()
+
+        self.assertEqual(dispatched, 3)
+        expected = [queued[1], queued[4], queued[0]]
+        self.assertEqual([call.kwargs["video_id"] for call in send_pch.call_args_list],
+                         [video.pk for video in expected])
+        self.assertEqual(set(Video.objects.filter(status="queued").values_list("pk", flat=True)),
+                         {queued[2].pk, queued[3].pk})
+        self.assertEqual(Video.objects.filter(status="processing").count(), 5)
+
+    @override_settings(VIDEO_JOB_SLOTS=2)
+    @patch("videos.tasks.send_request_to_text_to_vid_api.delay")
+    def test_dispatch_video_queue_waits_when_slots_are_full(self, send_pch):
+        queued = self.create_queued_videos([0])
+
+        self.assertEqual(dispatch_video_queue(), 0)
+
+        send_pch.assert_not_called()
+        self.assertEqual(Video.objects.get(pk=queued[0].pk).status, "queued")
+
+    @override_settings(VIDEO_JOB_SLOTS=2, VIDEO_JOB_STALE_AFTER=60)
+    @patch("videos.tasks.send_request_to_text_to_vid_api.delay")
+    def test_dispatch_video_queue_ignores_silent_processing_videos(self, send_pch):
+        queued = self.create_queued_videos([0])
+        Video.objects.filter(pk=2).update(status_updated_at=timezone.now() - timedelta(minutes=5))
+
+        self.assertEqual(dispatch_video_queue(), 1)
+
+        send_pch.assert_called_once_with(video_id=queued[0].pk, prompt=queued[0].prompt)
+        # The silent video is failed rather than left processing forever
+        stale_video = Video.objects.get(pk=2)
+        self.assertEqual(stale_video.status, "error")
+        self.assertEqual(stale_video.status_message, STALE_VIDEO_MESSAGE)
+
+    @override_settings(VIDEO_JOB_STALE_AFTER=60)
+    def test_video_status_fails_silent_processing_video(self):
+        Video.objects.filter(pk=2).update(status_updated_at=timezone.now() - timedelta(minutes=5))
+
+        response = self.authenticated_client.get(reverse("video_status", args=[2]))
+
+        self.assertEqual(response.json()["status"], "error")
+        self.assertEqual(response.json()["message"], STALE_VIDEO_MESSAGE)
+
+    @patch("videos.tasks.dispatch_video_queue.delay")
+    def test_retry_failed_fastapi_jobs_requeues_videos(self, dispatch_pch):
+        Video.objects.filter(pk=4).update(status="retry")
+
+        retry_failed_fastapi_jobs()
+
+        video = Video.objects.get(pk=4)
+        self.assertEqual(video.status, "queued")
+        self.assertIsNotNone(video.queued_at)
+        dispatch_pch.assert_called_once()
 
     def test_video_complete_notification_some_fields_not_in_payload(self):
 
@@ -548,6 +790,60 @@ class VideoTestCase(TestCase):
         self.assertEqual(response.status_code, 401)
         self.assertEqual(json.loads(str(response.content, 'utf-8'))['error'], "Unauthorized")
 
+    def test_video_progress_notification_success(self):
+        video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
+        payload = {"video_id": video.pk, "progress": 40, "message": "Rendering scenes"}
+        headers = {"Authorization": f"Bearer {settings.DJANGO_API_KEY}"}
+
+        response = self.client.post(reverse("video_progress_notification"), data=payload, headers=headers,
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        video_after = Video.objects.get(pk=video.pk)
+        self.assertEqual(video_after.progress, 40)
+        self.assertEqual(video_after.status_message, "Rendering scenes")
+        self.assertGreater(video_after.status_updated_at, video.status_updated_at)
+
+    def test_video_progress_notification_ignored_after_completion(self):
+        video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{1}").first()
+        payload = {"video_id": video.pk, "progress": 40, "message": "Rendering scenes"}
+        headers = {"Authorization": f"Bearer {settings.DJANGO_API_KEY}"}
+
+        response = self.client.post(reverse("video_progress_notification"), data=payload, headers=headers,
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        video_after = Video.objects.get(pk=video.pk)
+        self.assertEqual(video_after.status, "completed")
+        self.assertEqual(video_after.progress, 0)
+
+    def test_video_progress_notification_invalid_payloads(self):
+        video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
+        headers = {"Authorization": f"Bearer {settings.DJANGO_API_KEY}"}
+        url = reverse("video_progress_notification")
+
+        cases = [
+            ({"video_id": video.pk}, 400, "Missing fields"),
+            ({"video_id": video.pk, "progress": "lots"}, 400, "Invalid progress"),
+            ({"video_id": 999999, "progress": 10}, 404, "Video not found"),
+        ]
+        for payload, status_code, error in cases:
+            with self.subTest(payload=payload):
+                response = self.client.post(url, data=payload, headers=headers, content_type='application/json')
+                self.assertEqual(response.status_code, status_code)
+                self.assertEqual(response.json()["error"], error)
+
+    def test_video_progress_notification_wrong_api_key(self):
+        video = Video.objects.filter(user=VideoTestCase.test_user, title=f"Video_title_{2}").first()
+        payload = {"video_id": video.pk, "progress": 40}
+        headers = {"Authorization": "Bearer random_api_key"}
+
+        response = self.client.post(reverse("video_progress_notification"), data=payload, headers=headers,
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(Video.objects.get(pk=video.pk).progress, 0)
+
     @patch("videos.decorators.send_ses_email.delay")
     @patch("videos.decorators.is_fastapi_online", return_value=True)
     @patch('videos.tasks.settings')
@@ -641,13 +937,11 @@ class VideoTestCase(TestCase):
         self.assertEqual(video_after.status, "error")
         mock_send_email_pch.assert_not_called()
 
-    @patch("videos.decorators.send_ses_email.delay")
-    @patch("videos.decorators.is_fastapi_online", return_value=False)
-    @patch('videos.tasks.settings')
-    @patch('videos.tasks.requests.post')
-    def test_successful_text_to_vid_api_call_sets_retry_status(self, mock_post, mock_settings,
-                                                                    mock_fastapi_online, mock_send_email_pch):
-        mock_settings.VIDEOAPI_BASE_URL = "http://fakeapi.com"
+    def open_video_api_circuit(self, next_probe_at):
+        CircuitBreaker.objects.create(name="video_api", state="open", failure_count=3,
+                                      opened_at=timezone.now() - timedelta(minutes=10), next_probe_at=next_probe_at)
+
+    def mock_generate_response(self, mock_post):
         mock_response = MagicMock()
         mock_response.raise_for_status.return_value = None
         mock_response.json.return_value = {
@@ -655,19 +949,245 @@ class VideoTestCase(TestCase):
         }
         mock_post.return_value = mock_response
 
+    @patch("videos.decorators.send_ses_email.delay")
+    @patch("videos.decorators.is_fastapi_online", return_value=True)
+    @patch('videos.tasks.requests.post')
+    def test_closed_circuit_sends_without_health_check(self, mock_post, mock_fastapi_online, mock_send_email_pch):
+        self.mock_generate_response(mock_post)
+
+        result = send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4")
+
+        self.assertEqual(result, "Successfully sent to FASTAPI")
+        mock_fastapi_online.assert_not_called()
+        mock_send_email_pch.assert_not_called()
+
+    @patch("videos.decorators.send_ses_email.delay")
+    @patch("videos.decorators.is_fastapi_online", return_value=True)
+    @patch('videos.tasks.requests.post')
+    def test_open_circuit_requeues_video_without_calling_api(self, mock_post, mock_fastapi_online,
+                                                             mock_send_email_pch):
+        self.open_video_api_circuit(next_probe_at=timezone.now() + timedelta(minutes=1))
+
+        result = send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4")
+
+        self.assertIsNone(result)
         video = Video.objects.get(pk=4)
-        self.assertEqual(video.status, "uploaded")
+        self.assertEqual(video.status, "queued")
+        self.assertIsNotNone(video.queued_at)
+        mock_fastapi_online.assert_not_called()
+        mock_post.assert_not_called()
+        mock_send_email_pch.assert_not_called()
 
-        result = send_request_to_text_to_vid_api(video_id=video.pk, prompt=video.prompt)
+    @patch("videos.circuit_breaker.schedule_video_api_probe")
+    @patch("videos.decorators.send_ses_email.delay")
+    @patch("videos.decorators.is_fastapi_online", return_value=False)
+    @patch('videos.tasks.requests.post')
+    def test_failed_probe_requeues_video_and_books_next_probe(self, mock_post, mock_fastapi_online,
+                                                              mock_send_email_pch, schedule_probe_pch):
+        # The reset timeout has passed so this worker probes, the API is still down
+        self.open_video_api_circuit(next_probe_at=timezone.now() - timedelta(seconds=1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4")
 
         self.assertIsNone(result)
-        video_after = Video.objects.get(pk=4)
-        self.assertEqual(video_after.status, "retry")
-        mock_send_email_pch.assert_called()
+        self.assertEqual(Video.objects.get(pk=4).status, "queued")
+        mock_fastapi_online.assert_called_once()
+        mock_post.assert_not_called()
+        circuit = CircuitBreaker.objects.get(name="video_api")
+        self.assertEqual(circuit.state, "open")
+        self.assertGreater(circuit.next_probe_at, timezone.now())
+        # One dispatch booked for the end of the probe's lease, then one for the next probe once it failed
+        self.assertEqual(schedule_probe_pch.call_count, 2)
+        schedule_probe_pch.assert_called_with(circuit.next_probe_at)
+        # Still the same outage, its alert has already gone out
+        mock_send_email_pch.assert_not_called()
+
+    @patch("videos.tasks.retry_failed_fastapi_jobs.delay_on_commit")
+    @patch("videos.decorators.send_ses_email.delay")
+    @patch("videos.decorators.is_fastapi_online", return_value=True)
+    @patch('videos.tasks.requests.post')
+    def test_successful_probe_closes_circuit_and_requeues_held_videos(self, mock_post, mock_fastapi_online,
+                                                                      mock_send_email_pch, retry_pch):
+        self.open_video_api_circuit(next_probe_at=timezone.now() - timedelta(seconds=1))
+        self.mock_generate_response(mock_post)
+
+        result = send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4")
+
+        self.assertEqual(result, "Successfully sent to FASTAPI")
+        self.assertEqual(CircuitBreaker.objects.get(name="video_api").state, "closed")
+        mock_fastapi_online.assert_called_once()
+        retry_pch.assert_called_once()
+
+    @override_settings(VIDEO_API_FAILURE_THRESHOLD=3)
+    @patch("videos.decorators.send_ses_email.delay")
+    @patch("videos.decorators.is_fastapi_online", return_value=True)
+    @patch('videos.tasks.requests.post', side_effect=requests.exceptions.ConnectionError)
+    def test_failures_open_circuit_and_alert_once(self, mock_post, mock_fastapi_online, mock_send_email_pch):
+        for _ in range(3):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4")
+
+        # The three failures opened the circuit, later jobs are held back without calling the API
+        for _ in range(2):
+            self.assertIsNone(send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4"))
+
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(Video.objects.get(pk=4).status, "queued")
+        self.assertEqual(CircuitBreaker.objects.get(name="video_api").state, "open")
+        mock_fastapi_online.assert_not_called()
+        mock_send_email_pch.assert_called_once()
+
+    @patch("videos.tasks.dispatch_video_queue.delay_on_commit")
+    @patch("videos.decorators.send_ses_email.delay")
+    @patch("videos.decorators.is_fastapi_online", return_value=True)
+    @patch('videos.tasks.requests.post')
+    def test_transient_failure_requeues_video_then_success_sends_it(self, mock_post, mock_fastapi_online,
+                                                                     mock_send_email_pch, dispatch_pch):
+        mock_post.side_effect = requests.exceptions.ConnectionError
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4")
+
+        # Below the threshold the circuit stays closed and the video is dispatched again rather than parked
+        video = Video.objects.get(pk=4)
+        self.assertEqual(video.status, "queued")
+        self.assertIsNotNone(video.queued_at)
+        dispatch_pch.assert_called_once()
+        self.assertEqual(CircuitBreaker.objects.get(name="video_api").state, "closed")
+
+        mock_post.side_effect = None
+        self.mock_generate_response(mock_post)
+
+        self.assertEqual(send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4"),
+                         "Successfully sent to FASTAPI")
+
+        self.assertEqual(Video.objects.get(pk=4).status, "processing")
+        self.assertEqual(CircuitBreaker.objects.get(name="video_api").failure_count, 0)
+        mock_send_email_pch.assert_not_called()
+
+    @override_settings(VIDEO_API_FAILURE_THRESHOLD=1, VIDEO_JOB_SLOTS=5)
+    @patch("videos.tasks.send_request_to_text_to_vid_api.delay")
+    @patch("videos.circuit_breaker.schedule_video_api_probe")
+    @patch("videos.decorators.send_ses_email.delay")
+    @patch('videos.tasks.requests.post', side_effect=requests.exceptions.ConnectionError)
+    def test_open_circuit_recovers_without_new_uploads(self, mock_post, mock_send_email_pch, schedule_probe_pch,
+                                                       send_pch):
+        queued = self.create_queued_videos([0, 0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4")
+
+        # Opening the circuit books the probe, nothing else has to happen for the queue to move again
+        circuit = CircuitBreaker.objects.get(name="video_api")
+        schedule_probe_pch.assert_called_once_with(circuit.next_probe_at)
+
+        with patch("videos.tasks.dispatch_video_queue.apply_async") as rebook_pch:
+            self.assertEqual(dispatch_video_queue(), 0)
+        send_pch.assert_not_called()
+        rebook_pch.assert_called_once_with(eta=circuit.next_probe_at)
+
+        # The booked dispatch runs once the reset timeout is up and sends a single trial job
+        CircuitBreaker.objects.filter(pk=circuit.pk).update(next_probe_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(dispatch_video_queue(), 1)
+        send_pch.assert_called_once_with(video_id=queued[0].pk, prompt=queued[0].prompt)
+
+    @patch("videos.tasks.dispatch_video_queue.apply_async")
+    @patch("videos.tasks.send_request_to_text_to_vid_api.delay")
+    def test_dispatch_video_queue_holds_jobs_while_circuit_open(self, send_pch, rebook_pch):
+        self.open_video_api_circuit(next_probe_at=timezone.now() + timedelta(minutes=1))
+        self.create_queued_videos([0])
+
+        self.assertEqual(dispatch_video_queue(), 0)
+
+        send_pch.assert_not_called()
+
+    @patch("videos.tasks.dispatch_video_queue.apply_async")
+    @patch("videos.tasks.send_request_to_text_to_vid_api.delay")
+    def test_early_dispatch_rebooks_itself_for_the_probe(self, send_pch, rebook_pch):
+        # The dispatch booked for next_probe_at arrived a little early, e.g. clock skew between workers
+        next_probe_at = timezone.now() + timedelta(seconds=5)
+        self.open_video_api_circuit(next_probe_at=next_probe_at)
+        self.create_queued_videos([0])
+
+        self.assertEqual(dispatch_video_queue(), 0)
+
+        send_pch.assert_not_called()
+        rebook_pch.assert_called_once_with(eta=next_probe_at)
+
+    @patch("videos.tasks.dispatch_video_queue.apply_async")
+    @patch("videos.tasks.send_request_to_text_to_vid_api.delay")
+    @patch("videos.circuit_breaker.schedule_video_api_probe")
+    @patch("videos.decorators.is_fastapi_online", return_value=True)
+    @patch('videos.tasks.requests.post')
+    def test_rejected_probe_rebooks_dispatch_for_lease_expiry(self, mock_post, mock_fastapi_online,
+                                                               schedule_probe_pch, send_pch, rebook_pch):
+        self.open_video_api_circuit(next_probe_at=timezone.now() - timedelta(seconds=1))
+        self.create_queued_videos([0])
+        mock_response = MagicMock(status_code=422)
+        mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=mock_response)
+        mock_post.return_value = mock_response
+
+        # The API turns the trial video down, which neither closes nor reopens the circuit
+        with self.assertRaises(requests.exceptions.HTTPError):
+            send_request_to_text_to_vid_api(video_id=4, prompt="Prompt_4")
+
+        self.assertEqual(Video.objects.get(pk=4).status, "error")
+        circuit = CircuitBreaker.objects.get(name="video_api")
+        self.assertEqual(circuit.state, "half_open")
+
+        # The dispatch for the freed slot is declined while the lease runs and books the next go for its expiry
+        self.assertEqual(dispatch_video_queue(), 0)
+        send_pch.assert_not_called()
+        rebook_pch.assert_called_once_with(eta=circuit.next_probe_at)
+
+    @patch("videos.tasks.send_request_to_text_to_vid_api.delay")
+    @patch("videos.circuit_breaker.schedule_video_api_probe")
+    def test_lost_probe_is_replaced_once_its_lease_runs_out(self, schedule_probe_pch, send_pch):
+        self.open_video_api_circuit(next_probe_at=timezone.now() - timedelta(seconds=1))
+        queued = self.create_queued_videos([0])
+
+        # The worker given the probe dies before it can record the outcome
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(acquire_video_api_permit(), PROBE)
+
+        circuit = CircuitBreaker.objects.get(name="video_api")
+        schedule_probe_pch.assert_called_once_with(circuit.next_probe_at)
+
+        # The dispatch booked for the end of the lease sends a new trial job
+        CircuitBreaker.objects.filter(pk=circuit.pk).update(next_probe_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(dispatch_video_queue(), 1)
+        send_pch.assert_called_once_with(video_id=queued[0].pk, prompt=queued[0].prompt)
+
+    @patch("videos.views.retry_failed_fastapi_jobs.delay_on_commit")
+    def test_fastapi_status_view_closes_circuit(self, retry_pch):
+        self.open_video_api_circuit(next_probe_at=timezone.now() + timedelta(minutes=1))
+
+        response = self.client.post(reverse("fastapi_status_view"), data={"status": "on"},
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        circuit = CircuitBreaker.objects.get(name="video_api")
+        self.assertEqual(circuit.state, "closed")
+        self.assertIsNone(circuit.opened_at)
+        retry_pch.assert_called_once()
 
 
 class VideoHelpersTestCase(TestCase):
 
+    def test_get_s3_range(self):
+        self.assertEqual(get_s3_range("bytes=0-99"), "bytes=0-99")
+        self.assertEqual(get_s3_range("bytes=100-"), "bytes=100-")
+        self.assertEqual(get_s3_range("bytes=-500"), "bytes=-500")
+        self.assertIsNone(get_s3_range(None))
+        self.assertIsNone(get_s3_range("bytes=-"))
+        self.assertIsNone(get_s3_range("bytes=9-5"))
+        self.assertIsNone(get_s3_range("bytes=0-1,4-5"))
+        self.assertIsNone(get_s3_range("items=0-1"))
+
     def test_raises_validation_error_validators_func(self):
         with self.assertRaises(ValidationError) as context:
             validate_prompt_token_length(random_prompt_text)
@@ -689,7 +1209,7 @@ class VideoHelpersTestCase(TestCase):
         mock_client_instance = MagicMock()
         mock_boto_client.return_value = mock_client_instance
 
-        client = get_s3_client()
+        client = create_s3_client()
         mock_boto_client.assert_called_once_with('s3', region_name="us-east-1")
         self.assertEqual(client, mock_client_instance)
 
@@ -704,7 +1224,7 @@ class VideoHelpersTestCase(TestCase):
         mock_client_instance = MagicMock()
         mock_boto_client.return_value = mock_client_instance
 
-        client = get_s3_client()
+        client = create_s3_client()
         mock_boto_client.assert_called_once_with(
             's3',
             aws_access_key_id="FAKEKEY",
@@ -721,9 +1241,45 @@ class VideoHelpersTestCase(TestCase):
         mock_settings.AWS_ACCESS_KEY = "INVALID"
         mock_settings.AWS_SECRET_ACCESS_KEY = "INVALID"
 
+        get_cached_s3_client.cache_clear()
+        self.addCleanup(get_cached_s3_client.cache_clear)
+
         client = get_s3_client()
         self.assertIsNone(client)
 
+    @patch('videos.utils.create_s3_client')
+    def test_s3_client_is_created_once_per_process(self, mock_create_s3_client):
+        get_cached_s3_client.cache_clear()
+        self.addCleanup(get_cached_s3_client.cache_clear)
+        mock_create_s3_client.side_effect = [None, MockS3Client(), MockS3Client()]
+
+        # A failed login isn't cached so the next call tries again
+        self.assertIsNone(get_s3_client())
+        client = get_s3_client()
+
+        self.assertIsInstance(client, MockS3Client)
+        self.assertIs(get_s3_client(), client)
+        self.assertEqual(mock_create_s3_client.call_count, 2)
+
+    @override_settings(VIDEO_URL_EXPIRY=3600, VIDEO_URL_REFRESH_MARGIN=300)
+    @patch('videos.utils.cache')
+    @patch('videos.utils.get_s3_client')
+    def test_video_presigned_url_is_cached_until_near_expiry(self, mock_get_s3_client, mock_cache):
+        mock_s3_client = MagicMock()
+        mock_s3_client.generate_presigned_url.return_value = "http://signed.url"
+        mock_get_s3_client.return_value = mock_s3_client
+        mock_cache.get.return_value = None
+
+        self.assertEqual(get_video_presigned_url(7), "http://signed.url")
+
+        mock_s3_client.generate_presigned_url.assert_called_once_with(
+            'get_object', Params={'Bucket': settings.S3_BUCKET_NAME, 'Key': "videos/7.mp4"}, ExpiresIn=3600)
+        mock_cache.set.assert_called_once_with("video_presigned_url:7", "http://signed.url", timeout=3300)
+
+        mock_cache.get.return_value = "http://cached.url"
+        self.assertEqual(get_video_presigned_url(7), "http://cached.url")
+        mock_s3_client.generate_presigned_url.assert_called_once()
+
     @patch('videos.tasks.get_s3_client', return_value=None)
     def test_raises_exception_when_s3_client_is_none(self, mock_get_client):
         with self.assertRaises(Exception) as context:
@@ -1,7 +1,10 @@
 from transformers import GPT2Tokenizer
 import boto3
+import re
+import threading
 from functools import lru_cache
 from django.conf import settings
+from django.core.cache import cache
 import logging
 
 logger = logging.getLogger("django_mcq")
@@ -12,7 +15,7 @@ def get_tokenizer():
     return GPT2Tokenizer.from_pretrained("gpt2")
 
 
-def get_s3_client():
+def create_s3_client():
 
     region = settings.AWS_REGION
 
@@ -43,3 +46,88 @@ def get_s3_client():
     else:
         return s3_client
 
+
+# boto3 isn't thread safe while it builds a client, once built the client can be shared by every thread
+_s3_client_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def get_cached_s3_client():
+    s3_client = create_s3_client()
+
+    if s3_client is None:
+        # lru_cache doesn't keep exceptions so a failed login is tried again on the next call
+        raise RuntimeError("Could not create S3 client")
+
+    return s3_client
+
+
+def get_s3_client():
+    """Returns the process wide S3 client, or None if it can't be created."""
+
+    with _s3_client_lock:
+        try:
+            return get_cached_s3_client()
+        except RuntimeError:
+            return None
+
+
+def get_video_url_cache_key(video_pk: int):
+    return f"video_presigned_url:{video_pk}"
+
+
+def get_video_presigned_url(video_pk: int):
+    """
+    Returns a presigned S3 url to play the video, or None if there is no S3 client. Urls are cached and reused
+    until VIDEO_URL_REFRESH_MARGIN seconds before they expire so the browser never gets one about to run out.
+    """
+
+    cache_key = get_video_url_cache_key(video_pk)
+    presigned_url = cache.get(cache_key)
+
+    if presigned_url is not None:
+        return presigned_url
+
+    s3 = get_s3_client()
+
+    if s3 is None:
+        return None
+
+    presigned_url = s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': settings.S3_BUCKET_NAME, 'Key': f"videos/{video_pk}.mp4"},
+        ExpiresIn=settings.VIDEO_URL_EXPIRY
+    )
+
+    cache.set(cache_key, presigned_url, timeout=settings.VIDEO_URL_EXPIRY - settings.VIDEO_URL_REFRESH_MARGIN)
+
+    return presigned_url
+
+
+def forget_video_presigned_url(video_pk: int):
+    cache.delete(get_video_url_cache_key(video_pk))
+
+
+def get_s3_range(range_header):
+    """
+    Returns the S3 Range for a request's Range header. Only a single byte range is supported, anything else is
+    ignored so the whole video is sent as the HTTP spec allows.
+    """
+
+    if not range_header:
+        return None
+
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+
+    if match is None:
+        return None
+
+    start, end = match.groups()
+
+    if not start and not end:
+        return None
+
+    if start and end and int(start) > int(end):
+        return None
+
+    return f"bytes={start}-{end}"
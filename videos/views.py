@@ -1,27 +1,34 @@
 import boto3
 from botocore.exceptions import ClientError
 
-from io import BytesIO
-
-from django.shortcuts import render, get_object_or_404, redirect
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, get_object_or_404, redirect, aget_object_or_404
 from django.views.generic.list import ListView
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic.detail import DetailView
+from django.db import transaction
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
 from django.views.generic.edit import DeleteView
 from django.urls import reverse_lazy
-from django.http import Http404, FileResponse, JsonResponse
+from django.http import Http404, FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
 
+import asyncio
 import logging
 import json
-import requests
+import time
 
+from MCQ_Generator.streaming import is_asgi_request
+from videos.circuit_breaker import record_video_api_success
 from videos.forms import VideoForm
-from videos.tasks import delete_s3_file, send_request_to_text_to_vid_api, send_test_request, retry_failed_fastapi_jobs
-from videos.utils import get_s3_client
+from videos.scheduler import expire_stale_videos
+from videos.tasks import delete_s3_file, dispatch_video_queue, send_test_request, retry_failed_fastapi_jobs
+from videos.utils import forget_video_presigned_url, get_s3_client, get_s3_range, get_video_presigned_url
 
 from django.contrib import messages
 
@@ -40,88 +47,92 @@ class VideoListView(LoginRequiredMixin, ListView):
         # Filter quizzes by the current logged-in user
         return Video.objects.filter(user=self.request.user)
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+
+        # Playback links for the page, signed urls are cached so this doesn't talk to S3 on every view
+        for video in context["videos"]:
+            video.video_url = None
+            if video.status == "completed":
+                try:
+                    video.video_url = get_video_presigned_url(video.pk)
+                except Exception as e:
+                    logger.error(f"Error generating S3 URL: {e}")
+
+        return context
+
 class VideoDetailView(LoginRequiredMixin, DetailView):
     model = Video
     template_name = "videos/video_detail.html"
     context_object_name = "video"
 
     def get_queryset(self):
-        # Ensure users can only access their own documents
+        # Ensure users can only access their own videos
         return Video.objects.filter(user=self.request.user)
 
-    def get_object(self, queryset=None):
-        queryset = self.get_queryset()
-        return get_object_or_404(queryset, pk=self.kwargs.get("pk"))
-
-    def get(self, request, *args, **kwargs):
-        self.object = self.get_object()
-
-        status = None
-        message = None
-
-        if self.object.status == "processing":
-            status, message = self.poll_video_status(self.object)
-
-        context = self.get_context_data(object=self.object, status=status, message=message)
-        return self.render_to_response(context)
-
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        # 🔽 Add your extra data here
-        context["status"] = kwargs.get("status", None)
-        context["message"] = kwargs.get("message", None)
-
+        # Milliseconds the page waits between status requests, under ASGI the server does the waiting
+        context["status_poll_delay"] = 0 if is_asgi_request(self.request) else int(
+            settings.VIDEO_STATUS_POLL_INTERVAL * 1000)
 
         if self.object.status == "completed":
 
             # 🔽 Add pre-signed video URL
-            s3 = get_s3_client()
-            if s3:
-                video = self.object
-                try:
-                    presigned_url = s3.generate_presigned_url(
-                        'get_object',
-                        Params={'Bucket': settings.S3_BUCKET_NAME, 'Key': f"videos/{video.pk}.mp4"},
-                        ExpiresIn=3600
-                    )
-                    context["video_url"] = presigned_url
-                except Exception as e:
-                    logger.error(f"Error generating S3 URL: {e}")
-                    context["video_url_error"] = "Could not load video."
-                    context["video_url"] = None
-            else:
-                context["video_url"] = None
+            try:
+                presigned_url = get_video_presigned_url(self.object.pk)
+            except Exception as e:
+                logger.error(f"Error generating S3 URL: {e}")
+                presigned_url = None
+
+            context["video_url"] = presigned_url
+            if presigned_url is None:
                 context["video_url_error"] = "Could not load video."
         else:
             context["video_url"] = None
 
         return context
 
-    def poll_video_status(self, video):
-        """
-        Polls external API for latest status based on the video object.
-        This is just a placeholder — add your logic.
-        """
 
-        try:
-            response = requests.get(f"{settings.VIDEOAPI_BASE_URL}/status/{video.celery_task_id}")
-            response.raise_for_status()
-            data = response.json()
+def get_video_status_data(video):
+    return {
+        "status": video.status,
+        "progress": video.progress,
+        "message": video.status_message,
+        "updated_at": video.status_updated_at.isoformat(),
+    }
 
-        except requests.RequestException as e:
-            # Handle or log error
-            logger.error(f"Error polling API: {e}")
-            message = f"Error connecting to API"
-            status = "error"
-            return status, message
-
-        else:
 
-            status = data['status']
-            message = data['message']
+@transaction.non_atomic_requests
+@login_required
+@require_GET
+async def video_status(request, pk):
+    """
+    Status for the detail page, only the database is read as the video API pushes its updates to the webhooks
+    below. Under ASGI this is a long poll: it answers as soon as the status has changed since the client's `since`
+    timestamp, otherwise it waits up to VIDEO_STATUS_LONG_POLL_TIMEOUT seconds and sends the unchanged status
+    back. Under WSGI waiting would hold a worker, so it always answers straight away and the page polls again after
+    VIDEO_STATUS_POLL_INTERVAL seconds.
+    """
+
+    user = await request.auser()
+    since = parse_datetime(request.GET.get("since", ""))
+    # Without this a lost video would be shown as processing until the next dispatch happened to expire it
+    await sync_to_async(expire_stale_videos)(pk=pk, user=user)
+    wait = settings.VIDEO_STATUS_LONG_POLL_TIMEOUT if is_asgi_request(request) else 0
+    deadline = time.monotonic() + wait
+
+    while True:
+        video = await aget_object_or_404(
+            Video.objects.only("status", "progress", "status_message", "status_updated_at"), pk=pk, user=user
+        )
+
+        if since is None or video.status_updated_at > since or time.monotonic() >= deadline:
+            return JsonResponse(get_video_status_data(video))
+
+        await asyncio.sleep(settings.VIDEO_STATUS_POLL_INTERVAL)
 
-            return status, message
 
 @login_required(login_url='login')
 def upload_video(request):
@@ -140,7 +151,8 @@ def upload_video(request):
             s3_url = f"https://{s3_bucket}.s3.{region}.amazonaws.com/{s3_key}"
             video.s_three_url = None
             video.celery_task_id = None
-            video.status = "uploaded"
+            video.status = "queued"
+            video.queued_at = timezone.now()
 
             try:
                 video.save()
@@ -149,7 +161,7 @@ def upload_video(request):
                 messages.error(request, f"An error occurred: {str(e)}")
                 return render(request, "videos/upload_video.html", {"form": form})
 
-            send_request_to_text_to_vid_api.delay_on_commit(video_id=video.pk, prompt=video.prompt)
+            dispatch_video_queue.delay_on_commit()
 
             messages.success(request, "Data saved successfully!")
             return redirect("video_index")  # Redirect after saving
@@ -175,9 +187,10 @@ class VideoDeleteView(LoginRequiredMixin, DeleteView):
 
     def get_queryset(self):
         """
-        Limit the queryset to quizzes owned by the logged-in user.
+        Limit the queryset to quizzes owned by the logged-in user. Queued videos can't be deleted as the dispatcher
+        may be claiming them.
         """
-        return Video.objects.filter(user=self.request.user)
+        return Video.objects.filter(user=self.request.user).exclude(status="queued")
 
     def handle_no_permission(self):
         """
@@ -191,6 +204,7 @@ class VideoDeleteView(LoginRequiredMixin, DeleteView):
 
         if instance.status == "completed":
             delete_s3_file.delay_on_commit(video_id=instance.pk)
+            forget_video_presigned_url(instance.pk)
 
         # Proceed with the standard delete operation
         return super().form_valid(form)
@@ -207,19 +221,31 @@ def download_video(request, pk):
         messages.error(request, "An error occurred")
         return redirect("video_detail", pk=video.pk)
 
-    try:
+    s3_key = f"videos/{video.pk}.mp4"
+    filename = f"{video.pk}.mp4"
 
-        s3_object = s3.get_object(Bucket=settings.S3_BUCKET_NAME, Key=f"videos/{video.pk}.mp4")
+    try:
 
-        file_stream = BytesIO(s3_object['Body'].read())
+        if settings.VIDEO_DOWNLOAD_MODE == "redirect":
+            # The browser downloads straight from S3 so the worker is free as soon as the url is signed
+            presigned_url = s3.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': settings.S3_BUCKET_NAME, 'Key': s3_key,
+                        'ResponseContentDisposition': f'attachment; filename="{filename}"'},
+                ExpiresIn=settings.VIDEO_DOWNLOAD_URL_EXPIRY
+            )
+            response = redirect(presigned_url)
+        else:
+            response = stream_s3_video(s3, s3_key, filename, request.headers.get("Range"),
+                                       use_async=is_asgi_request(request))
 
-        # Return the file response
-        response = FileResponse(file_stream, as_attachment=True)
-        response['Content-Disposition'] = f'attachment; filename="{video.pk}.mp4"'
+    except ClientError as client_error:
+        error_code = client_error.response['Error']['Code']
 
+        if error_code == 'InvalidRange':
+            return HttpResponse(status=416)
 
-    except ClientError as client_error:
-        if client_error.response['Error']['Code'] == 'NoSuchKey':
+        if error_code == 'NoSuchKey':
             logger.error(client_error)
             messages.error(request, "File not found in S3")
         else:
@@ -236,16 +262,61 @@ def download_video(request, pk):
     else:
         return response
 
+
+def stream_s3_video(s3, s3_key, filename, range_header=None, use_async=False):
+    """
+    Streams the S3 object to the client in VIDEO_DOWNLOAD_CHUNK_SIZE blocks so a download holds one block in
+    memory however large the video is. A single byte range is passed on to S3 and answered with a 206.
+
+    Under ASGI Django reads a sync iterator such as FileResponse's to the end before sending it, so use_async
+    streams the body through an async iterator instead.
+    """
+
+    get_object_params = {"Bucket": settings.S3_BUCKET_NAME, "Key": s3_key}
+
+    s3_range = get_s3_range(range_header)
+    if s3_range:
+        get_object_params["Range"] = s3_range
+
+    s3_object = s3.get_object(**get_object_params)
+
+    if use_async:
+        response = StreamingHttpResponse(aiter_s3_body(s3_object['Body'], settings.VIDEO_DOWNLOAD_CHUNK_SIZE),
+                                         content_type="video/mp4")
+    else:
+        response = FileResponse(s3_object['Body'], as_attachment=True, filename=filename)
+        response.block_size = settings.VIDEO_DOWNLOAD_CHUNK_SIZE
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Accept-Ranges'] = 'bytes'
+
+    if s3_object.get('ContentLength') is not None:
+        response['Content-Length'] = s3_object['ContentLength']
+
+    if s3_range and s3_object.get('ContentRange'):
+        response.status_code = 206
+        response['Content-Range'] = s3_object['ContentRange']
+
+    return response
+
+
+async def aiter_s3_body(body, chunk_size):
+    read = sync_to_async(body.read, thread_sensitive=False)
+
+    try:
+        while chunk := await read(chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+
 @login_required
 def test_video(request):
     send_test_request.delay()
     return redirect("video_index")
 
-@csrf_exempt
-@require_POST
-def video_complete_notification(request):
+def check_video_api_key(request):
+    """Returns a 401 response unless the request carries the video API's bearer token, otherwise None."""
 
-    payload = {}
     expected_api_key = settings.DJANGO_API_KEY
     auth_header = request.headers.get("Authorization")
 
@@ -254,10 +325,23 @@ def video_complete_notification(request):
         return JsonResponse({"error": "Unauthorized"}, status=401)
 
     token = auth_header.split(" ", 1)[1]
-    if token != expected_api_key:
+    if not constant_time_compare(token, expected_api_key):
         logger.warning("Invalid API key")
         return JsonResponse({"error": "Unauthorized"}, status=401)
 
+    return None
+
+
+@csrf_exempt
+@require_POST
+def video_complete_notification(request):
+
+    payload = {}
+
+    unauthorized = check_video_api_key(request)
+    if unauthorized:
+        return unauthorized
+
     # Parse JSON payload
     try:
         payload = json.loads(request.body.decode("utf-8"))
@@ -286,9 +370,12 @@ def video_complete_notification(request):
 
     if status == "completed":
         video.s_three_url = video_url
+        video.progress = 100
+        video.status_message = ""
 
     if status == "error":
         logger.error(error_message)
+        video.status_message = (error_message or "")[:255]
 
     try:
         video.save()
@@ -296,6 +383,50 @@ def video_complete_notification(request):
         logger.error(e)
         return JsonResponse({"error": "An error occurred"}, status=500)
 
+    if status in ("completed", "error"):
+        # The video's slot is free, start the next queued one
+        dispatch_video_queue.delay_on_commit()
+
+    return JsonResponse({"message": "Webhook processed"}, status=200)
+
+@csrf_exempt
+@require_POST
+def video_progress_notification(request):
+    """
+    Intermediate progress from the video API, {"video_id": 1, "progress": 40, "message": "Rendering"}. Only videos
+    still being processed are updated so a late progress update can't undo the completion webhook.
+    """
+
+    unauthorized = check_video_api_key(request)
+    if unauthorized:
+        return unauthorized
+
+    try:
+        payload = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON received in progress webhook")
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    if not isinstance(payload, dict) or not all(field in payload for field in ["video_id", "progress"]):
+        logger.error(f"Missing fields in payload: {payload}")
+        return JsonResponse({"error": "Missing fields"}, status=400)
+
+    try:
+        progress = min(max(int(payload["progress"]), 0), 100)
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "Invalid progress"}, status=400)
+
+    updated = Video.objects.filter(pk=payload["video_id"], status="processing").update(
+        progress=progress,
+        status_message=str(payload.get("message") or "")[:255],
+        status_updated_at=timezone.now(),
+    )
+
+    if not updated:
+        if not Video.objects.filter(pk=payload["video_id"]).exists():
+            return JsonResponse({"error": "Video not found"}, status=404)
+        logger.info(f"Ignoring progress for video {payload['video_id']}, it is no longer processing")
+
     return JsonResponse({"message": "Webhook processed"}, status=200)
 
 @csrf_exempt
@@ -305,7 +436,9 @@ def fastapi_status_view(request):
         data = json.loads(request.body)
         status = data.get("status")
         if status == "on":
-            retry_failed_fastapi_jobs.delay()
+            # The API told us itself that it is up, no need to wait for a probe
+            record_video_api_success()
+            retry_failed_fastapi_jobs.delay_on_commit()
             return JsonResponse({"message": "Status updated"}, status=200)
         else:
             logger.error("Error occured when notifying django that fastapi is on")